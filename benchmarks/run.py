@@ -0,0 +1,382 @@
+"""
+Benchmark remoteauth against a local stub OAuth/API server.
+
+    python -m benchmarks.run --concurrency 16 --requests 2000 --output new.json
+    python -m benchmarks.run --baseline old.json --output new.json
+
+Results are written as JSON. With --baseline, scenarios that lost more than
+--tolerance of their throughput, or gained as much p99 latency, are reported
+and the run exits with status 1.
+"""
+
+import argparse
+import asyncio
+import gc
+import io
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from importlib import metadata
+
+from benchmarks.stub_server import StubServer
+
+SCENARIOS = (
+    "authenticate",
+    "fetch",
+    "post",
+    "apify_wsgi",
+    "apify_asgi",
+)
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+
+def summarize(outcomes, seconds):
+    latencies = [latency for latency, ok in outcomes if ok]
+    errors = len(outcomes) - len(latencies)
+    summary = {
+        "requests": len(outcomes),
+        "errors": errors,
+        "seconds": round(seconds, 3),
+        "throughput": round(len(latencies) / seconds, 1) if seconds else 0,
+    }
+    if latencies:
+        summary["p50_ms"] = round(percentile(latencies, 0.5) * 1000, 3)
+        summary["p99_ms"] = round(percentile(latencies, 0.99) * 1000, 3)
+    return summary
+
+
+def run_threads(call, total, concurrency):
+    """
+    Make total calls from concurrency threads, as WSGI workers would
+    """
+
+    def timed(_):
+        started = time.perf_counter()
+        try:
+            ok = call()
+        except Exception:
+            ok = False
+        return time.perf_counter() - started, ok
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(timed, range(concurrency)))  # warm up
+        started = time.perf_counter()
+        outcomes = list(pool.map(timed, range(total)))
+        return summarize(outcomes, time.perf_counter() - started)
+
+
+def run_tasks(call, total, concurrency):
+    """
+    Make total calls from concurrency tasks on one event loop, as an ASGI
+    server would
+    """
+
+    async def main():
+        async def worker(count, outcomes):
+            for _ in range(count):
+                started = time.perf_counter()
+                try:
+                    ok = await call()
+                except Exception:
+                    ok = False
+                outcomes.append((time.perf_counter() - started, ok))
+
+        await asyncio.gather(*[worker(1, []) for _ in range(concurrency)])
+        outcomes = []
+        per_worker, extra = divmod(total, concurrency)
+        started = time.perf_counter()
+        await asyncio.gather(
+            *[worker(per_worker + (n < extra), outcomes) for n in range(concurrency)]
+        )
+        return summarize(outcomes, time.perf_counter() - started)
+
+    return asyncio.run(main())
+
+
+def wsgi_get(handler, path, query_string=""):
+    """
+    Send a GET through a Django WSGI handler the way a WSGI server would
+    """
+    environ = {
+        "REQUEST_METHOD": "GET",
+        "PATH_INFO": path,
+        "QUERY_STRING": query_string,
+        "SERVER_NAME": "bench",
+        "SERVER_PORT": "80",
+        "SERVER_PROTOCOL": "HTTP/1.1",
+        "HTTP_HOST": "bench",
+        "wsgi.input": io.BytesIO(),
+        "wsgi.errors": sys.stderr,
+        "wsgi.url_scheme": "http",
+    }
+    statuses = []
+    response = handler(environ, lambda status, headers: statuses.append(status))
+    try:
+        b"".join(response)
+    finally:
+        response.close()
+    return statuses[0]
+
+
+async def asgi_get(handler, path, query_string=""):
+    """
+    Send a GET through a Django ASGI handler the way an ASGI server would
+    """
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query_string.encode(),
+        "root_path": "",
+        "headers": [(b"host", b"bench")],
+        "client": ("127.0.0.1", 50000),
+        "server": ("bench", 80),
+    }
+    body_sent = asyncio.Event()
+    disconnected = asyncio.Event()
+    messages = []
+
+    async def receive():
+        if not body_sent.is_set():
+            body_sent.set()
+            return {"type": "http.request", "body": b"", "more_body": False}
+        # The client stays connected until the response is sent
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        messages.append(message)
+
+    await handler(scope, receive, send)
+    disconnected.set()
+    return messages[0]["status"]
+
+
+def build_scenarios():
+    from django.core.handlers.asgi import ASGIHandler
+    from django.core.handlers.wsgi import WSGIHandler
+
+    from remoteauth import api, transport
+
+    backend = api.RemoteBackend()
+    wsgi_handler = WSGIHandler()
+    asgi_handler = ASGIHandler()
+
+    async def apify_asgi():
+        return await asgi_get(asgi_handler, "/asgi/items/", "page=1") == 200
+
+    scenarios = {
+        "authenticate": lambda: backend.authenticate(
+            None, username="bench", password="secret"
+        )
+        is not None,
+        "fetch": lambda: api.fetch("/items/?page=1").ok,
+        "post": lambda: api.post("/items/", {"name": "bench"}).ok,
+        "apify_wsgi": lambda: wsgi_get(wsgi_handler, "/wsgi/items/", "page=1")
+        == "200 OK",
+    }
+    if transport.httpx is not None:
+        scenarios["apify_asgi"] = apify_asgi
+    return scenarios
+
+
+def retained_state():
+    """
+    Sizes of the structures remoteauth keeps between requests. Before the
+    request context moved to a ContextVar it was kept in the module level
+    _requests dict, which is reported too should it come back.
+    """
+    from remoteauth import api
+
+    return {
+        "requests_dict_entries": len(getattr(api, "_requests", {})),
+        "request_context_left": api.get_request_context() is not None,
+        "token_store_entries": len(getattr(api.token_store, "_tokens", {})),
+        "token_store_locks": len(getattr(api.token_store, "_locks", {})),
+        "response_cache_entries": len(getattr(api.responses, "_entries", {})),
+        "inflight_gets": api.inflight_gets.stats()["in_flight"],
+    }
+
+
+def measure_memory(call, total, concurrency, checkpoints=10):
+    """
+    Make total calls and report how much memory is still held after each
+    tenth of them
+    """
+    tracemalloc.start()
+    run_threads(call, concurrency, concurrency)
+    gc.collect()
+    baseline = tracemalloc.get_traced_memory()[0]
+
+    growth = []
+    batch = max(total // checkpoints, 1)
+    for done in range(batch, total + 1, batch):
+        run_threads(call, batch, concurrency)
+        gc.collect()
+        growth.append([done, tracemalloc.get_traced_memory()[0] - baseline])
+    tracemalloc.stop()
+
+    return {
+        "requests": growth[-1][0],
+        "growth_bytes": growth[-1][1],
+        "bytes_per_request": round(growth[-1][1] / growth[-1][0], 1),
+        "growth": growth,
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "retained": retained_state(),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Return the scenarios that got slower than baseline by more than tolerance
+    """
+    regressions = []
+    for name, result in results["results"].items():
+        before = baseline.get("results", {}).get(name, {})
+        # Skipped scenarios carry no numbers to compare
+        if "throughput" not in result or "throughput" not in before:
+            continue
+        if result["throughput"] < before["throughput"] * (1 - tolerance):
+            regressions.append(
+                {
+                    "scenario": name,
+                    "metric": "throughput",
+                    "baseline": before["throughput"],
+                    "current": result["throughput"],
+                }
+            )
+        if "p99_ms" in result and "p99_ms" in before:
+            if result["p99_ms"] > before["p99_ms"] * (1 + tolerance):
+                regressions.append(
+                    {
+                        "scenario": name,
+                        "metric": "p99_ms",
+                        "baseline": before["p99_ms"],
+                        "current": result["p99_ms"],
+                    }
+                )
+    return regressions
+
+
+def version():
+    try:
+        return metadata.version("remoteauth")
+    except metadata.PackageNotFoundError:
+        return "unknown"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--latency", type=float, default=5, help="stub server latency in ms"
+    )
+    parser.add_argument(
+        "--payload-size", type=int, default=4096, help="bytes per data response"
+    )
+    parser.add_argument(
+        "--scenarios", nargs="*", choices=SCENARIOS, default=list(SCENARIOS)
+    )
+    parser.add_argument(
+        "--memory-requests",
+        type=int,
+        default=5000,
+        help="proxied requests made to measure memory growth, 0 to skip",
+    )
+    parser.add_argument("--output", help="write the results here, not to stdout")
+    parser.add_argument("--baseline", help="results of an earlier run to compare to")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    server = StubServer(
+        latency=args.latency / 1000, payload_size=args.payload_size
+    ).start()
+    database = tempfile.NamedTemporaryFile(suffix=".sqlite3", delete=False)
+    database.close()
+    os.environ["REMOTEAUTH_BENCH_ENDPOINT"] = server.url
+    os.environ["REMOTEAUTH_BENCH_DATABASE"] = database.name
+    os.environ["DJANGO_SETTINGS_MODULE"] = "benchmarks.settings"
+
+    import django
+    from django.core.management import call_command
+
+    django.setup()
+    call_command("migrate", verbosity=0)
+
+    try:
+        scenarios = build_scenarios()
+        results = {
+            "meta": {
+                "remoteauth": version(),
+                "django": django.get_version(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "timestamp": datetime.now(timezone.utc).isoformat(),
+            },
+            "config": {
+                "requests": args.requests,
+                "concurrency": args.concurrency,
+                "latency_ms": args.latency,
+                "payload_size": args.payload_size,
+            },
+            "results": {},
+        }
+        for name in args.scenarios:
+            if name not in scenarios:
+                results["results"][name] = {"skipped": "httpx is not installed"}
+                continue
+            run = run_tasks if name.endswith("_asgi") else run_threads
+            results["results"][name] = run(
+                scenarios[name], args.requests, args.concurrency
+            )
+        if args.memory_requests:
+            results["memory"] = measure_memory(
+                scenarios["apify_wsgi"], args.memory_requests, args.concurrency
+            )
+    finally:
+        server.stop()
+        os.unlink(database.name)
+
+    status = 0
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            results["regressions"] = compare(
+                results, json.load(baseline), args.tolerance
+            )
+        for regression in results["regressions"]:
+            print(
+                "{scenario} {metric}: {baseline} -> {current}".format(**regression),
+                file=sys.stderr,
+            )
+        status = 1 if results["regressions"] else 0
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
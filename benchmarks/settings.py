@@ -0,0 +1,43 @@
+"""
+Django settings for the benchmarks. The runner starts the stub server and
+points API_ENDPOINT at it through the environment before Django is set up.
+"""
+
+import os
+
+SECRET_KEY = "benchmarks"
+DEBUG = False
+ALLOWED_HOSTS = ["*"]
+USE_TZ = True
+
+API_ENDPOINT = os.environ["REMOTEAUTH_BENCH_ENDPOINT"]
+API_CLIENT_ID = "bench-client-id"
+API_CLIENT_SECRET = "bench-client-secret"
+# Every proxied request is timed, metrics are kept as in production
+API_METRICS_VIEW = True
+
+INSTALLED_APPS = [
+    "django.contrib.auth",
+    "django.contrib.contenttypes",
+    "django.contrib.sessions",
+    "remoteauth",
+]
+MIDDLEWARE = [
+    "django.contrib.sessions.middleware.SessionMiddleware",
+    "remoteauth.api.GlobalRequestMiddleware",
+]
+AUTHENTICATION_BACKENDS = ["remoteauth.api.RemoteBackend"]
+ROOT_URLCONF = "benchmarks.urls"
+DATABASES = {
+    "default": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": os.environ["REMOTEAUTH_BENCH_DATABASE"],
+    }
+}
+CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+SESSION_ENGINE = "django.contrib.sessions.backends.cache"
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "loggers": {"remoteauth": {"level": "CRITICAL"}},
+}
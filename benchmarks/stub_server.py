@@ -0,0 +1,115 @@
+"""
+A local stand-in for the OAuth server and the API, with a fixed latency and
+payload size, so benchmarks measure remoteauth rather than the network.
+"""
+
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Keep connections alive like a real upstream would
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, do not let them wait on ACKs
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._respond()
+
+    def do_POST(self):
+        self._respond()
+
+    def do_PUT(self):
+        self._respond()
+
+    def do_DELETE(self):
+        self._respond()
+
+    def _respond(self):
+        length = int(self.headers.get("Content-Length", 0) or 0)
+        if length:
+            self.rfile.read(length)
+
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+
+        path = self.path.split("?", 1)[0]
+        if path.endswith(server.token_path):
+            body = json.dumps(
+                {
+                    "access_token": uuid.uuid4().hex,
+                    "refresh_token": uuid.uuid4().hex,
+                    "token_type": "Bearer",
+                    "expires_in": 3600,
+                    "scope": "read write",
+                }
+            ).encode()
+        elif path.endswith(server.profile_path):
+            body = server.profile
+        else:
+            body = server.payload
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        latency=0.0,
+        payload_size=1024,
+        token_path="/oauth/token/",
+        profile_path="/users/profile/",
+    ):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.latency = latency
+        self.token_path = token_path
+        self.profile_path = profile_path
+        self.profile = json.dumps(
+            {
+                "username": "bench",
+                "first_name": "Bench",
+                "last_name": "Mark",
+                "email": "bench@example.com",
+                "roles": ["reader"],
+            }
+        ).encode()
+        self.payload = self._build_payload(payload_size)
+        self._thread = None
+
+    @staticmethod
+    def _build_payload(size):
+        # A list of small objects, like a typical API page, of about size bytes
+        item_size = len(json.dumps({"id": 0, "name": "item-000000"})) + 2
+        items = [
+            {"id": n, "name": f"item-{n:06d}"} for n in range(max(size // item_size, 1))
+        ]
+        return json.dumps({"results": items}).encode()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.serve_forever, name="remoteauth-stub", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,8 @@
+from django.urls import include, path
+
+from remoteauth.views import aapify
+
+urlpatterns = [
+    path("asgi/<str:path>/", aapify),
+    path("wsgi/", include("remoteauth.urls")),
+]
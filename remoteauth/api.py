@@ -1,13 +1,36 @@
-import requests
 import logging
-import datetime
+import hashlib
+import time
 from requests.auth import HTTPBasicAuth
-from requests.exceptions import ConnectionError, Timeout
+from requests.exceptions import ConnectionError, RequestException, Timeout
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar, copy_context
+from functools import partial
+from threading import Lock
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
 from django.conf import settings
 from django.contrib.auth.models import User
-from threading import get_ident
 from django.contrib.auth.backends import ModelBackend
 
+from remoteauth import (
+    codec,
+    graphql,
+    hedging,
+    jwks,
+    metrics,
+    pagination,
+    profiles,
+    resilience,
+    response_cache,
+    retry,
+    roles,
+    singleflight,
+    tracing,
+    transport,
+)
+from remoteauth.multipart import MultipartBody
+from remoteauth.tokens import ISO_DATE_FORMAT, Token, get_token_store
+
 
 logger = logging.getLogger(__name__)
 
@@ -21,26 +44,75 @@ ACCESS_TOKEN_ENDPOINT = getattr(settings, "ACCESS_TOKEN_ENDPOINT", "/oauth/token
 USER_PROFILE_ENDPOINT = getattr(settings, "USER_PROFILE_ENDPOINT", "/users/profile/")
 USER_ACCESS_TOKEN_KEY = "user_token"
 SITE_ACCESS_TOKEN_KEY = "site_token"
-ISO_DATE_FORMAT = "'%Y-%m-%dT%H:%M:%S'"
 RELATIVE_URL_PREFIX = getattr(settings, "RELATIVE_URL_PREFIX", "/api")
+# Seconds before expiry at which a token is no longer handed out
+TOKEN_EXPIRY_LEEWAY = getattr(settings, "API_TOKEN_EXPIRY_LEEWAY", 30)
+# Seconds before expiry at which a token is replaced in the background
+TOKEN_REFRESH_AHEAD = getattr(settings, "API_TOKEN_REFRESH_AHEAD", 300)
+# Threads shared by all gather() and fetch_many() calls of the process
+FANOUT_WORKERS = getattr(settings, "API_FANOUT_WORKERS", 8)
+COALESCE_REQUESTS = getattr(settings, "API_COALESCE_REQUESTS", False)
+# Endpoints given a circuit breaker and hedger of their own. apify lets
+# clients choose the paths called, so past this many the rest share one.
+MAX_ENDPOINTS = getattr(settings, "API_MAX_ENDPOINTS", 100)
+OTHER_ENDPOINT = metrics.OTHER_ENDPOINT
 
-_requests = {}
+# State of the request being handled in the current thread or task
+_request_context = ContextVar("remoteauth_request_context", default=None)
+# Token looked up once by gather() for all of its calls
+_shared_token = ContextVar("remoteauth_shared_token", default=None)
+token_store = get_token_store()
+responses = response_cache.get_response_cache()
+# Identical GETs in flight at the same time, see fetch(coalesce=True)
+inflight_gets = singleflight.Group()
+_fanout_executor = None
+_fanout_executor_lock = Lock()
+_endpoints = set()
+_endpoints_lock = Lock()
 
 
 class GlobalRequestMiddleware(object):
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
 
     def __call__(self, request):
-        _requests[get_ident()] = {"request": request}
-        response = self.get_response(request)
-        self.after_view_rendered(request, response)
-        return response
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        reset_token = _request_context.set(__new_request_context__(request))
+        try:
+            with tracing.request_trace(request) as trace:
+                response = self.get_response(request)
+                self.after_view_rendered(request, response)
+            if trace is not None:
+                trace.apply(response)
+            return response
+        finally:
+            _request_context.reset(reset_token)
+
+    async def __acall__(self, request):
+        reset_token = _request_context.set(__new_request_context__(request))
+        try:
+            with tracing.request_trace(request) as trace:
+                response = await self.get_response(request)
+                await sync_to_async(self.after_view_rendered)(request, response)
+            if trace is not None:
+                trace.apply(response)
+            return response
+        finally:
+            _request_context.reset(reset_token)
 
     def after_view_rendered(self, request, response):
-        data = _requests.pop(get_ident())
+        data = get_request_context() or {}
         current_request_auth_token = data.get("access_token", None)
         if current_request_auth_token:
+            if isinstance(current_request_auth_token, Token):
+                current_request_auth_token = current_request_auth_token.to_session()
             request.session[USER_ACCESS_TOKEN_KEY] = current_request_auth_token
         profile = data.get("user_profile", None)
         if profile:
@@ -49,8 +121,24 @@ class GlobalRequestMiddleware(object):
         return response
 
 
+def __new_request_context__(request):
+    return {
+        "request": request,
+        # API calls made for this request must not run past it
+        "deadline": retry.deadline_after(retry.REQUEST_DEADLINE),
+    }
+
+
+def get_request_context():
+    """
+    Return the state GlobalRequestMiddleware keeps for the current request,
+    or None outside of a request
+    """
+    return _request_context.get()
+
+
 def get_request():
-    data = _requests.get(get_ident(), None)
+    data = get_request_context()
     if data is not None:
         return data.get("request", None)
 
@@ -72,64 +160,149 @@ class ApiAccessToken:
             f" with client_id: xxxxx{last_5_client_id} and client_secret: xxxxx{last_5_client_secret}"
         )
 
-    def get_access_token(self, username=None, password=None, session={}):
+    def get_access_token(self, username=None, password=None, session=None):
+        if session is None:
+            session = {}
 
         token = None
         if session.get(USER_ACCESS_TOKEN_KEY, None) or (username and password):
-            token = self.__get_access_token_for_user(
-                username=username, password=password, session=session
-            )
+            with tracing.span("token"), metrics.timer(
+                "remoteauth_token_seconds", kind="user"
+            ):
+                token = self.__get_access_token_for_user(
+                    username=username, password=password, session=session
+                )
         else:
-            token = self._get_machine_token(session=session)
+            with tracing.span("token"), metrics.timer(
+                "remoteauth_token_seconds", kind="site"
+            ):
+                token = self._get_machine_token(session=session)
         return token
 
-    def _get_machine_token(self, session={}):
-        token = session.get(SITE_ACCESS_TOKEN_KEY, None)
-        if token is None or self.__is_expired(token):
-            url = __full_url__(ACCESS_TOKEN_ENDPOINT)
-            data = {"grant_type": "client_credentials"}
-            try:
-                response = requests.post(
-                    url=url,
-                    data=data,
-                    auth=HTTPBasicAuth(API_CLIENT_ID, API_CLIENT_SECRET),
+    async def aget_access_token(self, username=None, password=None, session=None):
+        """
+        Async version of get_access_token. Only loading the session, which
+        may query the database, runs in the thread Django keeps for that.
+        Token grants run on another thread, so that they do not hold up
+        other sync code of the request.
+        """
+        await __aload_session__(session)
+        return await sync_to_async(self.get_access_token, thread_sensitive=False)(
+            username=username, password=password, session=session
+        )
+
+    def invalidate(self, token, session=None):
+        """
+        Forget a token the upstream has rejected, so that the next call to
+        get_access_token fetches a new one
+        """
+        if session is None:
+            session = {}
+
+        user_token = Token.load(session.get(USER_ACCESS_TOKEN_KEY, None))
+        if user_token and user_token.access_token == token.get("access_token"):
+            # Keep the refresh token around so the user stays logged in
+            session[USER_ACCESS_TOKEN_KEY] = user_token.expired().to_session()
+        else:
+            session.pop(SITE_ACCESS_TOKEN_KEY, None)
+            token_store.invalidate(SITE_ACCESS_TOKEN_KEY, token)
+
+    async def ainvalidate(self, token, session=None):
+        await __aload_session__(session)
+        await sync_to_async(self.invalidate, thread_sensitive=False)(
+            token, session=session
+        )
+
+    def _get_machine_token(self, session=None):
+        if session is None:
+            session = {}
+
+        token = __session_token__(session, SITE_ACCESS_TOKEN_KEY)
+        if token is None or self.__is_due_for_refresh(token):
+            # One site token is shared by the whole process
+            token = Token.load(
+                token_store.get_or_refresh(
+                    SITE_ACCESS_TOKEN_KEY,
+                    is_valid=lambda t: not Token.load(t).is_expired(
+                        TOKEN_EXPIRY_LEEWAY
+                    ),
+                    refresh=self.__request_machine_token,
                 )
-                if response.ok:
-                    token = response.json()
-                    token.update(
-                        {"timestamp": datetime.datetime.now().strftime(ISO_DATE_FORMAT)}
+            )
+            if token is not None:
+                if self.__is_due_for_refresh(token):
+                    metrics.increment(
+                        "remoteauth_token_background_refreshes_total", kind="site"
                     )
-                    session[SITE_ACCESS_TOKEN_KEY] = token
-                else:
-                    self.__log_http_failure(
-                        url=url,
-                        response=response,
-                        context="ApiAccessToken.__get_site_access_token",
+                    token_store.refresh_in_background(
+                        SITE_ACCESS_TOKEN_KEY,
+                        self.__request_machine_token,
+                        is_due=lambda t: self.__is_due_for_refresh(Token.load(t)),
                     )
-            except ConnectionError:
-                logger.exception("Unable to connect to API token endpoint")
-            except Timeout:
-                logger.exception("Connecting to API token endpoint has timed out")
+                session[SITE_ACCESS_TOKEN_KEY] = token.to_session()
         return token
 
-    def __is_expired(self, token: dict):
-        token_grabbed_at = datetime.datetime.strptime(
-            token["timestamp"], ISO_DATE_FORMAT
-        )
-        now = datetime.datetime.now()
-        diff = now - token_grabbed_at
-        return diff >= datetime.timedelta(seconds=token["expires_in"])
-
-    def __get_access_token_for_user(self, username, password, session={}):
-        token = session.get(USER_ACCESS_TOKEN_KEY, None)
-        if token is None or self.__is_expired(token):
-            url = __full_url__(ACCESS_TOKEN_ENDPOINT)
+    def __request_machine_token(self):
+        url = __full_url__(ACCESS_TOKEN_ENDPOINT)
+        data = {"grant_type": "client_credentials"}
+        try:
+            response = transport.request(
+                "POST",
+                url=url,
+                endpoint=ACCESS_TOKEN_ENDPOINT,
+                data=data,
+                auth=HTTPBasicAuth(API_CLIENT_ID, API_CLIENT_SECRET),
+            )
+            if response.ok:
+                token = Token.from_grant(codec.loads(response.content))
+                __count_token_grant__(data["grant_type"], "ok")
+                return token
+            else:
+                __count_token_grant__(data["grant_type"], response.status_code)
+                self.__log_http_failure(
+                    url=url,
+                    response=response,
+                    context="ApiAccessToken.__get_site_access_token",
+                )
+        except ConnectionError:
+            __count_token_grant__(data["grant_type"], "error")
+            logger.exception("Unable to connect to API token endpoint")
+        except Timeout:
+            __count_token_grant__(data["grant_type"], "error")
+            logger.exception("Connecting to API token endpoint has timed out")
+
+    def __is_due_for_refresh(self, token: Token):
+        # Short-lived tokens are refreshed half way through their lifetime
+        window = min(TOKEN_REFRESH_AHEAD, (token.expires_in or 0) / 2)
+        return token.is_expired(window)
+
+    def __refreshed_token_key(self, token):
+        refresh_token = token.refresh_token.encode()
+        return f"{USER_ACCESS_TOKEN_KEY}:{hashlib.sha256(refresh_token).hexdigest()}"
+
+    def __take_refreshed_user_token(self, token):
+        """
+        Return the token fetched in the background to replace token, if any
+        """
+        if not token_store.shared:
+            return None
+        return Token.load(token_store.take(self.__refreshed_token_key(token)))
+
+    def __get_access_token_for_user(self, username, password, session):
+        token = __session_token__(session, USER_ACCESS_TOKEN_KEY)
+        if token is not None and token.refresh_token:
+            refreshed = self.__take_refreshed_user_token(token)
+            if refreshed is not None:
+                token = refreshed
+                session[USER_ACCESS_TOKEN_KEY] = token.to_session()
+
+        if token is None or token.is_expired(TOKEN_EXPIRY_LEEWAY):
             data = {}
             if token is not None:
                 logger.info("REFRESHING TOKEN")
                 data.update(
                     {
-                        "refresh_token": token["refresh_token"],
+                        "refresh_token": token.refresh_token,
                         "grant_type": "refresh_token",
                     }
                 )
@@ -143,23 +316,59 @@ class ApiAccessToken:
                     }
                 )
 
-            response = requests.post(
-                url=url, data=data, auth=HTTPBasicAuth(API_CLIENT_ID, API_CLIENT_SECRET)
+            new_token = self.__request_user_token(data)
+            if new_token is not None:
+                token = new_token
+                session[USER_ACCESS_TOKEN_KEY] = token.to_session()
+        elif (
+            token_store.shared
+            and token.refresh_token
+            and self.__is_due_for_refresh(token)
+        ):
+            # Still usable, fetch its replacement without making the user wait.
+            # It is parked in the shared store for whichever worker the
+            # session comes back to.
+            data = {
+                "refresh_token": token.refresh_token,
+                "grant_type": "refresh_token",
+            }
+            metrics.increment(
+                "remoteauth_token_background_refreshes_total", kind="user"
+            )
+            token_store.refresh_in_background(
+                self.__refreshed_token_key(token),
+                lambda: self.__request_user_token(data),
+            )
+
+        return token
+
+    def __request_user_token(self, data):
+        url = __full_url__(ACCESS_TOKEN_ENDPOINT)
+        try:
+            response = transport.request(
+                "POST",
+                url=url,
+                endpoint=ACCESS_TOKEN_ENDPOINT,
+                data=data,
+                auth=HTTPBasicAuth(API_CLIENT_ID, API_CLIENT_SECRET),
             )
             if response.ok:
-                token = response.json()
-                token.update(
-                    {"timestamp": datetime.datetime.now().strftime(ISO_DATE_FORMAT)}
-                )
-                session[USER_ACCESS_TOKEN_KEY] = token
+                token = Token.from_grant(codec.loads(response.content))
+                __count_token_grant__(data["grant_type"], "ok")
+                return token
             else:
+                __count_token_grant__(data["grant_type"], response.status_code)
                 self.__log_http_failure(
                     url=url,
                     response=response,
                     context="ApiAccessToken.__get_access_token_for_user",
                 )
-
-        return token
+        except ConnectionError:
+            __count_token_grant__(data["grant_type"], "error")
+            logger.exception("Unable to connect to API token endpoint")
+        except Timeout:
+            __count_token_grant__(data["grant_type"], "error")
+            logger.exception("Connecting to API token endpoint has timed out")
 
 
 class RemoteBackend(ModelBackend):
@@ -167,49 +376,123 @@ class RemoteBackend(ModelBackend):
     Custom authentication through a remote API
     """
 
-    def get_profile(self, token):
+    def __verified_profile(self, token):
+        """
+        Read the profile from the claims of a JWT access token. Returns None
+        when the token does not verify, or False when the keys to verify it
+        with could not be fetched and the profile endpoint is to be asked.
+        """
+        try:
+            return jwks.profile_of(token)
+        except RequestException:
+            logger.exception("Unable to fetch the JWKS document at %s", jwks.JWKS_URL)
+            return False
+
+    def get_profile(self, token, username=None):
+        if jwks.JWT_VALIDATION:
+            profile = self.__verified_profile(token)
+            if profile is not False:
+                return profile
+        profile = profiles.lookup(token, username)
+        if profile is not None:
+            return profile
         url = __full_url__(USER_PROFILE_ENDPOINT)
         headers = __get_auth_header__(token.get("access_token", None))
-        response = requests.get(url, headers=headers, auth=None)
+        try:
+            response = transport.request(
+                "GET", url, endpoint=USER_PROFILE_ENDPOINT, headers=headers, auth=None
+            )
+        except RequestException:
+            # An open circuit, a full bulkhead or a network failure fails the
+            # login rather than the request
+            logger.exception("Unable to fetch the user profile")
+            return None
         if response.ok:
-            return response.json()
+            profile = codec.loads(response.content)
+            profiles.remember(token, profile, username)
+            return profile
         logger.warn("GET PROFILE FAILED: {0}".format(response.text))
 
+    async def aget_profile(self, token, username=None):
+        if jwks.JWT_VALIDATION:
+            # The keys are only fetched now and then, but that is blocking
+            profile = await sync_to_async(self.__verified_profile)(token)
+            if profile is not False:
+                return profile
+        profile = await profiles.alookup(token, username)
+        if profile is not None:
+            return profile
+        url = __full_url__(USER_PROFILE_ENDPOINT)
+        headers = __get_auth_header__(token.get("access_token", None))
+        try:
+            response = await transport.arequest(
+                "GET", url, endpoint=USER_PROFILE_ENDPOINT, headers=headers
+            )
+        except RequestException:
+            logger.exception("Unable to fetch the user profile")
+            return None
+        if response.is_success:
+            profile = codec.loads(response.content)
+            await profiles.aremember(token, profile, username)
+            return profile
+        logger.warn("GET PROFILE FAILED: {0}".format(response.text))
+
+    @metrics.timed("remoteauth_authenticate_seconds")
     def authenticate(self, request, username=None, password=None):
         logger.info("AUTHENTICATING as {un}:{pwd}".format(un=username, pwd="*****"))
-        token = ApiAccessToken().get_access_token(
-            username=username, password=password, session={}
-        )
+        token = ApiAccessToken().get_access_token(username=username, password=password)
         user = None
         if token:
-            user_info = self.get_profile(token)
+            user_info = self.get_profile(token, username)
             if user_info:
                 try:
-                    user = User.objects.get(username=username)
-                except User.DoesNotExist:
-                    user = User.objects.create_user(
-                        username=user_info["username"],
-                        first_name=user_info["first_name"],
-                        last_name=user_info["last_name"],
-                        email=user_info["email"],
-                    )
+                    user = profiles.sync_user(username, user_info)
                 finally:
-                    # keep token in current thread's _requests dict
-                    request_data = _requests.get(get_ident(), {})
-                    request_data.update(
-                        {"access_token": token, "user_profile": user_info}
-                    )
-                    _requests[get_ident()] = request_data
+                    metrics.increment("remoteauth_logins_total", result="ok")
+                    self._keep_login(token, user_info)
+                    return user
+            else:
+                metrics.increment("remoteauth_logins_total", result="no_profile")
+                logger.warn("UNABLE to Get Profile")
+        else:
+            metrics.increment("remoteauth_logins_total", result="no_token")
+            logger.warn("UNABLE to log in")
 
+        # if we ever reach here then return none
+        return None
+
+    @metrics.timed("remoteauth_authenticate_seconds")
+    async def aauthenticate(self, request, username=None, password=None):
+        logger.info("AUTHENTICATING as {un}:{pwd}".format(un=username, pwd="*****"))
+        token = await ApiAccessToken().aget_access_token(
+            username=username, password=password
+        )
+        user = None
+        if token:
+            user_info = await self.aget_profile(token, username)
+            if user_info:
+                try:
+                    user = await profiles.async_user(username, user_info)
+                finally:
+                    metrics.increment("remoteauth_logins_total", result="ok")
+                    self._keep_login(token, user_info)
                     return user
             else:
+                metrics.increment("remoteauth_logins_total", result="no_profile")
                 logger.warn("UNABLE to Get Profile")
         else:
+            metrics.increment("remoteauth_logins_total", result="no_token")
             logger.warn("UNABLE to log in")
 
         # if we ever reach here then return none
         return None
 
+    def _keep_login(self, token, user_info):
+        # GlobalRequestMiddleware moves these into the session after the view
+        request_data = get_request_context()
+        if request_data is not None:
+            request_data.update({"access_token": token, "user_profile": user_info})
+
     def get_user(self, user_id):
         try:
             return User.objects.get(pk=user_id)
@@ -224,330 +507,817 @@ class RemoteBackend(ModelBackend):
         return (
             request
             and user_obj.is_authenticated
-            and perm in request.session.get("user_profile", {}).get("roles", [])
+            and perm in roles.exact_roles_of(request)
         )
 
 
 class ApiResults:
-    def __init__(self, ok=False, data=None, error_code=None):
+    """
+    The outcome of an API call. Results made with raw keep the JSON body as
+    bytes and only decode it when data is first read, so that a proxy can
+    pass it on untouched.
+    """
+
+    _undecoded = object()
+
+    def __init__(
+        self, ok=False, data=None, error_code=None, raw=None, content_type=None
+    ):
         self.ok = ok
-        self.data = data
+        self.raw = raw
+        self.content_type = content_type
+        self._data = self._undecoded if raw is not None and data is None else data
         self.error_code = error_code
 
+    @property
+    def data(self):
+        if self._data is self._undecoded:
+            with tracing.span("decode"):
+                self._data = codec.loads(self.raw)
+        return self._data
 
-def fetch(path, max_retry=3, json=True):
-    url = __full_url__(path)
-    token = ApiAccessToken().get_access_token(session=get_request_session())
-    if token:
-        headers = __get_auth_header__(token.get("access_token", None))
-        try:
-            response = requests.get(url, headers=headers, auth=None)
-            if response.ok:
-                return ApiResults(
-                    ok=response.ok, data=response.json() if json else response.text
-                )
-            else:
-                # in case http 401 we should refresh access token
-                if max_retry and response.status_code == 401:
-                    ApiAccessToken().get_access_token(session=get_request_session())
-                    return fetch(path, max_retry=max_retry - 1)
-                else:
-                    logger.warn(
-                        "api.fetch:= Unable to fetch data at {url}. Received http {statuscode}: {reason}".format(
-                            url=url,
-                            statuscode=response.status_code,
-                            reason=response.reason,
-                        )
-                    )
-                    try:
-                        error = response.json()
-                    except:
-                        error = {
-                            "error_code": "GENERAL_FAILURE",
-                            "message": response.text,
-                            "errors": None,
-                        }
-
-                    return ApiResults(error_code=response.status_code, data=error)
-        except ConnectionError:
-            logger.exception("Unable to connect to get to API endpoint {}".format(url))
-            return ApiResults(
-                error_code=NETWORK_ERROR_CODE,
-                data={
-                    "message": "Unable to connect to remote endpoint",
-                    "error_code": "NETWORK_ERROR",
-                },
-            )
-        except Timeout:
-            logger.exception("Connecting to API endpoint {} has timed out".format(url))
-            return ApiResults(
-                error_code=NETWORK_ERROR_CODE,
-                data={
-                    "message": "Unable to connect to remote endpoint",
-                    "error_code": "NETWORK_TIMEOUT_ERROR",
-                },
-            )
-        except Exception as ex:
-            logger.critical(f"Unable to connect to API {ex}")
-            return ApiResults(
-                error_code=NETWORK_ERROR_CODE,
-                data={
-                    "message": "Unable to connect to remote endpoint",
-                    "error_code": "GENERAL_NETWORK_ERROR",
-                },
-            )
-    else:
-        logger.critical(
-            "Unable to obtain access token for fetch request to {0}".format(url)
-        )
-        return ApiResults(
-            error_code=4000,
-            data={
-                "message": "Unable to obtain access token",
-                "error_code": "OBTAIN_ACCESS_TOKEN",
-            },
+    @data.setter
+    def data(self, value):
+        self._data = value
+
+    @property
+    def is_decoded(self):
+        return self._data is not self._undecoded
+
+
+def fetch(
+    path,
+    max_retry=3,
+    json=True,
+    cache_ttl=None,
+    coalesce=None,
+    hedge=None,
+    raw=False,
+):
+    """
+    GET path from the API. Responses of paths matched by
+    API_RESPONSE_CACHE_TTLS are cached per user; cache_ttl sets the seconds a
+    response stays fresh for this call instead. With coalesce (defaults to
+    API_COALESCE_REQUESTS), identical GETs in flight at the same time share
+    one upstream request. With hedge (defaults to API_HEDGE_REQUESTS), a GET
+    slower than usual is sent a second time and the first response wins.
+    With raw, the JSON body is only decoded when the results' data is read.
+    """
+    if cache_ttl is None:
+        cache_ttl = response_cache.ttl_for(path)
+    if coalesce is None:
+        coalesce = COALESCE_REQUESTS
+    if hedge is None:
+        hedge = hedging.HEDGE_REQUESTS
+    return __call_api__(
+        "GET",
+        path,
+        context="api.fetch:= Unable to fetch data",
+        parse=__parser__(json, raw),
+        max_retry=max_retry,
+        cache_ttl=cache_ttl,
+        coalesce=coalesce,
+        hedge=hedge,
+    )
+
+
+def post(
+    path: str, data: dict, files=None, max_retry=3, idempotency_key=None, raw=False
+):
+    """
+    POST data to path. POSTs are only retried after a failure when an
+    idempotency_key the API deduplicates on is given. data may also be a
+    JSON body already encoded as bytes.
+    """
+    if files:
+        # Send data and files as a multipart body streamed in chunks
+        body = MultipartBody(fields=data, files=files)
+        return upload(
+            "POST",
+            path,
+            body,
+            body.content_type,
+            max_retry=max_retry,
+            idempotency_key=idempotency_key,
         )
 
+    return __call_api__(
+        "POST",
+        path,
+        context="api.post:= Unable to post data",
+        parse=__parser__(raw=raw),
+        max_retry=max_retry,
+        content_type=codec.CONTENT_TYPE,
+        idempotency_key=idempotency_key,
+        data=__json_body__(data),
+    )
 
-def post(path: str, data: dict, files=None, max_retry=3):
-    url = __full_url__(path)
+
+def put(path: str, data: dict, files=None, max_retry=3, raw=False):
+    if files:
+        # Send data and files as a multipart body streamed in chunks
+        body = MultipartBody(fields=data, files=files)
+        return upload("PUT", path, body, body.content_type, max_retry=max_retry)
+
+    return __call_api__(
+        "PUT",
+        path,
+        context="api.put:= Unable to put data",
+        parse=__parser__(raw=raw),
+        max_retry=max_retry,
+        content_type=codec.CONTENT_TYPE,
+        data=__json_body__(data),
+    )
+
+
+def upload(
+    method: str,
+    path: str,
+    body,
+    content_type: str,
+    max_retry=3,
+    idempotency_key=None,
+):
+    """
+    Send body, an iterable of bytes, with chunked transfer encoding so it is
+    forwarded while it is being produced. Only pass max_retry when body can
+    be iterated more than once.
+    """
+    return __call_api__(
+        method,
+        path,
+        context=f"api.upload:= Unable to {method.lower()} data",
+        parse=__json__,
+        max_retry=max_retry,
+        content_type=content_type,
+        idempotency_key=idempotency_key,
+        data=body,
+    )
+
+
+def delete(path, max_retry=3):
+    return __call_api__(
+        "DELETE",
+        path,
+        context="api.delete:= Unable to delete data",
+        max_retry=max_retry,
+    )
+
+
+async def afetch(path, max_retry=3, json=True, hedge=None, raw=False):
+    if hedge is None:
+        hedge = hedging.HEDGE_REQUESTS
+    return await __acall_api__(
+        "GET",
+        path,
+        context="api.afetch:= Unable to fetch data",
+        parse=__parser__(json, raw),
+        max_retry=max_retry,
+        hedge=hedge,
+    )
+
+
+async def apost(
+    path: str, data: dict, files=None, max_retry=3, idempotency_key=None, raw=False
+):
+    return await __acall_api__(
+        "POST",
+        path,
+        context="api.apost:= Unable to post data",
+        parse=__parser__(raw=raw),
+        max_retry=max_retry,
+        idempotency_key=idempotency_key,
+        **__async_body__(data, files),
+    )
+
+
+async def aput(path: str, data: dict, files=None, max_retry=3, raw=False):
+    return await __acall_api__(
+        "PUT",
+        path,
+        context="api.aput:= Unable to put data",
+        parse=__parser__(raw=raw),
+        max_retry=max_retry,
+        **__async_body__(data, files),
+    )
+
+
+async def adelete(path, max_retry=3):
+    return await __acall_api__(
+        "DELETE",
+        path,
+        context="api.adelete:= Unable to delete data",
+        max_retry=max_retry,
+    )
+
+
+def fetch_many(paths, json=True):
+    """
+    Fetch several paths at the same time. Returns their ApiResults in the
+    order of paths.
+    """
+    return gather(*[(partial(fetch, json=json), path) for path in paths])
+
+
+def gather(*calls):
+    """
+    Run several API calls at the same time on a bounded pool of threads.
+    Each call is a tuple of an api function and its positional arguments,
+    e.g. gather((fetch, "/users/"), (post, "/logs/", {"event": "view"})).
+    Returns their ApiResults in the order of calls.
+
+    The access token is looked up once for all the calls, and each call sees
+    the request of the caller through get_request().
+    """
     token = ApiAccessToken().get_access_token(session=get_request_session())
-    if token:
-        headers = __get_auth_header__(token.get("access_token", None))
-        try:
-            response = requests.post(
-                url, json=data, headers=headers, auth=None, files=files
-            )
-            if response.ok:
-                return ApiResults(ok=response.ok, data=response.json())
-            else:
-                # in case http 401 we should refresh access token
-                if max_retry and response.status_code == 401:
-                    ApiAccessToken.get_access_token(session=get_request_session())
-                    return post(path, data=data, files=files, max_retry=max_retry - 1)
-                else:
-                    logger.error(
-                        "api.post:= Unable to post data at {url}. Received http {statuscode}: {reason}. Data={data}".format(
-                            url=url,
-                            statuscode=response.status_code,
-                            reason=response.reason,
-                            data=data,
-                        )
-                    )
-                try:
-                    error = response.json()
-                except:
-                    error = {
-                        "error_code": "GENERAL_FAILURE",
-                        "message": response.text,
-                        "errors": None,
-                    }
+    futures = []
+    for func, *args in calls:
+        context = copy_context()
+        context.run(_shared_token.set, token)
+        futures.append(__get_fanout_executor__().submit(context.run, func, *args))
+    return [future.result() for future in futures]
 
-                return ApiResults(error_code=response.status_code, data=error)
 
-        except ConnectionError:
-            logger.exception("Unable to connect to get to API endpoint {}".format(url))
-            return ApiResults(
-                error_code=NETWORK_ERROR_CODE,
-                data={
-                    "message": "Unable to connect to remote endpoint",
-                    "error_code": "NETWORK_ERROR",
-                },
-            )
-        except Timeout:
-            logger.exception("Connecting to API endpoint {} has timed out".format(url))
-            return ApiResults(
-                error_code=NETWORK_ERROR_CODE,
-                data={
-                    "message": "Unable to connect to remote endpoint",
-                    "error_code": "NETWORK_TIMEOUT_ERROR",
-                },
-            )
-        except Exception as ex:
-            print(f"EXCEPTION: {ex}")
-            logger.critical(f"Unable to connect to API {ex}")
-            return ApiResults(
-                error_code=NETWORK_ERROR_CODE,
-                data={
-                    "message": "Unable to connect to remote endpoint",
-                    "error_code": "GENERAL_NETWORK_ERROR",
-                },
-            )
-    else:
-        logger.critical(
-            "Unable to obtain access token for fetch request to {0}".format(url)
-        )
-        return ApiResults(
-            error_code=4000,
-            data={
-                "message": "Unable to obtain access token",
-                "error_code": "OBTAIN_ACCESS_TOKEN",
-            },
-        )
+def fetch_pages(
+    path,
+    items_key="results",
+    next_key="next",
+    cursor_param="cursor",
+    offset_param=None,
+    page_size=None,
+    read_ahead=True,
+    max_retry=3,
+):
+    """
+    Yield the items of each page of the list endpoint at path, with the path
+    of the page after it, or None on the last page. See pagination.Paginator
+    for how pages link to each other.
+
+    With read_ahead, the next page is fetched on the fanout pool while the
+    caller handles the current one, so that at most two pages are held at a
+    time. Raises pagination.PageError when a page can not be fetched.
+    """
+    paginator = pagination.Paginator(
+        __full_url__(""), items_key, next_key, cursor_param, offset_param, page_size
+    )
+    fetch_page = partial(fetch, max_retry=max_retry)
+    pending = None
+    try:
+        results = fetch_page(path)
+        while True:
+            if not results.ok:
+                raise pagination.PageError(path, results)
+            items = paginator.items(results.data)
+            next_path = paginator.next_path(path, results.data, items)
+            results = None
+            if next_path and read_ahead:
+                pending = __get_fanout_executor__().submit(
+                    copy_context().run, fetch_page, next_path
+                )
+            yield items, next_path
+            if not next_path:
+                return
+            results = pending.result() if pending else fetch_page(next_path)
+            pending = None
+            path = next_path
+    finally:
+        # The caller stopped early, the page read ahead is not needed
+        if pending is not None:
+            pending.cancel()
+
+
+def iter_pages(path, **kwargs):
+    """
+    Yield the items of a paginated list endpoint one at a time, following
+    its pages lazily. Takes the keyword arguments of fetch_pages, e.g.
+    iter_pages("/users/", offset_param="offset", page_size=100).
+    """
+    for items, _ in fetch_pages(path, **kwargs):
+        yield from items
 
 
-def put(path: str, data: dict, files=None, max_retry=3):
+def stream(method: str, path: str, max_retry=3, headers=None, **kwargs):
+    """
+    Send a request to the API without reading the response body. Returns the
+    upstream requests.Response, which the caller must close, or ApiResults
+    when no response could be obtained.
+    """
     url = __full_url__(path)
-    token = ApiAccessToken().get_access_token(session=get_request_session())
-    if token:
-        headers = __get_auth_header__(token.get("access_token", None))
-        try:
-            response = requests.put(
-                url, json=data, headers=headers, files=files, auth=None
+    session = get_request_session()
+    token = ApiAccessToken().get_access_token(session=session)
+    if not token:
+        return __no_token_results__(method, url)
+
+    request_headers = dict(headers or {})
+    request_headers.update(__get_auth_header__(token.access_token))
+    endpoint = __endpoint__(path)
+    try:
+        with tracing.span("upstream", method=method, endpoint=endpoint):
+            response = transport.request(
+                method,
+                url,
+                endpoint=endpoint,
+                retries=max_retry,
+                deadline=__deadline__(),
+                headers=request_headers,
+                auth=None,
+                stream=True,
+                **kwargs,
             )
+    except Exception as ex:
+        return __network_error_results__(url, ex)
 
-            if response.ok:
-                return ApiResults(ok=response.ok, data=response.json())
-            else:
-                # in case http 401 we should refresh access token
-                if max_retry and response.status_code == 401:
-                    ApiAccessToken().get_access_token(session=get_request_session())
-                    return put(path, data=data, files=files, max_retry=max_retry - 1)
-                else:
-                    logger.error(
-                        "api.put:= Unable to put data at {url}. Received http {statuscode}: {reason}. Data={data}".format(
-                            url=url,
-                            statuscode=response.status_code,
-                            reason=response.reason,
-                            data=data,
-                        )
-                    )
+    # The token was rejected: drop it and try once more with a new one
+    if max_retry and response.status_code == 401:
+        response.close()
+        ApiAccessToken().invalidate(token, session=session)
+        return stream(method, path, max_retry=0, headers=headers, **kwargs)
+    return response
 
-                try:
-                    errors = response.json()
-                except:
-                    error = {
-                        "error_code": "GENERAL_FAILURE",
-                        "message": response.text,
-                        "errors": None,
-                    }
 
-                return ApiResults(error_code=response.status_code, data=error)
+def graphiQl(
+    path: str, query: str, variables=None, operation_name=None, cache_ttl=None
+):
+    """
+    Send a GraphQL operation to path. See graphiQl_many for persisted queries
+    and caching.
+    """
+    operation = graphql.Operation(query, variables, operation_name)
+    return graphiQl_many(path, [operation], cache_ttl=cache_ttl)[0]
 
-        except ConnectionError:
-            logger.exception("Unable to connect to get to API endpoint {}".format(url))
-            return ApiResults(
-                error_code=NETWORK_ERROR_CODE,
-                data={
-                    "message": "Unable to connect to remote endpoint",
-                    "error_code": "NETWORK_ERROR",
-                },
+
+def graphiQl_many(path: str, operations, cache_ttl=None):
+    """
+    Send several GraphQL operations to path in one POST, as a batch. Each
+    operation is a query string, a (query, variables) tuple or a
+    graphql.Operation. Returns their ApiResults in the order of operations.
+
+    With API_GRAPHQL_PERSISTED_QUERIES, operations are sent by the hash of
+    their query, and their text only when the server asks for it. Results of
+    read-only queries are reused for cache_ttl seconds (defaults to
+    API_GRAPHQL_CACHE_TTL), per user, without calling the server.
+    """
+    operations = [graphql.Operation.of(operation) for operation in operations]
+    if cache_ttl is None:
+        cache_ttl = graphql.GRAPHQL_CACHE_TTL
+    token = None
+    if cache_ttl:
+        token = ApiAccessToken().get_access_token(session=get_request_session())
+
+    results = [None] * len(operations)
+    keys = [None] * len(operations)
+    for n, operation in enumerate(operations):
+        if token and operation.read_only:
+            keys[n] = response_cache.cache_key(
+                graphql.cache_path(path, operation), token
             )
-        except Timeout:
-            logger.exception("Connecting to API endpoint {} has timed out".format(url))
-            return ApiResults(
-                error_code=NETWORK_ERROR_CODE,
-                data={
-                    "message": "Unable to connect to remote endpoint",
-                    "error_code": "NETWORK_TIMEOUT_ERROR",
-                },
+            cached = responses.get(keys[n])
+            if cached is not None and cached.is_fresh():
+                metrics.increment("remoteauth_graphql_cache_total", result="hit")
+                results[n] = ApiResults(ok=True, raw=cached.content)
+            else:
+                metrics.increment("remoteauth_graphql_cache_total", result="miss")
+
+    unsent = [n for n, result in enumerate(results) if result is None]
+    if unsent:
+        sent = __send_graphql__(path, [operations[n] for n in unsent])
+        for n, result in zip(unsent, sent):
+            results[n] = result
+            if keys[n] and result.ok and graphql.cacheable(operations[n], result.data):
+                entry = response_cache.CachedResponse(
+                    codec.dumps(result.data),
+                    "utf-8",
+                    codec.CONTENT_TYPE,
+                    time.time() + cache_ttl,
+                    etag=None,
+                    last_modified=None,
+                )
+                responses.set(keys[n], entry)
+    return results
+
+
+def __send_graphql__(path, operations):
+    """
+    POST operations to path, alone or as a batch, and send the text of the
+    persisted ones the server does not know yet
+    """
+    persisted = graphql.GRAPHQL_PERSISTED_QUERIES
+    payloads = [
+        operation.payload(persisted, with_query=False) for operation in operations
+    ]
+    results = __post_graphql__(path, payloads)
+    if persisted:
+        missing = [
+            n
+            for n, result in enumerate(results)
+            if result.ok and graphql.persisted_query_missing(result.data)
+        ]
+        if missing:
+            metrics.increment(
+                "remoteauth_graphql_persisted_misses_total", value=len(missing)
             )
-        except Exception as ex:
-            logger.critical(f"Unable to connect to API {ex}")
-            return ApiResults(
-                error_code=NETWORK_ERROR_CODE,
-                data={
-                    "message": "Unable to connect to remote endpoint",
-                    "error_code": "GENERAL_NETWORK_ERROR",
-                },
+            resent = __post_graphql__(
+                path, [operations[n].payload(persisted) for n in missing]
             )
-    else:
-        logger.critical(
-            "Unable to obtain access token for fetch request to {0}".format(url)
+            for n, result in zip(missing, resent):
+                results[n] = result
+    return results
+
+
+def __post_graphql__(path, payloads):
+    """
+    POST one payload as it is, or several as a batch. The results of a batch
+    are split back into one ApiResults per payload.
+    """
+    if len(payloads) == 1:
+        return [post(path, payloads[0])]
+    results = post(path, payloads)
+    if not results.ok:
+        return [results] * len(payloads)
+    if not isinstance(results.data, list) or len(results.data) != len(payloads):
+        logger.error(
+            "api.graphiQl_many:= Batch of %s operations at %s was answered with %r",
+            len(payloads),
+            path,
+            results.data,
         )
-        return ApiResults(
-            error_code=4000,
-            data={
-                "message": "Unable to obtain access token",
-                "error_code": "OBTAIN_ACCESS_TOKEN",
-            },
+        return [ApiResults(error_code=NETWORK_ERROR_CODE)] * len(payloads)
+    return [ApiResults(ok=True, data=data) for data in results.data]
+
+
+def __full_url__(relative_url):
+    return f"{BASE_URL}{RELATIVE_URL_PREFIX}{relative_url}"
+
+
+def __endpoint__(relative_url):
+    """
+    Name the endpoint a path belongs to by its first segment, so that e.g.
+    /users/1/ and /users/2/ share one circuit breaker. Endpoints first seen
+    after MAX_ENDPOINTS others are named OTHER_ENDPOINT.
+    """
+    first_segment = relative_url.lstrip("/").split("?", 1)[0].split("/", 1)[0]
+    endpoint = f"/{first_segment}/"
+    if endpoint in _endpoints:
+        return endpoint
+    with _endpoints_lock:
+        if len(_endpoints) < MAX_ENDPOINTS:
+            _endpoints.add(endpoint)
+            return endpoint
+    return OTHER_ENDPOINT
+
+
+def __deadline__():
+    """
+    The moment the current API call must be done by: API_CALL_DEADLINE from
+    now, or the deadline of the request being handled if that comes first
+    """
+    data = get_request_context() or {}
+    return retry.earliest(
+        retry.deadline_after(retry.CALL_DEADLINE), data.get("deadline", None)
+    )
+
+
+async def __aload_session__(session):
+    """
+    Load a Django session from its backend, so that reading and writing it
+    afterwards stays in memory
+    """
+    if session is not None and not isinstance(session, dict):
+        await sync_to_async(session.keys)()
+
+
+def __session_token__(session, key):
+    """
+    Read the token kept in the session under key. Tokens kept by earlier
+    versions are converted once and kept in the current form.
+    """
+    value = session.get(key, None)
+    token = Token.load(value)
+    if token is not None and "timestamp" in value:
+        session[key] = token.to_session()
+    return token
+
+
+def __get_auth_header__(access_token=None, token_type="Bearer"):
+    return {
+        "Authorization": "{token_type} {token}".format(
+            token_type=token_type, token=access_token
         )
+    }
 
 
-def delete(path, max_retry=3):
+def __get_fanout_executor__():
+    global _fanout_executor
+    if _fanout_executor is None:
+        with _fanout_executor_lock:
+            if _fanout_executor is None:
+                _fanout_executor = ThreadPoolExecutor(
+                    max_workers=FANOUT_WORKERS, thread_name_prefix="remoteauth-fanout"
+                )
+    return _fanout_executor
+
+
+def __call_api__(method, path, context, *args, **kwargs):
+    """
+    Call the API, recording how long the call took, token lookup and
+    retries included, and how it ended
+    """
+    endpoint = __endpoint__(path)
+    with metrics.timer("remoteauth_api_call_seconds", method=method, endpoint=endpoint):
+        results = __send_api_call__(method, path, context, *args, **kwargs)
+    __count_api_call__(method, endpoint, results)
+    return results
+
+
+async def __acall_api__(method, path, context, *args, **kwargs):
+    endpoint = __endpoint__(path)
+    with metrics.timer("remoteauth_api_call_seconds", method=method, endpoint=endpoint):
+        results = await __asend_api_call__(method, path, context, *args, **kwargs)
+    __count_api_call__(method, endpoint, results)
+    return results
+
+
+def __count_api_call__(method, endpoint, results):
+    metrics.increment(
+        "remoteauth_api_calls_total",
+        method=method,
+        endpoint=endpoint,
+        result="ok" if results.ok else results.error_code,
+    )
+
+
+def __count_token_grant__(grant_type, result):
+    metrics.increment("remoteauth_token_grants_total", grant=grant_type, result=result)
+
+
+def __send_api_call__(
+    method,
+    path,
+    context,
+    parse=None,
+    max_retry=3,
+    cache_ttl=None,
+    coalesce=False,
+    hedge=False,
+    content_type=None,
+    idempotency_key=None,
+    **kwargs,
+):
     url = __full_url__(path)
-    token = ApiAccessToken().get_access_token(session=get_request_session())
-    if token:
-        headers = __get_auth_header__(token.get("access_token", None))
-        try:
-            response = requests.delete(url, headers=headers, auth=None)
-            if response.ok:
-                return ApiResults(ok=response.ok)
+    session = get_request_session()
+    if parse is not None and parse is not __raw_json__:
+        parse = tracing.traced("decode", parse)
+    # Calls started by gather() share the token looked up by their caller
+    token = _shared_token.get() or ApiAccessToken().get_access_token(session=session)
+    if not token:
+        return __no_token_results__(method, url)
+
+    headers = __get_auth_header__(token.access_token)
+    if content_type:
+        headers["Content-Type"] = content_type
+    if idempotency_key:
+        headers[retry.IDEMPOTENCY_KEY_HEADER] = idempotency_key
+    cached = None
+    if cache_ttl is not None:
+        key = response_cache.cache_key(path, token)
+        cached = responses.get(key)
+        if cached is None:
+            metrics.increment("remoteauth_response_cache_total", result="miss")
+        elif cached.is_fresh():
+            metrics.increment("remoteauth_response_cache_total", result="hit")
+            return __ok_results__(cached.to_response(), parse)
+        else:
+            metrics.increment("remoteauth_response_cache_total", result="stale")
+            headers.update(cached.revalidation_headers())
+
+    endpoint = __endpoint__(path)
+    send = partial(
+        transport.request,
+        method,
+        url,
+        endpoint=endpoint,
+        retries=max_retry,
+        deadline=__deadline__(),
+        headers=headers,
+        auth=None,
+        **kwargs,
+    )
+    if hedge and method == "GET":
+        send = partial(hedging.call, endpoint, send)
+    try:
+        with tracing.span("upstream", method=method, endpoint=endpoint):
+            if coalesce:
+                # Callers share the response but each parses its own copy
+                response = inflight_gets.do(
+                    (method, url, tuple(sorted(headers.items()))), send
+                )
             else:
-                # in case http 401 we should refresh access token
-                if max_retry and response.status_code == 401:
-                    ApiAccessToken().get_access_token(session=get_request_session())
-                    return delete(path, max_retry=max_retry - 1)
-                else:
-                    logger.error(
-                        "api.delete:= Unable to delete data at {url}. Received http {statuscode}: {reason}".format(
-                            url=url,
-                            statuscode=response.status_code,
-                            reason=response.reason,
-                        )
-                    )
-                    try:
-                        errors = response.json()
-                    except:
-                        error = {
-                            "error_code": "GENERAL_FAILURE",
-                            "message": response.text,
-                            "errors": None,
-                        }
+                response = send()
+        if response.status_code == 304 and cached is not None:
+            # Not modified: serve the body we already have
+            metrics.increment("remoteauth_response_cache_total", result="revalidated")
+            ttl = response_cache.freshness(response, cache_ttl)
+            if ttl is not None:
+                cached.refresh(ttl)
+                responses.set(key, cached)
+            return __ok_results__(cached.to_response(), parse)
 
-                return ApiResults(error_code=response.status_code, data=error)
+        if response.ok:
+            results = __ok_results__(response, parse)
+            if cache_ttl is not None:
+                ttl = response_cache.freshness(response, cache_ttl)
+                if ttl is not None:
+                    responses.set(key, response_cache.build_entry(response, ttl))
+            return results
 
-        except ConnectionError:
-            logger.exception("Unable to connect to get to API endpoint {}".format(url))
-            return ApiResults(
-                error_code=NETWORK_ERROR_CODE,
-                data={
-                    "message": "Unable to connect to remote endpoint",
-                    "error_code": "NETWORK_ERROR",
-                },
+        # The token was rejected: drop it and try once more with a new one
+        if max_retry and response.status_code == 401:
+            ApiAccessToken().invalidate(token, session=session)
+            _shared_token.set(None)
+            return __send_api_call__(
+                method,
+                path,
+                context,
+                parse,
+                0,
+                cache_ttl=cache_ttl,
+                coalesce=coalesce,
+                hedge=hedge,
+                content_type=content_type,
+                idempotency_key=idempotency_key,
+                **kwargs,
             )
-        except Timeout:
-            logger.exception("Connecting to API endpoint {} has timed out".format(url))
-            return ApiResults(
-                error_code=NETWORK_ERROR_CODE,
-                data={
-                    "message": "Unable to connect to remote endpoint",
-                    "error_code": "NETWORK_TIMEOUT_ERROR",
-                },
-            )
-        except Exception as ex:
-            logger.critical(f"Unable to connect to API{ex}")
-            return ApiResults(
-                error_code=NETWORK_ERROR_CODE,
-                data={
-                    "message": "Unable to connect to remote endpoint",
-                    "error_code": "GENERAL_NETWORK_ERROR",
-                },
+
+        return __failure_results__(context, url, response, response.reason)
+    except Exception as ex:
+        return __network_error_results__(url, ex)
+
+
+async def __asend_api_call__(
+    method,
+    path,
+    context,
+    parse=None,
+    max_retry=3,
+    hedge=False,
+    content_type=None,
+    idempotency_key=None,
+    **kwargs,
+):
+    url = __full_url__(path)
+    session = get_request_session()
+    if parse is not None and parse is not __raw_json__:
+        parse = tracing.traced("decode", parse)
+    token = await ApiAccessToken().aget_access_token(session=session)
+    if not token:
+        return __no_token_results__(method, url)
+
+    headers = __get_auth_header__(token.access_token)
+    if content_type:
+        headers["Content-Type"] = content_type
+    if idempotency_key:
+        headers[retry.IDEMPOTENCY_KEY_HEADER] = idempotency_key
+    endpoint = __endpoint__(path)
+    send = partial(
+        transport.arequest,
+        method,
+        url,
+        endpoint=endpoint,
+        retries=max_retry,
+        deadline=__deadline__(),
+        headers=headers,
+        **kwargs,
+    )
+    if hedge and method == "GET":
+        send = partial(hedging.acall, endpoint, send)
+    try:
+        with tracing.span("upstream", method=method, endpoint=endpoint):
+            response = await send()
+        if response.is_success:
+            return __ok_results__(response, parse)
+
+        # The token was rejected: drop it and try once more with a new one
+        if max_retry and response.status_code == 401:
+            await ApiAccessToken().ainvalidate(token, session=session)
+            return await __asend_api_call__(
+                method,
+                path,
+                context,
+                parse,
+                max_retry=0,
+                hedge=hedge,
+                content_type=content_type,
+                idempotency_key=idempotency_key,
+                **kwargs,
             )
-    else:
-        logger.critical(
-            "Unable to obtain access token for fetch request to {0}".format(url)
-        )
+
+        return __failure_results__(context, url, response, response.reason_phrase)
+    except Exception as ex:
+        return __network_error_results__(url, ex)
+
+
+def __json__(response):
+    return codec.loads(response.content)
+
+
+def __text__(response):
+    return response.text
+
+
+def __raw_json__(response):
+    """
+    Marks calls whose JSON body is kept as bytes, see ApiResults
+    """
+    return response.content
+
+
+def __parser__(json=True, raw=False):
+    if not json:
+        return __text__
+    return __raw_json__ if raw else __json__
+
+
+def __ok_results__(response, parse):
+    if parse is None:
+        return ApiResults(ok=True)
+    if parse is __raw_json__:
         return ApiResults(
-            error_code=4000,
-            data={
-                "message": "Unable to obtain access token",
-                "error_code": "OBTAIN_ACCESS_TOKEN",
-            },
+            ok=True,
+            raw=response.content,
+            content_type=response.headers.get("Content-Type", None),
         )
+    return ApiResults(ok=True, data=parse(response))
 
 
-def graphiQl(path: str, query: str):
-    return post(path=path, data=dict(query=query))
+def __json_body__(data):
+    # Bodies that are already encoded, e.g. by a proxy, are sent as they are
+    if isinstance(data, (bytes, bytearray)):
+        return data
+    return codec.dumps(data)
 
 
-def __full_url__(relative_url):
-    return f"{BASE_URL}{RELATIVE_URL_PREFIX}{relative_url}"
+def __async_body__(data, files):
+    if files:
+        return dict(data=data, files=files)
+    return dict(content=__json_body__(data), content_type=codec.CONTENT_TYPE)
 
 
-def __get_auth_header__(access_token=None, token_type="Bearer"):
-    return {
-        "Authorization": "{token_type} {token}".format(
-            token_type=token_type, token=access_token
+def __no_token_results__(method, url):
+    logger.critical(
+        "Unable to obtain access token for {method} request to {url}".format(
+            method=method, url=url
         )
-    }
+    )
+    return ApiResults(
+        error_code=4000,
+        data={
+            "message": "Unable to obtain access token",
+            "error_code": "OBTAIN_ACCESS_TOKEN",
+        },
+    )
+
+
+def __failure_results__(context, url, response, reason):
+    logger.error(
+        "{context} at {url}. Received http {statuscode}: {reason}".format(
+            context=context,
+            url=url,
+            statuscode=response.status_code,
+            reason=reason,
+        )
+    )
+    try:
+        error = codec.loads(response.content)
+    except ValueError:
+        error = {
+            "error_code": "GENERAL_FAILURE",
+            "message": response.text,
+            "errors": None,
+        }
+    return ApiResults(error_code=response.status_code, data=error)
+
+
+def __network_error_results__(url, ex):
+    if isinstance(ex, resilience.CircuitOpenError):
+        logger.warning("Not calling API endpoint {}: {}".format(url, ex))
+        error_code = "CIRCUIT_OPEN"
+    elif isinstance(ex, resilience.BulkheadFullError):
+        logger.warning("Not calling API endpoint {}: {}".format(url, ex))
+        error_code = "BULKHEAD_FULL"
+    elif isinstance(ex, ConnectionError):
+        logger.exception("Unable to connect to get to API endpoint {}".format(url))
+        error_code = "NETWORK_ERROR"
+    elif isinstance(ex, Timeout):
+        logger.exception("Connecting to API endpoint {} has timed out".format(url))
+        error_code = "NETWORK_TIMEOUT_ERROR"
+    else:
+        logger.critical(f"Unable to connect to API {ex}")
+        error_code = "GENERAL_NETWORK_ERROR"
+
+    return ApiResults(
+        error_code=NETWORK_ERROR_CODE,
+        data={
+            "message": "Unable to connect to remote endpoint",
+            "error_code": error_code,
+        },
+    )
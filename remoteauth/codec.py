@@ -0,0 +1,90 @@
+import json
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.datastructures import MultiValueDict
+from django.utils.module_loading import import_string
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Can remain static until restart
+# Class JSON bodies are encoded and decoded with
+JSON_CODEC = getattr(settings, "API_JSON_CODEC", "remoteauth.codec.StdlibCodec")
+
+CONTENT_TYPE = "application/json"
+
+
+class StdlibCodec:
+    """
+    Encodes and decodes JSON with the standard library. Values JSON has no
+    type for, like dates and decimals, are encoded as JsonResponse does.
+    """
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def dumps(self, value):
+        return json.dumps(value, cls=DjangoJSONEncoder).encode()
+
+
+class OrjsonCodec:
+    """
+    Encodes and decodes JSON with orjson, several times faster than the
+    standard library on large bodies
+    """
+
+    def __init__(self):
+        if orjson is None:
+            raise ImportError(
+                "OrjsonCodec needs orjson. Install it with: pip install "
+                "remoteauth[orjson]"
+            )
+        self.options = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+    def dumps(self, value):
+        if isinstance(value, MultiValueDict):
+            # Form data keeps the last value of each field, as with json.dumps
+            value = value.dict()
+        try:
+            # Dates and types orjson does not know, like lazy translations,
+            # are encoded as DjangoJSONEncoder does
+            return orjson.dumps(value, default=_encoder.default, option=self.options)
+        except TypeError:
+            # Values orjson rejects, like integers past 64 bits
+            return _stdlib.dumps(value)
+
+
+_encoder = DjangoJSONEncoder()
+_stdlib = StdlibCodec()
+
+
+def get_codec():
+    """
+    Build the codec configured by the API_JSON_CODEC setting
+    """
+    return import_string(JSON_CODEC)()
+
+
+codec = get_codec()
+
+
+def loads(data):
+    """
+    Decode a JSON body, given as bytes or str. Raises ValueError when it is
+    not valid JSON.
+    """
+    return codec.loads(data)
+
+
+def dumps(value):
+    """
+    Encode value as a JSON body, in bytes
+    """
+    return codec.dumps(value)
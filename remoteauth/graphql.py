@@ -0,0 +1,131 @@
+import hashlib
+import json
+import re
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+
+# Can remain static until restart
+# Send the sha256 hash of queries instead of their text, as automatic
+# persisted queries do. The text is only sent when the server does not know
+# the hash yet.
+GRAPHQL_PERSISTED_QUERIES = getattr(settings, "API_GRAPHQL_PERSISTED_QUERIES", False)
+# Seconds the results of read-only queries are reused per user, 0 to never
+GRAPHQL_CACHE_TTL = getattr(settings, "API_GRAPHQL_CACHE_TTL", 0)
+
+PERSISTED_QUERY_ERRORS = {"PersistedQueryNotFound", "PersistedQueryNotSupported"}
+
+_comments = re.compile(r"#[^\n]*")
+_operation_types = re.compile(r"(?:^|})\s*(query|mutation|subscription)\b")
+
+
+class Operation:
+    """
+    A GraphQL query or mutation with its variables
+    """
+
+    def __init__(self, query, variables=None, operation_name=None):
+        self.query = query
+        self.variables = variables
+        self.operation_name = operation_name
+
+    @classmethod
+    def of(cls, value):
+        """
+        Build an operation from a query string, a (query, variables) tuple or
+        an Operation
+        """
+        if isinstance(value, cls):
+            return value
+        if isinstance(value, str):
+            return cls(value)
+        return cls(*value)
+
+    @property
+    def hash(self):
+        return query_hash(self.query)
+
+    @property
+    def read_only(self):
+        return is_read_only(self.query)
+
+    def payload(self, persisted=False, with_query=True):
+        """
+        Return the JSON body of the operation. Persisted operations carry the
+        hash of their query, and its text only when with_query is set.
+        """
+        body = {}
+        if with_query or not persisted:
+            body["query"] = self.query
+        if self.variables is not None:
+            body["variables"] = self.variables
+        if self.operation_name is not None:
+            body["operationName"] = self.operation_name
+        if persisted:
+            body["extensions"] = {
+                "persistedQuery": {"version": 1, "sha256Hash": self.hash}
+            }
+        return body
+
+
+@lru_cache(maxsize=1024)
+def query_hash(query):
+    return hashlib.sha256(query.encode()).hexdigest()
+
+
+@lru_cache(maxsize=1024)
+def is_read_only(query):
+    """
+    Tell whether query only reads data: a query operation, or the shorthand
+    selection set. Mutations and subscriptions are not read-only.
+    """
+    text = _comments.sub("", query).lstrip()
+    if text.startswith("{"):
+        return True
+    kinds = _operation_types.findall(text)
+    return bool(kinds) and all(kind == "query" for kind in kinds)
+
+
+def persisted_query_missing(data):
+    """
+    Tell whether the server answered a persisted operation by asking for
+    its text
+    """
+    if not isinstance(data, dict):
+        return False
+    for error in data.get("errors") or []:
+        if not isinstance(error, dict):
+            continue
+        code = (error.get("extensions") or {}).get("code")
+        if error.get("message") in PERSISTED_QUERY_ERRORS or code in (
+            "PERSISTED_QUERY_NOT_FOUND",
+            "PERSISTED_QUERY_NOT_SUPPORTED",
+        ):
+            return True
+    return False
+
+
+def cacheable(operation, data):
+    """
+    Tell whether the result data of operation can be reused
+    """
+    return (
+        operation.read_only
+        and isinstance(data, dict)
+        and not data.get("errors")
+        and "data" in data
+    )
+
+
+def cache_path(path, operation):
+    """
+    Identify the result of operation at path, for the response cache.
+    Variables are compared by value, whatever the order of their keys.
+    """
+    variables = json.dumps(operation.variables, sort_keys=True, cls=DjangoJSONEncoder)
+    digest = hashlib.sha256(
+        f"{operation.operation_name}|{variables}".encode()
+    ).hexdigest()
+    return f"{path}#graphql:{operation.hash}:{digest}"
@@ -0,0 +1,200 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextvars import copy_context
+
+from django.conf import settings
+
+
+# Can remain static until restart
+HEDGE_REQUESTS = getattr(settings, "API_HEDGE_REQUESTS", False)
+# Latency percentile of an endpoint after which a GET is sent a second time
+HEDGE_PERCENTILE = getattr(settings, "API_HEDGE_PERCENTILE", 95)
+# Latencies an endpoint needs before its GETs are hedged
+HEDGE_MIN_SAMPLES = getattr(settings, "API_HEDGE_MIN_SAMPLES", 20)
+HEDGE_SAMPLES = getattr(settings, "API_HEDGE_SAMPLES", 1000)
+# Most hedges per call sent to an endpoint, e.g. 0.05 for one in twenty
+HEDGE_MAX_RATE = getattr(settings, "API_HEDGE_MAX_RATE", 0.05)
+# Hedged calls in flight at the same time; beyond this calls are not hedged
+HEDGE_MAX_CONCURRENT = getattr(settings, "API_HEDGE_MAX_CONCURRENT", 8)
+
+_hedgers = {}
+_registry_lock = threading.Lock()
+_executor = None
+_executor_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(HEDGE_MAX_CONCURRENT)
+
+
+class Hedger:
+    """
+    Tracks the latencies of one endpoint to decide how long a GET may take
+    before a second one is sent, and how many second GETs may be sent
+    """
+
+    # Hedges that may be saved up while they are not needed
+    BURST = 10
+
+    def __init__(
+        self, name, percentile=None, min_samples=None, samples=None, max_rate=None
+    ):
+        self.name = name
+        self.percentile = percentile or HEDGE_PERCENTILE
+        self.min_samples = min_samples or HEDGE_MIN_SAMPLES
+        self.max_rate = HEDGE_MAX_RATE if max_rate is None else max_rate
+        self.hedged = 0
+        self._latencies = deque(maxlen=samples or HEDGE_SAMPLES)
+        self._delay = None
+        self._stale = True
+        self._budget = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+            self._stale = True
+
+    def delay(self):
+        """
+        Return the seconds to wait before hedging, or None while too few
+        latencies are known
+        """
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            if self._stale:
+                latencies = sorted(self._latencies)
+                index = int(len(latencies) * self.percentile / 100)
+                self._delay = latencies[min(index, len(latencies) - 1)]
+                self._stale = False
+            return self._delay
+
+    def earn(self):
+        """
+        Add the share of a hedge every call is allowed
+        """
+        with self._lock:
+            self._budget = min(self._budget + self.max_rate, self.BURST)
+
+    def try_spend(self):
+        with self._lock:
+            if self._budget < 1:
+                return False
+            self._budget -= 1
+            self.hedged += 1
+            return True
+
+
+def get_hedger(name):
+    with _registry_lock:
+        hedger = _hedgers.get(name)
+        if hedger is None:
+            hedger = _hedgers[name] = Hedger(name)
+        return hedger
+
+
+def reset():
+    """
+    Forget the latencies and hedge budgets of all endpoints
+    """
+    with _registry_lock:
+        _hedgers.clear()
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                # Every hedged call runs at most two requests at a time
+                _executor = ThreadPoolExecutor(
+                    max_workers=2 * HEDGE_MAX_CONCURRENT,
+                    thread_name_prefix="remoteauth-hedge",
+                )
+    return _executor
+
+
+def _timed(hedger, send):
+    started = time.monotonic()
+    response = send()
+    hedger.record(time.monotonic() - started)
+    return response
+
+
+def _discard(future):
+    # A request we stopped waiting for cannot be interrupted, but its
+    # connection goes back to the pool as soon as it is done
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+def call(endpoint, send):
+    """
+    Run send() and, when it takes longer than the usual latency of endpoint,
+    run it a second time. The first response to arrive is returned and the
+    other one is dropped. Only pass idempotent requests.
+    """
+    hedger = get_hedger(endpoint)
+    hedger.earn()
+    delay = hedger.delay()
+    if delay is None or not _slots.acquire(blocking=False):
+        return _timed(hedger, send)
+
+    try:
+        executor = _get_executor()
+        pending = {executor.submit(copy_context().run, _timed, hedger, send)}
+        done, _ = wait(pending, timeout=delay)
+        if not done and hedger.try_spend():
+            pending.add(executor.submit(copy_context().run, _timed, hedger, send))
+
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for loser in (done | pending) - {future}:
+                        loser.add_done_callback(_discard)
+                    return future.result()
+                error = future.exception()
+        raise error
+    finally:
+        _slots.release()
+
+
+async def acall(endpoint, send):
+    """
+    Async version of call. The request that loses is cancelled.
+    """
+    hedger = get_hedger(endpoint)
+    hedger.earn()
+    delay = hedger.delay()
+
+    async def timed():
+        started = time.monotonic()
+        response = await send()
+        hedger.record(time.monotonic() - started)
+        return response
+
+    if delay is None:
+        return await timed()
+
+    pending = {asyncio.ensure_future(timed())}
+    try:
+        done, _ = await asyncio.wait(pending, timeout=delay)
+        if not done and hedger.try_spend():
+            pending.add(asyncio.ensure_future(timed()))
+
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
@@ -0,0 +1,184 @@
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from remoteauth import metrics, transport
+
+try:
+    import jwt
+except ImportError:
+    jwt = None
+
+
+logger = logging.getLogger(__name__)
+
+# Can remain static until restart
+# Read the user's profile from the claims of JWT access tokens, verified
+# locally, instead of calling USER_PROFILE_ENDPOINT
+JWT_VALIDATION = getattr(settings, "API_JWT_VALIDATION", False)
+JWKS_URL = getattr(
+    settings, "API_JWKS_URL", f"{settings.API_ENDPOINT}/.well-known/jwks.json"
+)
+JWT_ALGORITHMS = getattr(settings, "API_JWT_ALGORITHMS", ["RS256"])
+# Expected aud and iss claims, not checked when None
+JWT_AUDIENCE = getattr(settings, "API_JWT_AUDIENCE", None)
+JWT_ISSUER = getattr(settings, "API_JWT_ISSUER", None)
+# Seconds of clock skew allowed when checking exp and nbf
+JWT_LEEWAY = getattr(settings, "API_JWT_LEEWAY", 10)
+# Maps profile fields to the claims they are read from
+JWT_CLAIMS = getattr(
+    settings,
+    "API_JWT_CLAIMS",
+    {
+        "username": "preferred_username",
+        "first_name": "given_name",
+        "last_name": "family_name",
+        "email": "email",
+        "roles": "roles",
+    },
+)
+JWKS_CACHE_TTL = getattr(settings, "API_JWKS_CACHE_TTL", 3600)
+# Least seconds between two fetches triggered by unknown key ids, so that
+# tokens with made up key ids can not make us hammer the JWKS endpoint
+JWKS_MIN_REFRESH_INTERVAL = getattr(settings, "API_JWKS_MIN_REFRESH_INTERVAL", 60)
+JWKS_ENDPOINT = "jwks"
+
+
+class KeySet:
+    """
+    The signing keys of a JWKS document, fetched once and kept for ttl
+    seconds. A token signed with a key id that is not known yet makes the
+    document be fetched again, as happens when the upstream rotates keys.
+    """
+
+    def __init__(self, url=None, ttl=None, min_refresh_interval=None):
+        self.url = url or JWKS_URL
+        self.ttl = JWKS_CACHE_TTL if ttl is None else ttl
+        self.min_refresh_interval = (
+            JWKS_MIN_REFRESH_INTERVAL
+            if min_refresh_interval is None
+            else min_refresh_interval
+        )
+        self._keys = {}
+        self._fetched_at = None
+        self._lock = threading.Lock()
+
+    def key(self, kid):
+        """
+        Return the key with id kid, or the only key of the set when kid is
+        None. Returns None when there is no such key.
+        """
+        keys, fetched_at = self._keys, self._fetched_at
+        if fetched_at is None or time.monotonic() - fetched_at >= self.ttl:
+            keys = self.refresh(fetched_at)
+        elif self._find(keys, kid) is None:
+            if time.monotonic() - fetched_at >= self.min_refresh_interval:
+                keys = self.refresh(fetched_at)
+        return self._find(keys, kid)
+
+    @staticmethod
+    def _find(keys, kid):
+        if kid is None and len(keys) == 1:
+            return next(iter(keys.values()))
+        return keys.get(kid)
+
+    def refresh(self, seen_fetched_at=None):
+        """
+        Fetch the document again. Callers pass the fetch time of the keys
+        they found lacking, so that of several threads doing so at once only
+        the first one fetches.
+        """
+        with self._lock:
+            if self._fetched_at != seen_fetched_at:
+                return self._keys
+            response = transport.request("GET", self.url, endpoint=JWKS_ENDPOINT)
+            response.raise_for_status()
+            keys = {}
+            for data in response.json().get("keys", []):
+                try:
+                    key = jwt.PyJWK(data)
+                except (jwt.PyJWKError, jwt.InvalidKeyError):
+                    # Keys of a type or algorithm we can not use
+                    continue
+                keys[key.key_id] = key
+            metrics.increment("remoteauth_jwks_refreshes_total")
+            self._keys = keys
+            self._fetched_at = time.monotonic()
+            return keys
+
+    def clear(self):
+        with self._lock:
+            self._keys = {}
+            self._fetched_at = None
+
+
+def _check_installed():
+    if jwt is None:
+        raise ImportError(
+            "Validating JWT access tokens needs PyJWT. "
+            "Install it with: pip install remoteauth[jwt]"
+        )
+
+
+_key_set = None
+_key_set_lock = threading.Lock()
+
+
+def get_key_set():
+    global _key_set
+    if _key_set is None:
+        with _key_set_lock:
+            if _key_set is None:
+                _check_installed()
+                _key_set = KeySet()
+    return _key_set
+
+
+def verify(access_token, key_set=None):
+    """
+    Return the claims of access_token once its signature, expiry, audience
+    and issuer are verified, or None when it is not a valid token
+    """
+    _check_installed()
+    key_set = key_set or get_key_set()
+    try:
+        header = jwt.get_unverified_header(access_token)
+        key = key_set.key(header.get("kid"))
+        if key is None:
+            metrics.increment("remoteauth_jwt_validations_total", result="unknown_key")
+            return None
+        claims = jwt.decode(
+            access_token,
+            key.key,
+            algorithms=JWT_ALGORITHMS,
+            audience=JWT_AUDIENCE,
+            issuer=JWT_ISSUER,
+            leeway=JWT_LEEWAY,
+            options={"require": ["exp"], "verify_aud": JWT_AUDIENCE is not None},
+        )
+    except jwt.PyJWTError as ex:
+        logger.warning("Rejected JWT access token: %s", ex)
+        metrics.increment("remoteauth_jwt_validations_total", result="invalid")
+        return None
+    metrics.increment("remoteauth_jwt_validations_total", result="ok")
+    return claims
+
+
+def profile_from_claims(claims):
+    profile = {
+        field: claims[claim] for field, claim in JWT_CLAIMS.items() if claim in claims
+    }
+    profile.setdefault("roles", [])
+    return profile
+
+
+def profile_of(token, key_set=None):
+    """
+    Return the profile carried by the claims of token, or None when the
+    token does not verify
+    """
+    claims = verify(token.get("access_token"), key_set)
+    if claims is not None:
+        return profile_from_claims(claims)
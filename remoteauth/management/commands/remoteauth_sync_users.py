@@ -0,0 +1,84 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from remoteauth import api, pagination, profiles
+
+
+def pages(path):
+    """
+    Yield the users of each page of the listing starting at path, with the
+    path of the page after it. The next page is read ahead while one is
+    synced, and the listing is never held in memory as a whole.
+    """
+    try:
+        yield from api.fetch_pages(path)
+    except pagination.PageError as ex:
+        raise CommandError(f"{ex}, resume with --cursor {ex.path}")
+    except ValueError as ex:
+        raise CommandError(str(ex))
+
+
+class Command(BaseCommand):
+    help = (
+        "Create and update users from the API's user listing in bulk, so that "
+        "first logins do not have to"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--endpoint",
+            default=profiles.USER_LIST_ENDPOINT,
+            help="path of the first page of the user listing",
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=profiles.USER_SYNC_BATCH_SIZE
+        )
+        parser.add_argument("--cursor", help="path of the page to resume from")
+        parser.add_argument(
+            "--cursor-file",
+            help="keep the path of the next page here so that an interrupted "
+            "sync resumes where it stopped",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="report the users that would be written without writing them",
+        )
+
+    def handle(self, *args, **options):
+        cursor_file = options["cursor_file"]
+        path = options["cursor"] or self.read_cursor(cursor_file) or options["endpoint"]
+        batch_size = options["batch_size"]
+        dry_run = options["dry_run"]
+
+        created = updated = 0
+        for users, path in pages(path):
+            for start in range(0, len(users), batch_size):
+                batch_created, batch_updated = profiles.sync_users(
+                    users[start : start + batch_size], dry_run=dry_run
+                )
+                created += batch_created
+                updated += batch_updated
+            if cursor_file and not dry_run:
+                self.write_cursor(cursor_file, path)
+            if path and options["verbosity"] > 1:
+                self.stdout.write(f"Next page: {path}")
+
+        if dry_run:
+            self.stdout.write(f"Would create {created} and update {updated} users")
+        else:
+            self.stdout.write(f"Created {created} and updated {updated} users")
+
+    def read_cursor(self, cursor_file):
+        if cursor_file and os.path.exists(cursor_file):
+            with open(cursor_file) as file:
+                return file.read().strip()
+
+    def write_cursor(self, cursor_file, path):
+        if path:
+            with open(cursor_file, "w") as file:
+                file.write(path)
+        elif os.path.exists(cursor_file):
+            # The sync is complete, the next one starts from the first page
+            os.remove(cursor_file)
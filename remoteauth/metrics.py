@@ -0,0 +1,212 @@
+import inspect
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+# Can remain static until restart
+# Class metrics are reported to, or None to record none
+METRICS_SINK = getattr(settings, "API_METRICS_SINK", "remoteauth.metrics.Registry")
+# Upper bounds, in seconds, of the latency histogram buckets
+METRICS_BUCKETS = getattr(
+    settings,
+    "API_METRICS_BUCKETS",
+    (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+# Serve the metrics in the Prometheus text format at metrics/ in remoteauth.urls
+METRICS_VIEW = getattr(settings, "API_METRICS_VIEW", False)
+# Endpoints reported under their own endpoint label, the others as
+# OTHER_ENDPOINT. None reports every endpoint, of which there are at most
+# API_MAX_ENDPOINTS.
+METRICS_ENDPOINTS = getattr(settings, "API_METRICS_ENDPOINTS", None)
+OTHER_ENDPOINT = "/other/"
+
+
+def _labels(labels):
+    endpoint = labels.get("endpoint", None)
+    if (
+        endpoint is not None
+        and METRICS_ENDPOINTS is not None
+        and endpoint not in METRICS_ENDPOINTS
+    ):
+        labels = dict(labels, endpoint=OTHER_ENDPOINT)
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in labels)
+    return f"{{{pairs}}}"
+
+
+class Registry:
+    """
+    Keeps counters, gauges and latency histograms in process memory and
+    renders them in the Prometheus text format.
+
+    Other sinks (e.g. for statsd) implement the same increment, add and
+    observe methods; labels are passed as a tuple of (name, value) pairs.
+    """
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(buckets or METRICS_BUCKETS)
+        self._counters = {}
+        self._gauges = {}
+        # Per histogram: the count of each bucket and of +Inf, then the sum
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, labels, value=1):
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def add(self, name, labels, value):
+        key = (name, labels)
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        key = (name, labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self._histograms.get(key, None)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(self.buckets) + 1)
+                histogram.append(0.0)
+            histogram[index] += 1
+            histogram[-1] += value
+
+    def value(self, name, **labels):
+        """
+        Return the current value of a counter or gauge, or the number of
+        observations of a histogram
+        """
+        key = (name, _labels(labels))
+        with self._lock:
+            if key in self._histograms:
+                return sum(self._histograms[key][:-1])
+            return self._counters.get(key, self._gauges.get(key, 0))
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+    def render(self):
+        with self._lock:
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items())
+            histograms = sorted(
+                (key, list(histogram)) for key, histogram in self._histograms.items()
+            )
+
+        lines = []
+        for kind, samples in (("counter", counters), ("gauge", gauges)):
+            seen = None
+            for (name, labels), value in samples:
+                if name != seen:
+                    lines.append(f"# TYPE {name} {kind}")
+                    seen = name
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+
+        seen = None
+        for (name, labels), histogram in histograms:
+            if name != seen:
+                lines.append(f"# TYPE {name} histogram")
+                seen = name
+            cumulative = 0
+            bounds = [str(bound) for bound in self.buckets] + ["+Inf"]
+            for bound, count in zip(bounds, histogram):
+                cumulative += count
+                bucket_labels = _format_labels(labels + (("le", bound),))
+                lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {histogram[-1]}")
+            lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+def get_sink():
+    """
+    Build the sink configured by the API_METRICS_SINK setting
+    """
+    if METRICS_SINK:
+        return import_string(METRICS_SINK)()
+
+
+sink = get_sink()
+
+
+def increment(name, value=1, **labels):
+    if sink is not None:
+        sink.increment(name, _labels(labels), value)
+
+
+def add(name, value, **labels):
+    if sink is not None:
+        sink.add(name, _labels(labels), value)
+
+
+def observe(name, value, **labels):
+    if sink is not None:
+        sink.observe(name, _labels(labels), value)
+
+
+class timer:
+    """
+    Observe the seconds a block takes in the histogram name. With gauge, the
+    block is also counted in that gauge while it runs.
+    """
+
+    __slots__ = ("name", "gauge", "labels", "started")
+
+    def __init__(self, name, gauge=None, **labels):
+        self.name = name
+        self.gauge = gauge
+        self.labels = labels
+
+    def __enter__(self):
+        if self.gauge:
+            add(self.gauge, 1, **self.labels)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(self.name, time.perf_counter() - self.started, **self.labels)
+        if self.gauge:
+            add(self.gauge, -1, **self.labels)
+
+
+def timed(name, gauge=None, **labels):
+    """
+    Decorate a function or coroutine function to time its calls, see timer
+    """
+
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with timer(name, gauge, **labels):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name, gauge, **labels):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
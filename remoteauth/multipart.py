@@ -0,0 +1,107 @@
+import json
+import mimetypes
+import os
+import uuid
+
+from django.conf import settings
+
+
+# Can remain static until restart
+UPLOAD_CHUNK_SIZE = getattr(settings, "API_UPLOAD_CHUNK_SIZE", 64 * 1024)
+
+
+def _items(mapping):
+    if not mapping:
+        return
+    # MultiValueDicts (request.POST, request.FILES) can hold several values
+    pairs = mapping.lists() if hasattr(mapping, "lists") else mapping.items()
+    for name, values in pairs:
+        if not isinstance(values, list):
+            values = [values]
+        for value in values:
+            yield name, value
+
+
+def _field_value(value):
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, (dict, list)):
+        return json.dumps(value).encode()
+    return str(value).encode()
+
+
+class MultipartBody:
+    """
+    A multipart/form-data body produced part by part while it is sent. Files
+    are read in chunks, so an upload is never held in memory as a whole.
+    Files are rewound on every iteration so the body can be sent again.
+
+    files maps field names to file objects, or to (filename, file object) or
+    (filename, file object, content type) tuples, like requests' files.
+    """
+
+    def __init__(self, fields=None, files=None, boundary=None, chunk_size=None):
+        self.fields = fields
+        self.files = files
+        self.boundary = boundary or uuid.uuid4().hex
+        self.chunk_size = chunk_size or UPLOAD_CHUNK_SIZE
+
+    @property
+    def content_type(self):
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def _part_header(self, name, filename=None, content_type=None):
+        disposition = f'form-data; name="{name}"'
+        if filename is not None:
+            disposition += f'; filename="{filename}"'
+        header = f"--{self.boundary}\r\nContent-Disposition: {disposition}\r\n"
+        if content_type:
+            header += f"Content-Type: {content_type}\r\n"
+        return f"{header}\r\n".encode()
+
+    def __iter__(self):
+        for name, value in _items(self.fields):
+            yield self._part_header(name) + _field_value(value) + b"\r\n"
+
+        for name, value in _items(self.files):
+            filename, file, content_type = None, value, None
+            if isinstance(value, tuple):
+                filename, file, *rest = value
+                content_type = rest[0] if rest else None
+            filename = filename or os.path.basename(getattr(file, "name", name))
+            content_type = (
+                content_type
+                or getattr(file, "content_type", None)
+                or mimetypes.guess_type(filename)[0]
+                or "application/octet-stream"
+            )
+
+            yield self._part_header(name, filename, content_type)
+            if hasattr(file, "seek"):
+                file.seek(0)
+            while True:
+                chunk = file.read(self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+            yield b"\r\n"
+
+        yield f"--{self.boundary}--\r\n".encode()
+
+
+class RequestStream:
+    """
+    The body of an incoming Django request, read in chunks as it is sent on.
+    It can only be iterated once.
+    """
+
+    def __init__(self, request, chunk_size=None):
+        self.request = request
+        self.chunk_size = chunk_size or UPLOAD_CHUNK_SIZE
+
+    def __iter__(self):
+        while True:
+            chunk = self.request.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
@@ -0,0 +1,86 @@
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+
+class PageError(Exception):
+    """
+    Raised by api.iter_pages when a page can not be fetched. path is the
+    page that failed, so that the listing can be resumed from it.
+    """
+
+    def __init__(self, path, results):
+        super().__init__(f"Fetching {path} failed with {results.error_code}")
+        self.path = path
+        self.results = results
+
+
+def with_params(path, **params):
+    """
+    Return path with params set in its query string
+    """
+    parts = urlsplit(path)
+    query = dict(parse_qsl(parts.query, keep_blank_values=True))
+    query.update({key: str(value) for key, value in params.items()})
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+class Paginator:
+    """
+    Finds the items of a page of a list endpoint and the path of the page
+    after it. Pages are either a list of items, or an object with the items
+    under items_key and a link to the next page under next_key. The link is
+    a URL or path, or an opaque cursor sent back as cursor_param. Listings
+    without links are paged with offset_param instead, until a page comes
+    back empty or shorter than page_size.
+    """
+
+    def __init__(
+        self,
+        base_url,
+        items_key="results",
+        next_key="next",
+        cursor_param="cursor",
+        offset_param=None,
+        page_size=None,
+    ):
+        self.base_url = base_url
+        self.items_key = items_key
+        self.next_key = next_key
+        self.cursor_param = cursor_param
+        self.offset_param = offset_param
+        self.page_size = page_size
+
+    def items(self, page):
+        if isinstance(page, dict):
+            return page.get(self.items_key) or []
+        return page or []
+
+    def next_path(self, path, page, items):
+        """
+        Return the path of the page after page, fetched from path, or None
+        on the last one
+        """
+        link = page.get(self.next_key) if isinstance(page, dict) else None
+        if link:
+            return self._link_path(path, str(link))
+        if self.offset_param and items:
+            if self.page_size and len(items) < self.page_size:
+                return None
+            query = dict(parse_qsl(urlsplit(path).query))
+            offset = int(query.get(self.offset_param, 0)) + len(items)
+            return with_params(path, **{self.offset_param: offset})
+        return None
+
+    def _link_path(self, path, link):
+        if link.startswith(self.base_url):
+            return link[len(self.base_url) :]
+        if "://" in link:
+            raise ValueError(f"Next page {link} is not on the API")
+        if link.startswith("/"):
+            # Root-relative links carry the path of the API, e.g. /api/users/
+            prefix = urlsplit(self.base_url).path.rstrip("/")
+            if prefix and link.startswith(f"{prefix}/"):
+                return link[len(prefix) :]
+            return link
+        if link.startswith("?"):
+            return urlsplit(path).path + link
+        return with_params(path, **{self.cursor_param: link})
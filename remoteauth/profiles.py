@@ -0,0 +1,279 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from remoteauth import metrics, response_cache
+
+
+# Can remain static until restart
+# Seconds a user profile is reused before it is fetched again, 0 to always fetch
+PROFILE_CACHE_TTL = getattr(settings, "API_PROFILE_CACHE_TTL", 0)
+PROFILE_CACHE = getattr(
+    settings, "API_PROFILE_CACHE", "remoteauth.profiles.LocalProfileCache"
+)
+PROFILE_CACHE_MAX_ENTRIES = getattr(settings, "API_PROFILE_CACHE_MAX_ENTRIES", 1000)
+PROFILE_CACHE_ALIAS = getattr(settings, "API_PROFILE_CACHE_ALIAS", "default")
+PROFILE_CACHE_PREFIX = getattr(
+    settings, "API_PROFILE_CACHE_PREFIX", "remoteauth:profile:"
+)
+# Upstream endpoint remoteauth_sync_users pages through
+USER_LIST_ENDPOINT = getattr(settings, "API_USER_LIST_ENDPOINT", "/users/")
+# Users written by remoteauth_sync_users in one bulk query
+USER_SYNC_BATCH_SIZE = getattr(settings, "API_USER_SYNC_BATCH_SIZE", 500)
+# User fields kept in line with the profile
+PROFILE_FIELDS = ("first_name", "last_name", "email")
+
+
+class LocalProfileCache:
+    """
+    Keeps profiles in process memory and evicts the least recently used
+    ones beyond max_entries. Each hit gets its own copy of the profile.
+    """
+
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries or PROFILE_CACHE_MAX_ENTRIES
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is None:
+                return None
+            expires_at, profile = entry
+            if time.time() >= expires_at:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+        return copy.deepcopy(profile)
+
+    def set(self, key, profile, ttl):
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, copy.deepcopy(profile))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    async def aget(self, key):
+        return self.get(key)
+
+    async def aset(self, key, profile, ttl):
+        self.set(key, profile, ttl)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class DjangoProfileCache:
+    """
+    Keeps profiles in one of Django's caches, shared between workers
+    """
+
+    def __init__(self, alias=None, prefix=None):
+        self.cache = caches[alias or PROFILE_CACHE_ALIAS]
+        self.prefix = prefix if prefix is not None else PROFILE_CACHE_PREFIX
+
+    def get(self, key):
+        return self.cache.get(f"{self.prefix}{key}")
+
+    def set(self, key, profile, ttl):
+        self.cache.set(f"{self.prefix}{key}", profile, timeout=ttl)
+
+    async def aget(self, key):
+        return await self.cache.aget(f"{self.prefix}{key}")
+
+    async def aset(self, key, profile, ttl):
+        await self.cache.aset(f"{self.prefix}{key}", profile, timeout=ttl)
+
+    def delete(self, key):
+        self.cache.delete(f"{self.prefix}{key}")
+
+
+def get_profile_cache():
+    """
+    Build the profile cache configured by the API_PROFILE_CACHE setting
+    """
+    return import_string(PROFILE_CACHE)()
+
+
+cache = get_profile_cache()
+
+
+def profile_key(token, username=None):
+    """
+    Identify whose profile token gives access to. A token without a subject
+    that was granted for username's password identifies that user, so that
+    repeated logins share the cached profile.
+    """
+    if token.get("sub", None) is None and username:
+        return f"username:{username}"
+    return response_cache.token_subject(token)
+
+
+def lookup(token, username=None):
+    """
+    Return the cached profile of the owner of token, if any
+    """
+    if not PROFILE_CACHE_TTL:
+        return None
+    return _counted(cache.get(profile_key(token, username)))
+
+
+async def alookup(token, username=None):
+    """
+    Async version of lookup
+    """
+    if not PROFILE_CACHE_TTL:
+        return None
+    return _counted(await cache.aget(profile_key(token, username)))
+
+
+def _counted(profile):
+    metrics.increment(
+        "remoteauth_profile_cache_total",
+        result="miss" if profile is None else "hit",
+    )
+    return profile
+
+
+def remember(token, profile, username=None):
+    if PROFILE_CACHE_TTL:
+        cache.set(profile_key(token, username), profile, PROFILE_CACHE_TTL)
+
+
+async def aremember(token, profile, username=None):
+    if PROFILE_CACHE_TTL:
+        await cache.aset(profile_key(token, username), profile, PROFILE_CACHE_TTL)
+
+
+def profile_value(profile, field):
+    """
+    Return the value of field in profile as the user stores it
+    """
+    value = profile[field] or ""
+    if field == "email":
+        return User.objects.normalize_email(value)
+    return value
+
+
+def changed_fields(user, profile):
+    """
+    Return the names of the user fields that differ from the profile
+    """
+    return [
+        field
+        for field in PROFILE_FIELDS
+        if field in profile and getattr(user, field) != profile_value(profile, field)
+    ]
+
+
+def apply_profile(user, profile):
+    """
+    Set the user fields that differ from the profile and return their names
+    """
+    fields = changed_fields(user, profile)
+    for field in fields:
+        setattr(user, field, profile_value(profile, field))
+    return fields
+
+
+def update_user(user, profile):
+    """
+    Write the profile fields that changed to user. Nothing is written when
+    the user is up to date. Returns the names of the fields written.
+    """
+    fields = apply_profile(user, profile)
+    if fields:
+        user.save(update_fields=fields)
+    return fields
+
+
+def _create_user(profile):
+    return User.objects.create_user(
+        username=profile["username"],
+        first_name=profile.get("first_name") or "",
+        last_name=profile.get("last_name") or "",
+        email=profile.get("email") or "",
+    )
+
+
+def sync_user(username, profile):
+    """
+    Return the user logged in as username, created from or updated to the
+    profile
+    """
+    try:
+        user = User.objects.get(username=username)
+    except User.DoesNotExist:
+        return _create_user(profile)
+    update_user(user, profile)
+    return user
+
+
+async def async_user(username, profile):
+    """
+    Async version of sync_user
+    """
+    try:
+        user = await User.objects.aget(username=username)
+    except User.DoesNotExist:
+        return await sync_to_async(_create_user)(profile)
+    fields = apply_profile(user, profile)
+    if fields:
+        await user.asave(update_fields=fields)
+    return user
+
+
+def _new_user(profile):
+    user = User(
+        username=profile["username"],
+        first_name=profile.get("first_name") or "",
+        last_name=profile.get("last_name") or "",
+        email=User.objects.normalize_email(profile.get("email") or ""),
+    )
+    # Remote users log in through the API, never with a local password
+    user.set_unusable_password()
+    return user
+
+
+def sync_users(batch, dry_run=False):
+    """
+    Create or update the users of a batch of profiles, reading them with one
+    query and writing them with at most one bulk_create and one bulk_update.
+    With dry_run nothing is written. Returns the numbers of users created and
+    updated.
+    """
+    by_username = {
+        profile["username"]: profile for profile in batch if profile.get("username")
+    }
+    changed = []
+    fields = set()
+    for user in User.objects.filter(username__in=list(by_username)):
+        written = apply_profile(user, by_username.pop(user.username))
+        if written:
+            changed.append(user)
+            fields.update(written)
+    created = [_new_user(profile) for profile in by_username.values()]
+
+    if not dry_run:
+        with transaction.atomic():
+            if created:
+                User.objects.bulk_create(created)
+            if changed:
+                User.objects.bulk_update(
+                    changed, [field for field in PROFILE_FIELDS if field in fields]
+                )
+    return len(created), len(changed)
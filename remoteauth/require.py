@@ -1,12 +1,16 @@
-from . import api
+from . import api, roles as role_index
 def in_any_of_the_roles(roles:list):
+    # Built once when the view is decorated, not on every check
+    required = role_index.normalize(roles)
+
     def user_test(user):
         request = api.get_request()
-        user_profile = request.session.get('user_profile')
-        if user_profile and user_profile.get('roles', None):
-            roles_set = set([r.lower() for r in roles])
-            return not roles_set.isdisjoint([r.lower() for r in user_profile.get('roles')])
-        elif not roles:
+        if request is None:
+            return False
+        user_roles = role_index.roles_of(request)
+        if user_roles:
+            return not required.isdisjoint(user_roles)
+        elif not required:
             return True
         
         return False
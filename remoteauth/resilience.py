@@ -0,0 +1,302 @@
+import asyncio
+import threading
+import time
+import weakref
+from collections import deque
+from urllib.parse import urlsplit
+
+from requests.exceptions import ConnectionError, Timeout
+from django.conf import settings
+
+
+# Can remain static until restart
+CIRCUIT_BREAKER_ENABLED = getattr(settings, "API_CIRCUIT_BREAKER_ENABLED", True)
+# Share of failed calls in the window that opens the circuit
+CIRCUIT_FAILURE_RATE = getattr(settings, "API_CIRCUIT_FAILURE_RATE", 0.5)
+# Calls needed in the window before the failure rate is trusted
+CIRCUIT_MIN_CALLS = getattr(settings, "API_CIRCUIT_MIN_CALLS", 20)
+CIRCUIT_WINDOW = getattr(settings, "API_CIRCUIT_WINDOW", 30)
+# Seconds an open circuit fails fast before a probe call is let through
+CIRCUIT_RESET_TIMEOUT = getattr(settings, "API_CIRCUIT_RESET_TIMEOUT", 30)
+# Calls slower than this count as failures
+CIRCUIT_SLOW_CALL_SECONDS = getattr(settings, "API_CIRCUIT_SLOW_CALL_SECONDS", 10)
+# Calls in flight per upstream host, None to not limit them
+BULKHEAD_MAX_CONCURRENT = getattr(settings, "API_BULKHEAD_MAX_CONCURRENT", None)
+BULKHEAD_MAX_WAITING = getattr(settings, "API_BULKHEAD_MAX_WAITING", 20)
+BULKHEAD_WAIT_TIMEOUT = getattr(settings, "API_BULKHEAD_WAIT_TIMEOUT", 1)
+
+_breakers = {}
+_bulkheads = {}
+_registry_lock = threading.Lock()
+
+
+class CircuitOpenError(ConnectionError):
+    """
+    Raised instead of calling an endpoint whose circuit is open
+    """
+
+
+class BulkheadFullError(ConnectionError):
+    """
+    Raised when an upstream already has as many calls in flight and queued
+    as it is allowed
+    """
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        name,
+        failure_rate=None,
+        min_calls=None,
+        window=None,
+        reset_timeout=None,
+        slow_call_seconds=None,
+    ):
+        self.name = name
+        self.failure_rate = failure_rate or CIRCUIT_FAILURE_RATE
+        self.min_calls = min_calls or CIRCUIT_MIN_CALLS
+        self.window = window or CIRCUIT_WINDOW
+        self.reset_timeout = reset_timeout or CIRCUIT_RESET_TIMEOUT
+        self.slow_call_seconds = slow_call_seconds or CIRCUIT_SLOW_CALL_SECONDS
+        self.state = self.CLOSED
+        self._outcomes = deque()
+        self._failures = 0
+        self._opened_at = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """
+        Raise CircuitOpenError when the call must not be made
+        """
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    raise CircuitOpenError(f"Circuit for {self.name} is open")
+                self.state = self.HALF_OPEN
+                self._probing = False
+
+            if self.state == self.HALF_OPEN:
+                # Let a single probe call find out if the endpoint recovered
+                if self._probing:
+                    raise CircuitOpenError(f"Circuit for {self.name} is open")
+                self._probing = True
+
+    def record(self, failed):
+        with self._lock:
+            now = time.monotonic()
+            if self.state == self.HALF_OPEN:
+                self._probing = False
+                if failed:
+                    self._open(now)
+                else:
+                    self.state = self.CLOSED
+                return
+
+            self._outcomes.append((now, failed))
+            self._failures += failed
+            while self._outcomes and now - self._outcomes[0][0] > self.window:
+                _, old_failed = self._outcomes.popleft()
+                self._failures -= old_failed
+
+            calls = len(self._outcomes)
+            if calls >= self.min_calls and self._failures / calls >= self.failure_rate:
+                self._open(now)
+
+    def cancel(self):
+        """
+        Give back the probe slot of a call that was let through but never
+        made, without recording an outcome
+        """
+        with self._lock:
+            self._probing = False
+
+    def _open(self, now):
+        self.state = self.OPEN
+        self._opened_at = now
+        self._outcomes.clear()
+        self._failures = 0
+
+
+class Bulkhead:
+    """
+    Limits the calls in flight to an upstream host. Threads and each event
+    loop get max_concurrent slots of their own, as a call of one can not
+    wait for a slot held by the other.
+    """
+
+    def __init__(self, name, max_concurrent=None, max_waiting=None, wait_timeout=None):
+        self.name = name
+        self.max_concurrent = max_concurrent or BULKHEAD_MAX_CONCURRENT
+        self.max_waiting = BULKHEAD_MAX_WAITING if max_waiting is None else max_waiting
+        self.wait_timeout = wait_timeout or BULKHEAD_WAIT_TIMEOUT
+        self._slots = threading.BoundedSemaphore(self.max_concurrent)
+        self._async_slots = weakref.WeakKeyDictionary()
+        self.waiting = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, blocking=True):
+        """
+        Take a slot, waiting in a bounded queue when blocking. Raises
+        BulkheadFullError when no slot could be had.
+        """
+        if self._slots.acquire(blocking=False):
+            return
+        if not blocking:
+            raise BulkheadFullError(f"Too many calls in flight to {self.name}")
+
+        with self._lock:
+            if self.waiting >= self.max_waiting:
+                raise BulkheadFullError(f"Too many calls queued for {self.name}")
+            self.waiting += 1
+        try:
+            if not self._slots.acquire(timeout=self.wait_timeout):
+                raise BulkheadFullError(f"Timed out waiting to call {self.name}")
+        finally:
+            with self._lock:
+                self.waiting -= 1
+
+    def release(self):
+        self._slots.release()
+
+    def _loop_slots(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            slots = self._async_slots.get(loop)
+            if slots is None:
+                slots = self._async_slots[loop] = asyncio.BoundedSemaphore(
+                    self.max_concurrent
+                )
+            return slots
+
+    async def aacquire(self):
+        """
+        Async version of acquire, waiting for a slot without blocking the
+        event loop
+        """
+        slots = self._loop_slots()
+        if not slots.locked():
+            await slots.acquire()
+            return
+
+        with self._lock:
+            if self.waiting >= self.max_waiting:
+                raise BulkheadFullError(f"Too many calls queued for {self.name}")
+            self.waiting += 1
+        try:
+            await asyncio.wait_for(slots.acquire(), self.wait_timeout)
+        except asyncio.TimeoutError:
+            raise BulkheadFullError(f"Timed out waiting to call {self.name}")
+        finally:
+            with self._lock:
+                self.waiting -= 1
+
+    def arelease(self):
+        self._loop_slots().release()
+
+
+def get_breaker(name):
+    with _registry_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = _breakers[name] = CircuitBreaker(name)
+        return breaker
+
+
+def get_bulkhead(name):
+    with _registry_lock:
+        bulkhead = _bulkheads.get(name)
+        if bulkhead is None:
+            bulkhead = _bulkheads[name] = Bulkhead(name)
+        return bulkhead
+
+
+def reset():
+    """
+    Forget all circuit breakers and bulkheads
+    """
+    with _registry_lock:
+        _breakers.clear()
+        _bulkheads.clear()
+
+
+def _guards(url, endpoint):
+    host = urlsplit(url).netloc
+    breaker = get_breaker(endpoint or host) if CIRCUIT_BREAKER_ENABLED else None
+    bulkhead = get_bulkhead(host) if BULKHEAD_MAX_CONCURRENT else None
+    return breaker, bulkhead
+
+
+def _is_failure(breaker, response, started):
+    return (
+        response.status_code >= 500
+        or time.monotonic() - started >= breaker.slow_call_seconds
+    )
+
+
+def call(url, endpoint, send):
+    """
+    Run send(), the request to url, behind the circuit breaker of endpoint
+    (or of the host when no endpoint is given) and the bulkhead of the host
+    """
+    breaker, bulkhead = _guards(url, endpoint)
+    if breaker is not None:
+        breaker.before_call()
+    if bulkhead is not None:
+        try:
+            bulkhead.acquire()
+        except BulkheadFullError:
+            if breaker is not None:
+                breaker.cancel()
+            raise
+
+    started = time.monotonic()
+    try:
+        response = send()
+    except Exception as ex:
+        if breaker is not None:
+            breaker.record(failed=isinstance(ex, (ConnectionError, Timeout)))
+        raise
+    finally:
+        if bulkhead is not None:
+            bulkhead.release()
+
+    if breaker is not None:
+        breaker.record(failed=_is_failure(breaker, response, started))
+    return response
+
+
+async def acall(url, endpoint, send):
+    """
+    Async version of call
+    """
+    breaker, bulkhead = _guards(url, endpoint)
+    if breaker is not None:
+        breaker.before_call()
+    if bulkhead is not None:
+        try:
+            await bulkhead.aacquire()
+        except BulkheadFullError:
+            if breaker is not None:
+                breaker.cancel()
+            raise
+
+    started = time.monotonic()
+    try:
+        response = await send()
+    except Exception as ex:
+        if breaker is not None:
+            breaker.record(failed=isinstance(ex, (ConnectionError, Timeout)))
+        raise
+    finally:
+        if bulkhead is not None:
+            bulkhead.arelease()
+
+    if breaker is not None:
+        breaker.record(failed=_is_failure(breaker, response, started))
+    return response
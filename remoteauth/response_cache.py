@@ -0,0 +1,195 @@
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from requests import Response
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+
+# Can remain static until restart
+# Maps path regular expressions to the seconds their responses stay fresh
+RESPONSE_CACHE_TTLS = getattr(settings, "API_RESPONSE_CACHE_TTLS", {})
+RESPONSE_CACHE = getattr(
+    settings, "API_RESPONSE_CACHE", "remoteauth.response_cache.LocalResponseCache"
+)
+RESPONSE_CACHE_MAX_ENTRIES = getattr(settings, "API_RESPONSE_CACHE_MAX_ENTRIES", 1000)
+RESPONSE_CACHE_ALIAS = getattr(settings, "API_RESPONSE_CACHE_ALIAS", "default")
+RESPONSE_CACHE_PREFIX = getattr(
+    settings, "API_RESPONSE_CACHE_PREFIX", "remoteauth:response:"
+)
+# Seconds a stale response is kept around so it can be revalidated
+RESPONSE_CACHE_STALE_TTL = getattr(settings, "API_RESPONSE_CACHE_STALE_TTL", 300)
+
+_ttl_policy = [
+    (re.compile(pattern), ttl) for pattern, ttl in RESPONSE_CACHE_TTLS.items()
+]
+
+
+class CachedResponse:
+    """
+    The body of a cached response. It is stored as bytes and parsed again on
+    every hit, so callers never share (and mutate) the same decoded object.
+    """
+
+    def __init__(
+        self, content, encoding, content_type, expires_at, etag, last_modified
+    ):
+        self.content = content
+        self.encoding = encoding
+        self.content_type = content_type
+        self.expires_at = expires_at
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def to_response(self):
+        response = Response()
+        response.status_code = 200
+        response._content = self.content
+        response.encoding = self.encoding
+        if self.content_type:
+            response.headers["Content-Type"] = self.content_type
+        return response
+
+    def refresh(self, ttl):
+        self.expires_at = time.time() + ttl
+
+    def is_fresh(self):
+        return time.time() < self.expires_at
+
+    def can_revalidate(self):
+        return bool(self.etag or self.last_modified)
+
+    def revalidation_headers(self):
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class LocalResponseCache:
+    """
+    Keeps responses in process memory and evicts the least recently used
+    ones beyond max_entries
+    """
+
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries or RESPONSE_CACHE_MAX_ENTRIES
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class DjangoResponseCache:
+    """
+    Keeps responses in one of Django's caches, shared between workers
+    """
+
+    def __init__(self, alias=None, prefix=None):
+        self.cache = caches[alias or RESPONSE_CACHE_ALIAS]
+        self.prefix = prefix if prefix is not None else RESPONSE_CACHE_PREFIX
+
+    def get(self, key):
+        return self.cache.get(f"{self.prefix}{key}")
+
+    def set(self, key, entry):
+        timeout = max(entry.expires_at - time.time(), 0)
+        if entry.can_revalidate():
+            timeout += RESPONSE_CACHE_STALE_TTL
+        self.cache.set(f"{self.prefix}{key}", entry, timeout=timeout)
+
+    def delete(self, key):
+        self.cache.delete(f"{self.prefix}{key}")
+
+
+def ttl_for(path):
+    """
+    Return the seconds responses of path stay fresh under the
+    API_RESPONSE_CACHE_TTLS policy, or None when they are not cached
+    """
+    for pattern, ttl in _ttl_policy:
+        if pattern.match(path):
+            return ttl
+
+
+def token_subject(token):
+    """
+    Identify whose data a token gives access to, so that cached responses
+    are never shared between users
+    """
+    subject = token.get("sub", None)
+    if subject is None:
+        subject = hashlib.sha256(token["access_token"].encode()).hexdigest()
+    return subject
+
+
+def cache_key(path, token):
+    subject = token_subject(token)
+    return hashlib.sha256(f"{subject}|{path}".encode()).hexdigest()
+
+
+def freshness(response, ttl):
+    """
+    Apply the response's Cache-Control header to ttl. Returns None when the
+    response must not be stored.
+    """
+    directives = {}
+    for directive in response.headers.get("Cache-Control", "").split(","):
+        name, _, value = directive.strip().partition("=")
+        if name:
+            directives[name.lower()] = value.strip('"')
+
+    if "no-store" in directives:
+        return None
+    if "no-cache" in directives:
+        return 0
+    if "max-age" in directives:
+        try:
+            return min(ttl, int(directives["max-age"]))
+        except ValueError:
+            pass
+    return ttl
+
+
+def build_entry(response, ttl):
+    return CachedResponse(
+        content=response.content,
+        encoding=response.encoding,
+        content_type=response.headers.get("Content-Type", None),
+        expires_at=time.time() + ttl,
+        etag=response.headers.get("ETag", None),
+        last_modified=response.headers.get("Last-Modified", None),
+    )
+
+
+def get_response_cache():
+    """
+    Build the response cache configured by the API_RESPONSE_CACHE setting
+    """
+    return import_string(RESPONSE_CACHE)()
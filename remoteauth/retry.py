@@ -0,0 +1,188 @@
+import asyncio
+import logging
+import random
+import time
+from email.utils import parsedate_to_datetime
+
+from requests.exceptions import ConnectionError, ConnectTimeout, Timeout
+from django.conf import settings
+
+from remoteauth.resilience import BulkheadFullError, CircuitOpenError
+
+
+logger = logging.getLogger(__name__)
+
+# Can remain static until restart
+# Most retries of one call, whatever its max_retry
+RETRY_ATTEMPTS = getattr(settings, "API_RETRY_ATTEMPTS", 2)
+RETRY_STATUSES = frozenset(
+    getattr(settings, "API_RETRY_STATUSES", (429, 502, 503, 504))
+)
+# First backoff in seconds, doubled on every retry and jittered
+RETRY_BACKOFF = getattr(settings, "API_RETRY_BACKOFF", 0.1)
+RETRY_BACKOFF_MAX = getattr(settings, "API_RETRY_BACKOFF_MAX", 2)
+# A longer Retry-After is not waited for: the response is returned instead
+RETRY_AFTER_MAX = getattr(settings, "API_RETRY_AFTER_MAX", 5)
+# Seconds one API call may take, retries included
+CALL_DEADLINE = getattr(settings, "API_CALL_DEADLINE", 30)
+# Seconds the API calls of one Django request may run for, counted from the
+# moment GlobalRequestMiddleware sees the request
+REQUEST_DEADLINE = getattr(settings, "API_REQUEST_DEADLINE", None)
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "OPTIONS", "PUT", "DELETE", "TRACE"])
+IDEMPOTENCY_KEY_HEADER = "Idempotency-Key"
+
+
+class DeadlineExceeded(Timeout):
+    """
+    Raised instead of calling the API once the deadline of a call has passed
+    """
+
+
+def deadline_after(seconds):
+    if seconds is None:
+        return None
+    return time.monotonic() + seconds
+
+
+def earliest(*deadlines):
+    deadlines = [deadline for deadline in deadlines if deadline is not None]
+    return min(deadlines) if deadlines else None
+
+
+def remaining(deadline):
+    """
+    Return the seconds left until deadline, or None without a deadline.
+    Raises DeadlineExceeded when none are left.
+    """
+    if deadline is None:
+        return None
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise DeadlineExceeded("The deadline of the API call has passed")
+    return left
+
+
+def is_idempotent(method, headers=None):
+    """
+    A request may be sent twice when its method is idempotent, or when it
+    carries an idempotency key the upstream deduplicates on
+    """
+    return method.upper() in IDEMPOTENT_METHODS or IDEMPOTENCY_KEY_HEADER in (
+        headers or {}
+    )
+
+
+def backoff(attempt):
+    """
+    Seconds to wait before retry number attempt (from 0), with full jitter
+    so that callers failing together do not retry together
+    """
+    return random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF * 2**attempt))
+
+
+def retry_after(response):
+    """
+    Return the seconds the Retry-After header of response asks to wait, or
+    None when it has none
+    """
+    value = response.headers.get("Retry-After", None)
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def _delay(method, headers, attempt, retries, deadline, response=None, error=None):
+    """
+    Return the seconds to wait before sending the request again, or None
+    when it must not be retried
+    """
+    if attempt >= retries:
+        return None
+
+    if error is not None:
+        # Guards refusing the call would only refuse it again
+        if isinstance(error, (CircuitOpenError, BulkheadFullError, DeadlineExceeded)):
+            return None
+        if not isinstance(error, (ConnectionError, Timeout)):
+            return None
+        # A request that never got connected was never seen by the upstream
+        if not isinstance(error, ConnectTimeout) and not is_idempotent(method, headers):
+            return None
+        delay = backoff(attempt)
+    else:
+        if response.status_code not in RETRY_STATUSES:
+            return None
+        if not is_idempotent(method, headers):
+            return None
+        delay = retry_after(response)
+        if delay is None:
+            delay = backoff(attempt)
+        elif delay > RETRY_AFTER_MAX:
+            return None
+
+    if deadline is not None and time.monotonic() + delay >= deadline:
+        return None
+    return delay
+
+
+def call(method, headers, send, retries=0, deadline=None):
+    """
+    Run send(timeout), retrying failed idempotent requests up to retries
+    times with jittered exponential backoff. timeout is the number of
+    seconds left until deadline (None without one), which send must not run
+    past.
+    """
+    retries = min(retries, RETRY_ATTEMPTS)
+    attempt = 0
+    while True:
+        try:
+            response = send(remaining(deadline))
+        except Exception as ex:
+            delay = _delay(method, headers, attempt, retries, deadline, error=ex)
+            if delay is None:
+                raise
+            reason = ex
+        else:
+            delay = _delay(method, headers, attempt, retries, deadline, response)
+            if delay is None:
+                return response
+            reason = f"http {response.status_code}"
+            response.close()
+
+        logger.warning(f"Retrying {method} request in {delay:.2f}s after {reason}")
+        time.sleep(delay)
+        attempt += 1
+
+
+async def acall(method, headers, send, retries=0, deadline=None):
+    """
+    Async version of call, for a send coroutine function returning httpx
+    responses
+    """
+    retries = min(retries, RETRY_ATTEMPTS)
+    attempt = 0
+    while True:
+        try:
+            response = await send(remaining(deadline))
+        except Exception as ex:
+            delay = _delay(method, headers, attempt, retries, deadline, error=ex)
+            if delay is None:
+                raise
+            reason = ex
+        else:
+            delay = _delay(method, headers, attempt, retries, deadline, response)
+            if delay is None:
+                return response
+            reason = f"http {response.status_code}"
+            await response.aclose()
+
+        logger.warning(f"Retrying {method} request in {delay:.2f}s after {reason}")
+        await asyncio.sleep(delay)
+        attempt += 1
@@ -0,0 +1,41 @@
+# Attribute of the request its roles are indexed under
+_INDEX_ATTRIBUTE = "_remoteauth_roles"
+
+
+def normalize(roles):
+    """
+    Return roles as a frozenset of lowercased names, the form role checks
+    compare
+    """
+    return frozenset(role.lower() for role in roles)
+
+
+def _index(request):
+    """
+    Return the roles of the user logged in to request, as given and
+    normalized. They are indexed once per request, and again only when the
+    profile in the session is replaced, e.g. by a login.
+    """
+    profile = request.session.get("user_profile", None) or {}
+    roles = profile.get("roles", None) or ()
+    indexed = getattr(request, _INDEX_ATTRIBUTE, None)
+    if indexed is not None and indexed[0] is roles:
+        return indexed[1]
+    index = (frozenset(roles), normalize(roles))
+    setattr(request, _INDEX_ATTRIBUTE, (roles, index))
+    return index
+
+
+def roles_of(request):
+    """
+    Return the normalized roles of the user logged in to request
+    """
+    return _index(request)[1]
+
+
+def exact_roles_of(request):
+    """
+    Return the roles of the user logged in to request, as the profile names
+    them
+    """
+    return _index(request)[0]
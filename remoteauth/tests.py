@@ -1,16 +1,78 @@
-from . import api
-from django.test import TestCase
+from . import (
+    api,
+    codec,
+    graphql,
+    hedging,
+    jwks,
+    metrics,
+    multipart,
+    pagination,
+    profiles,
+    require,
+    resilience,
+    response_cache,
+    retry,
+    roles,
+    tokens,
+    tracing,
+    transport,
+    views,
+)
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.http import HttpResponse, QueryDict
+from django.test import AsyncRequestFactory, RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.test.client import BOUNDARY, MULTIPART_CONTENT, encode_multipart
+from requests import Response
+import requests_mock
 from requests_mock import mock
 from django.conf import settings
-from datetime import datetime, timedelta
+from django.core.cache import caches
+from datetime import datetime, timedelta, timezone
+import asyncio
+import io
+import os
+import re
+import tempfile
+import threading
+from threading import Thread
+import time
+import json
+from unittest import skipIf, skipUnless
+from unittest.mock import patch
+from urllib.parse import urlsplit
 
 BASE_URL = api.BASE_URL
 
 def url(path:str):
     return api.__full_url__(path)
 
+class SiteTokenMixin:
+    """
+    Starts each test with a valid site token, so that API calls do not
+    request one
+    """
+
+    def setUp(self):
+        super().setUp()
+        api.token_store.clear()
+        api.token_store.set(
+            api.SITE_ACCESS_TOKEN_KEY,
+            {"access_token": "site", "expires_in": 36000},
+        )
+
+
 class ApiAccessTokenTests(TestCase):
 
+    def setUp(self):
+        api.token_store.clear()
+
     def register_vault_url(self, api_mock):
         mock_token={"access_token": "yiB2rhfMC5PlRpMVDhGU5I0fD5UB3H", "expires_in": 36000, "timestamp":datetime.now().strftime(api.ISO_DATE_FORMAT), "token_type": "Bearer", "scope": "read write"}
         api_mock.register_uri("POST",url('/configs/prod//oauth'), status_code=200, json=mock_token)
@@ -28,7 +90,7 @@ class ApiAccessTokenTests(TestCase):
 
         self.assertIsNotNone(token)
         self.assertEqual(token["access_token"],mock_token["access_token"])
-        self.assertIsNotNone(token["timestamp"])
+        self.assertFalse(token.is_expired())
 
     def test_access_token_is_read_from_session_when_in_sesstion_not_expired(self):   
         mock_token={"access_token": "yiB2rhfMC5PlRpMVDhGU5I0fD5UB3H", "expires_in": 36000, "timestamp":datetime.now().strftime(api.ISO_DATE_FORMAT), "token_type": "Bearer", "scope": "read write"}
@@ -51,7 +113,7 @@ class ApiAccessTokenTests(TestCase):
 
         self.assertIsNotNone(token)
         self.assertNotEqual(token["access_token"],expired_token["access_token"])
-        self.assertEqual(session["site_token"],token)
+        self.assertEqual(tokens.Token.load(session["site_token"]),token)
 
     @mock()
     def test_that_new_token_is_fetched_when_user_info_is_given(self, api_mock):
@@ -64,8 +126,8 @@ class ApiAccessTokenTests(TestCase):
 
         self.assertIsNotNone(token)
         self.assertNotEqual(token["access_token"],site_token["access_token"])
-        self.assertNotEqual(session["site_token"],token)
-        self.assertIsNotNone(token["timestamp"])
+        self.assertNotEqual(tokens.Token.load(session["site_token"]),token)
+        self.assertFalse(token.is_expired())
 
     @mock()
     def test_that_token_is_grabbed_from_session_when_in_session_unexpired(self, api_mock):
@@ -76,7 +138,7 @@ class ApiAccessTokenTests(TestCase):
         self.register_vault_url(api_mock)
         self.assertIsNotNone(token)
         self.assertEqual(token["access_token"],insession_token["access_token"])
-        self.assertEqual(session["user_token"],token)
+        self.assertEqual(tokens.Token.load(session["user_token"]),token)
 
     @mock()
     def test_that_new_user_token_is_fetched_when_existing_token_expires(self, api_mock):
@@ -90,4 +152,2028 @@ class ApiAccessTokenTests(TestCase):
 
         self.assertIsNotNone(token)
         self.assertNotEqual(token["access_token"],expired_token["access_token"])
-        self.assertEqual(session["user_token"],token)
+        self.assertEqual(tokens.Token.load(session["user_token"]),token)
+
+
+class TransportTests(TestCase):
+    def test_session_is_shared_between_calls(self):
+        self.assertIs(transport.get_session(), transport.get_session())
+
+    @mock()
+    def test_default_timeout_is_applied(self, api_mock):
+        api_mock.register_uri("GET", url("/things/"), status_code=200, json={})
+        transport.request("GET", url("/things/"))
+
+        self.assertEqual(
+            api_mock.last_request.timeout,
+            (transport.CONNECT_TIMEOUT, transport.READ_TIMEOUT),
+        )
+
+
+class SiteTokenStoreTests(TestCase):
+    def setUp(self):
+        api.token_store.clear()
+
+    def mock_token(self):
+        return {
+            "access_token": "yiB2rhfMC5PlRpMVDhGU5I0fD5UB3H",
+            "expires_in": 36000,
+            "token_type": "Bearer",
+            "scope": "read write",
+        }
+
+    @mock()
+    def test_site_token_is_shared_between_sessions(self, api_mock):
+        token_mock = api_mock.register_uri(
+            "POST", url(api.ACCESS_TOKEN_ENDPOINT), json=self.mock_token()
+        )
+        first = api.ApiAccessToken().get_access_token(session={})
+        second = api.ApiAccessToken().get_access_token(session={})
+
+        self.assertEqual(first["access_token"], second["access_token"])
+        self.assertEqual(token_mock.call_count, 1)
+
+    @mock()
+    def test_concurrent_misses_request_a_single_token(self, api_mock):
+        def slow_token(request, context):
+            time.sleep(0.1)
+            return self.mock_token()
+
+        token_mock = api_mock.register_uri(
+            "POST", url(api.ACCESS_TOKEN_ENDPOINT), json=slow_token
+        )
+        tokens = []
+        threads = [
+            Thread(
+                target=lambda: tokens.append(api.ApiAccessToken().get_access_token())
+            )
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(token_mock.call_count, 1)
+        self.assertEqual(len(tokens), 8)
+        self.assertTrue(all(t["access_token"] for t in tokens))
+
+    @mock()
+    def test_site_token_close_to_expiry_is_refreshed(self, api_mock):
+        token_mock = api_mock.register_uri(
+            "POST", url(api.ACCESS_TOKEN_ENDPOINT), json=self.mock_token()
+        )
+        expiring_token = dict(
+            self.mock_token(),
+            access_token="expiring",
+            expires_in=api.TOKEN_EXPIRY_LEEWAY - 1,
+            timestamp=datetime.now().strftime(api.ISO_DATE_FORMAT),
+        )
+        api.token_store.set(api.SITE_ACCESS_TOKEN_KEY, expiring_token)
+        token = api.ApiAccessToken().get_access_token()
+
+        self.assertNotEqual(token["access_token"], "expiring")
+        self.assertEqual(token_mock.call_count, 1)
+
+
+class CacheTokenStoreTests(TestCase):
+    def setUp(self):
+        caches["default"].clear()
+
+    def token(self, access_token="shared"):
+        return {"access_token": access_token, "expires_in": 600}
+
+    def test_token_refreshed_by_one_worker_is_read_by_another(self):
+        refreshes = []
+
+        def refresh():
+            refreshes.append(1)
+            return self.token()
+
+        first_worker = tokens.CacheTokenStore()
+        second_worker = tokens.CacheTokenStore()
+        first = first_worker.get_or_refresh("site", lambda t: True, refresh)
+        second = second_worker.get_or_refresh("site", lambda t: True, refresh)
+
+        self.assertEqual(first, second)
+        self.assertEqual(len(refreshes), 1)
+
+    def test_waits_for_worker_holding_the_lock(self):
+        store = tokens.CacheTokenStore()
+        other_worker = tokens.CacheTokenStore()
+        caches["default"].add(store._lock_key("site"), 1)
+
+        def finish_refresh():
+            time.sleep(0.1)
+            other_worker.set("site", self.token("from-other-worker"))
+            caches["default"].delete(store._lock_key("site"))
+
+        Thread(target=finish_refresh).start()
+        token = store.get_or_refresh(
+            "site", lambda t: True, lambda: self.token("from-this-worker")
+        )
+
+        self.assertEqual(token["access_token"], "from-other-worker")
+
+    def test_invalid_shared_token_is_refreshed(self):
+        store = tokens.CacheTokenStore()
+        store.set("site", self.token("stale"))
+        token = tokens.CacheTokenStore().get_or_refresh(
+            "site", lambda t: t["access_token"] != "stale", lambda: self.token()
+        )
+
+        self.assertEqual(token["access_token"], "shared")
+        self.assertEqual(store.get("site")["access_token"], "stale")
+        self.assertEqual(caches["default"].get(store._cache_key("site")), token)
+
+
+    def test_refresh_ahead_reuses_token_refreshed_by_another_worker(self):
+        refreshes = []
+
+        def refresh():
+            refreshes.append(1)
+            return tokens.Token.from_grant(self.token(f"site{len(refreshes)}"))
+
+        first_worker = tokens.CacheTokenStore()
+        second_worker = tokens.CacheTokenStore()
+        expiring = tokens.Token("site0", expires_in=600, expires_at=time.time() + 5)
+        first_worker.set("site", expiring)
+        second_worker.get("site")
+
+        def is_due(token):
+            return tokens.Token.load(token).is_expired(60)
+
+        first_worker._refresh_ahead("site", refresh, is_due)
+        second_worker._refresh_ahead("site", refresh, is_due)
+
+        self.assertEqual(len(refreshes), 1)
+        self.assertEqual(second_worker.get("site")["access_token"], "site1")
+        self.assertEqual(
+            caches["default"].get(first_worker._cache_key("site"))["access_token"],
+            "site1",
+        )
+
+    def test_expired_tokens_and_their_locks_are_dropped(self):
+        store = tokens.LocalTokenStore()
+        store._lock_for("parked")
+        store.set("parked", tokens.Token("old", expires_at=time.time() - 1))
+        store._lock_for("site")
+        store.set("site", self.token())
+
+        self.assertIsNone(store.get("parked"))
+        self.assertNotIn("parked", store._locks)
+        self.assertIsNotNone(store.take("site"))
+        self.assertEqual(store._locks, {})
+
+
+class TokenTests(TestCase):
+    def test_expiry_is_computed_from_grant(self):
+        token = tokens.Token.from_grant(
+            {"access_token": "t", "expires_in": 600}, granted_at=1000
+        )
+
+        self.assertEqual(token.expires_at, 1600)
+        self.assertTrue(token.is_expired())
+
+    def test_token_without_expiry_never_expires(self):
+        token = tokens.Token.from_grant({"access_token": "t"})
+
+        self.assertFalse(token.is_expired(leeway=10**9))
+        self.assertNotIn("expires_at", token.to_session())
+
+    def test_session_form_round_trips_through_json(self):
+        token = tokens.Token.from_grant(
+            {
+                "access_token": "t",
+                "refresh_token": "r",
+                "expires_in": 600,
+                "scope": "read write",
+                "sub": "user-1",
+            }
+        )
+
+        loaded = tokens.Token.load(json.loads(json.dumps(token.to_session())))
+
+        self.assertEqual(loaded, token)
+        self.assertEqual(loaded.expires_at, token.expires_at)
+        self.assertEqual(loaded["sub"], "user-1")
+
+    def test_legacy_session_token_is_read_and_converted_once(self):
+        grabbed_at = datetime.now() - timedelta(seconds=100)
+        legacy = {
+            "access_token": "legacy",
+            "refresh_token": "r",
+            "expires_in": 36000,
+            "timestamp": grabbed_at.strftime(api.ISO_DATE_FORMAT),
+            "token_type": "Bearer",
+        }
+        session = {"user_token": legacy}
+
+        token = api.ApiAccessToken().get_access_token(session=session)
+
+        self.assertEqual(token.access_token, "legacy")
+        self.assertAlmostEqual(
+            token.expires_at, grabbed_at.timestamp() + 36000, delta=1
+        )
+        self.assertNotIn("timestamp", session["user_token"])
+        self.assertEqual(tokens.Token.load(session["user_token"]), token)
+
+    def test_invalidated_user_token_keeps_its_refresh_token(self):
+        token = tokens.Token.from_grant(
+            {"access_token": "t", "refresh_token": "r", "expires_in": 600}
+        )
+        session = {"user_token": token.to_session()}
+
+        api.ApiAccessToken().invalidate(token, session=session)
+
+        kept = tokens.Token.load(session["user_token"])
+        self.assertTrue(kept.is_expired())
+        self.assertEqual(kept.refresh_token, "r")
+
+    def test_token_is_kept_in_cache_store(self):
+        store = tokens.CacheTokenStore(prefix="test:compact:")
+        token = tokens.Token.from_grant({"access_token": "t", "expires_in": 600})
+
+        store.set("site", token)
+
+        self.assertEqual(caches["default"].get("test:compact:site"), token)
+
+
+class TokenRefreshTests(TestCase):
+    def setUp(self):
+        api.token_store.clear()
+
+    def token(self, access_token, expires_in=36000, grabbed_at=None):
+        grabbed_at = grabbed_at or datetime.now()
+        return {
+            "access_token": access_token,
+            "refresh_token": f"refresh-{access_token}",
+            "expires_in": expires_in,
+            "timestamp": grabbed_at.strftime(api.ISO_DATE_FORMAT),
+            "token_type": "Bearer",
+        }
+
+    def wait_for_background_refresh(self):
+        for thread in threading.enumerate():
+            if thread.name.startswith("remoteauth-refresh-"):
+                thread.join()
+
+    @mock()
+    def test_site_token_due_for_refresh_is_replaced_in_background(self, api_mock):
+        api_mock.register_uri(
+            "POST", url(api.ACCESS_TOKEN_ENDPOINT), json=self.token("fresh")
+        )
+        grabbed_at = datetime.now() - timedelta(seconds=3600 - 60)
+        api.token_store.set(
+            api.SITE_ACCESS_TOKEN_KEY, self.token("old", 3600, grabbed_at)
+        )
+
+        token = api.ApiAccessToken().get_access_token()
+        self.wait_for_background_refresh()
+
+        self.assertEqual(token["access_token"], "old")
+        self.assertEqual(
+            api.token_store.get(api.SITE_ACCESS_TOKEN_KEY)["access_token"], "fresh"
+        )
+
+    @mock()
+    @patch.object(api, "token_store", tokens.CacheTokenStore())
+    def test_user_token_due_for_refresh_is_swapped_on_next_call(self, api_mock):
+        caches["default"].clear()
+        token_mock = api_mock.register_uri(
+            "POST", url(api.ACCESS_TOKEN_ENDPOINT), json=self.token("fresh")
+        )
+        grabbed_at = datetime.now() - timedelta(seconds=3600 - 60)
+        session = {"user_token": self.token("old", 3600, grabbed_at)}
+
+        token = api.ApiAccessToken().get_access_token(session=session)
+        self.wait_for_background_refresh()
+        next_token = api.ApiAccessToken().get_access_token(session=session)
+
+        self.assertEqual(token["access_token"], "old")
+        self.assertEqual(next_token["access_token"], "fresh")
+        self.assertEqual(tokens.Token.load(session["user_token"]), next_token)
+        self.assertEqual(
+            token_mock.last_request.text,
+            "refresh_token=refresh-old&grant_type=refresh_token",
+        )
+        self.assertEqual(api.token_store._tokens, {})
+        self.assertEqual(api.token_store._locks, {})
+
+    @mock()
+    def test_user_token_is_not_refreshed_ahead_into_a_local_store(self, api_mock):
+        token_mock = api_mock.register_uri(
+            "POST", url(api.ACCESS_TOKEN_ENDPOINT), json=self.token("fresh")
+        )
+        grabbed_at = datetime.now() - timedelta(seconds=3600 - 60)
+        session = {"user_token": self.token("old", 3600, grabbed_at)}
+
+        token = api.ApiAccessToken().get_access_token(session=session)
+        self.wait_for_background_refresh()
+
+        self.assertEqual(token["access_token"], "old")
+        self.assertEqual(token_mock.call_count, 0)
+        self.assertEqual(api.token_store._tokens, {})
+
+    @mock()
+    def test_unauthorized_response_is_retried_once_with_a_new_token(self, api_mock):
+        token_mock = api_mock.register_uri(
+            "POST",
+            url(api.ACCESS_TOKEN_ENDPOINT),
+            [{"json": self.token("first")}, {"json": self.token("second")}],
+        )
+        data_mock = api_mock.register_uri(
+            "GET", url("/things/"), status_code=401, json={"detail": "expired"}
+        )
+
+        result = api.fetch("/things/", max_retry=3)
+
+        self.assertFalse(result.ok)
+        self.assertEqual(result.error_code, 401)
+        self.assertEqual(data_mock.call_count, 2)
+        self.assertEqual(token_mock.call_count, 2)
+        self.assertEqual(
+            data_mock.request_history[1].headers["Authorization"], "Bearer second"
+        )
+
+
+@skipUnless(transport.httpx, "httpx is not installed")
+class AsyncApiTests(SiteTokenMixin, TestCase):
+    def mock_upstream(self, handler):
+        client = transport.httpx.AsyncClient(
+            transport=transport.httpx.MockTransport(handler)
+        )
+        return patch.object(transport, "get_async_client", return_value=client)
+
+    async def test_afetch_returns_upstream_data(self):
+        def handler(request):
+            self.assertEqual(request.headers["Authorization"], "Bearer site")
+            return transport.httpx.Response(200, json={"name": "thing"})
+
+        with self.mock_upstream(handler):
+            result = await api.afetch("/things/")
+
+        self.assertTrue(result.ok)
+        self.assertEqual(result.data, {"name": "thing"})
+
+    async def test_apost_reports_upstream_errors(self):
+        def handler(request):
+            return transport.httpx.Response(400, json={"errors": ["bad"]})
+
+        with self.mock_upstream(handler):
+            result = await api.apost("/things/", data={"name": "thing"})
+
+        self.assertFalse(result.ok)
+        self.assertEqual(result.error_code, 400)
+        self.assertEqual(result.data, {"errors": ["bad"]})
+
+    async def test_network_errors_use_network_error_code(self):
+        def handler(request):
+            raise transport.httpx.ConnectError("refused")
+
+        with self.mock_upstream(handler):
+            result = await api.adelete("/things/1/")
+
+        self.assertEqual(result.error_code, api.NETWORK_ERROR_CODE)
+        self.assertEqual(result.data["error_code"], "NETWORK_ERROR")
+
+    async def test_aapify_forwards_get_requests(self):
+        def handler(request):
+            self.assertEqual(request.url.params["page"], "2")
+            return transport.httpx.Response(200, json={"results": []})
+
+        request = AsyncRequestFactory().get("/things/", {"page": 2})
+        with self.mock_upstream(handler):
+            response = await views.aapify(request, "things")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content), {"results": []})
+
+    async def test_aget_access_token_reads_a_database_session(self):
+        stored = SessionStore()
+        stored["site_token"] = {"access_token": "from-session", "expires_in": 600}
+        await stored.asave()
+
+        session = SessionStore(session_key=stored.session_key)
+        token = await api.ApiAccessToken().aget_access_token(session=session)
+
+        self.assertEqual(token["access_token"], "from-session")
+
+    async def test_aauthenticate_creates_user_from_profile(self):
+        profile = {
+            "username": "tester",
+            "first_name": "Test",
+            "last_name": "User",
+            "email": "tester@example.com",
+        }
+
+        def handler(request):
+            self.assertEqual(request.headers["Authorization"], "Bearer user")
+            return transport.httpx.Response(200, json=profile)
+
+        with requests_mock.Mocker() as api_mock, self.mock_upstream(handler):
+            token_mock = api_mock.register_uri(
+                "POST",
+                url(api.ACCESS_TOKEN_ENDPOINT),
+                json={"access_token": "user", "refresh_token": "r", "expires_in": 600},
+            )
+            user = await api.RemoteBackend().aauthenticate(
+                None, username="tester", password="secret"
+            )
+
+        self.assertEqual(token_mock.call_count, 1)
+        self.assertEqual(user.username, "tester")
+        self.assertEqual(user.email, "tester@example.com")
+
+    @override_settings(
+        CACHES={
+            "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+            "profiles": {
+                "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+                "LOCATION": "remoteauth_profiles",
+            },
+        }
+    )
+    async def test_aauthenticate_caches_profiles_in_a_database_cache(self):
+        await sync_to_async(call_command)("createcachetable", "remoteauth_profiles")
+        profile = {"username": "tester", "email": "tester@example.com"}
+
+        def handler(request):
+            return transport.httpx.Response(200, json=profile)
+
+        cache = profiles.DjangoProfileCache(alias="profiles")
+        with requests_mock.Mocker() as api_mock, self.mock_upstream(handler):
+            api_mock.register_uri(
+                "POST",
+                url(api.ACCESS_TOKEN_ENDPOINT),
+                json={"access_token": "user", "refresh_token": "r", "expires_in": 600},
+            )
+            with patch.object(profiles, "cache", cache), patch.object(
+                profiles, "PROFILE_CACHE_TTL", 60
+            ):
+                for _ in range(2):
+                    user = await api.RemoteBackend().aauthenticate(
+                        None, username="tester", password="secret"
+                    )
+
+        self.assertEqual(user.username, "tester")
+        self.assertEqual(await cache.aget("username:tester"), profile)
+
+
+class ProfileTests(TestCase):
+    profile = {
+        "username": "tester",
+        "first_name": "Test",
+        "last_name": "User",
+        "email": "tester@example.com",
+    }
+
+    def setUp(self):
+        profiles.cache.clear()
+
+    def login(self, api_mock, profile=None):
+        api_mock.register_uri(
+            "POST",
+            url(api.ACCESS_TOKEN_ENDPOINT),
+            json={"access_token": "user", "refresh_token": "r", "expires_in": 600},
+        )
+        profile_mock = api_mock.register_uri(
+            "GET", url(api.USER_PROFILE_ENDPOINT), json=profile or self.profile
+        )
+        user = api.RemoteBackend().authenticate(
+            None, username="tester", password="secret"
+        )
+        return user, profile_mock
+
+    @mock()
+    def test_profile_is_fetched_on_every_login_by_default(self, api_mock):
+        self.login(api_mock)
+        _, profile_mock = self.login(api_mock)
+
+        self.assertEqual(profile_mock.call_count, 1)
+
+    @mock()
+    @patch.object(profiles, "PROFILE_CACHE_TTL", 60)
+    def test_repeat_logins_reuse_cached_profile(self, api_mock):
+        first, first_mock = self.login(api_mock)
+        second, second_mock = self.login(
+            api_mock, dict(self.profile, email="changed@example.com")
+        )
+
+        self.assertEqual(first_mock.call_count, 1)
+        self.assertEqual(second_mock.call_count, 0)
+        self.assertEqual(second.pk, first.pk)
+        self.assertEqual(second.email, "tester@example.com")
+
+    @mock()
+    def test_changed_profile_fields_are_written_back(self, api_mock):
+        self.login(api_mock)
+        user, _ = self.login(api_mock, dict(self.profile, last_name="Renamed"))
+
+        user.refresh_from_db()
+        self.assertEqual(user.last_name, "Renamed")
+        self.assertEqual(user.email, "tester@example.com")
+
+    def test_unchanged_user_is_not_written(self):
+        user = User.objects.create_user(**self.profile)
+
+        with self.assertNumQueries(1):
+            synced = profiles.sync_user("tester", self.profile)
+
+        self.assertEqual(synced.pk, user.pk)
+
+    @mock()
+    def test_relogin_with_a_mixed_case_email_domain_writes_nothing(self, api_mock):
+        profile = dict(self.profile, email="tester@Example.COM")
+        self.login(api_mock, profile)
+
+        with CaptureQueriesContext(connection) as queries:
+            user, _ = self.login(api_mock, profile)
+
+        self.assertEqual(user.email, "tester@example.com")
+        self.assertFalse(
+            [query for query in queries if query["sql"].startswith("UPDATE")]
+        )
+
+    def test_bulk_sync_compares_normalized_emails(self):
+        User.objects.create_user(**self.profile)
+
+        created, updated = profiles.sync_users(
+            [dict(self.profile, email="tester@Example.COM")]
+        )
+
+        self.assertEqual((created, updated), (0, 0))
+
+    def test_only_changed_fields_are_saved(self):
+        user = User.objects.create_user(**self.profile)
+
+        with patch.object(User, "save") as save:
+            fields = profiles.update_user(user, dict(self.profile, email="new@x.org"))
+
+        self.assertEqual(fields, ["email"])
+        save.assert_called_once_with(update_fields=["email"])
+
+
+@skipUnless(jwks.jwt is not None, "PyJWT is not installed")
+class JwtValidationTests(TestCase):
+    jwks_url = "https://issuer.example.com/jwks.json"
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        from cryptography.hazmat.primitives.asymmetric import rsa
+
+        cls.keys = {
+            kid: rsa.generate_private_key(public_exponent=65537, key_size=2048)
+            for kid in ("first", "second")
+        }
+
+    def setUp(self):
+        api.token_store.clear()
+        key_set = patch.object(jwks, "_key_set", jwks.KeySet(url=self.jwks_url))
+        self.key_set = key_set.start()
+        self.addCleanup(key_set.stop)
+
+    def jwk(self, kid):
+        jwk = jwks.jwt.algorithms.RSAAlgorithm.to_jwk(
+            self.keys[kid].public_key(), as_dict=True
+        )
+        return dict(jwk, kid=kid, alg="RS256", use="sig")
+
+    def register_jwks(self, api_mock, *kids):
+        return api_mock.register_uri(
+            "GET", self.jwks_url, json={"keys": [self.jwk(kid) for kid in kids]}
+        )
+
+    def access_token(self, kid="first", **claims):
+        claims = dict(
+            {
+                "preferred_username": "tester",
+                "given_name": "Test",
+                "family_name": "User",
+                "email": "tester@example.com",
+                "roles": ["editor"],
+                "exp": int(time.time()) + 600,
+            },
+            **claims,
+        )
+        return jwks.jwt.encode(
+            claims, self.keys[kid], algorithm="RS256", headers={"kid": kid}
+        )
+
+    @mock()
+    def test_login_reads_profile_from_claims(self, api_mock):
+        jwks_mock = self.register_jwks(api_mock, "first")
+        api_mock.register_uri(
+            "POST",
+            url(api.ACCESS_TOKEN_ENDPOINT),
+            json={"access_token": self.access_token(), "expires_in": 600},
+        )
+        profile_mock = api_mock.register_uri(
+            "GET", url(api.USER_PROFILE_ENDPOINT), json={}
+        )
+
+        with patch.object(jwks, "JWT_VALIDATION", True):
+            for _ in range(2):
+                user = api.RemoteBackend().authenticate(
+                    None, username="tester", password="secret"
+                )
+
+        self.assertEqual(user.email, "tester@example.com")
+        self.assertEqual(user.last_name, "User")
+        self.assertEqual(profile_mock.call_count, 0)
+        self.assertEqual(jwks_mock.call_count, 1)
+
+    @mock()
+    def test_invalid_tokens_are_rejected(self, api_mock):
+        self.register_jwks(api_mock, "first")
+        expired = self.access_token(exp=int(time.time()) - 60)
+        # Signed with a key the issuer never published
+        forged = jwks.jwt.encode(
+            {"roles": ["admin"], "exp": int(time.time()) + 600},
+            self.keys["second"],
+            algorithm="RS256",
+            headers={"kid": "first"},
+        )
+
+        self.assertIsNone(jwks.verify(expired))
+        self.assertIsNone(jwks.verify(forged))
+        self.assertIsNone(jwks.verify("not-a-jwt"))
+        self.assertEqual(jwks.verify(self.access_token())["roles"], ["editor"])
+
+    @mock()
+    def test_rotated_keys_are_fetched_again(self, api_mock):
+        self.register_jwks(api_mock, "first")
+        self.assertIsNotNone(jwks.verify(self.access_token()))
+        jwks_mock = self.register_jwks(api_mock, "first", "second")
+
+        with patch.object(self.key_set, "min_refresh_interval", 0):
+            claims = jwks.verify(self.access_token(kid="second"))
+
+        self.assertEqual(claims["preferred_username"], "tester")
+        self.assertEqual(jwks_mock.call_count, 1)
+
+    @mock()
+    def test_unknown_keys_do_not_refetch_within_the_interval(self, api_mock):
+        self.register_jwks(api_mock, "first")
+        self.assertIsNotNone(jwks.verify(self.access_token()))
+        jwks_mock = self.register_jwks(api_mock, "first", "second")
+
+        self.assertIsNone(jwks.verify(self.access_token(kid="second")))
+        self.assertEqual(jwks_mock.call_count, 0)
+
+
+class SyncUsersCommandTests(TestCase):
+    def setUp(self):
+        api.token_store.clear()
+
+    def user(self, username, **fields):
+        return dict(
+            {
+                "username": username,
+                "first_name": username.title(),
+                "last_name": "Remote",
+                "email": f"{username}@example.com",
+            },
+            **fields,
+        )
+
+    def register_pages(self, api_mock):
+        api_mock.register_uri(
+            "POST",
+            url(api.ACCESS_TOKEN_ENDPOINT),
+            json={"access_token": "site", "expires_in": 36000},
+        )
+        api_mock.register_uri(
+            "GET",
+            url("/users/"),
+            json={
+                "results": [self.user("alice"), self.user("bob")],
+                "next": url("/users/?cursor=2"),
+            },
+        )
+        return api_mock.register_uri(
+            "GET",
+            url("/users/?cursor=2"),
+            json={
+                "results": [self.user("carol", last_name="Renamed")],
+                "next": None,
+            },
+        )
+
+    def sync(self, *args):
+        out = io.StringIO()
+        call_command("remoteauth_sync_users", *args, stdout=out)
+        return out.getvalue()
+
+    @mock()
+    def test_users_are_created_and_updated_in_bulk(self, api_mock):
+        self.register_pages(api_mock)
+        User.objects.create_user(**self.user("carol"))
+        User.objects.create_user(**self.user("bob"))
+
+        output = self.sync("--batch-size", "1")
+
+        self.assertIn("Created 1 and updated 1 users", output)
+        self.assertEqual(
+            sorted(User.objects.values_list("username", flat=True)),
+            ["alice", "bob", "carol"],
+        )
+        self.assertEqual(User.objects.get(username="carol").last_name, "Renamed")
+        self.assertFalse(User.objects.get(username="alice").has_usable_password())
+
+    @mock()
+    def test_dry_run_writes_nothing(self, api_mock):
+        self.register_pages(api_mock)
+
+        output = self.sync("--dry-run")
+
+        self.assertIn("Would create 3 and update 0 users", output)
+        self.assertFalse(User.objects.exists())
+
+    @mock()
+    def test_sync_resumes_from_cursor_file(self, api_mock):
+        self.register_pages(api_mock)
+        api_mock.register_uri("GET", url("/users/?cursor=2"), status_code=404)
+
+        with tempfile.TemporaryDirectory() as directory:
+            cursor_file = os.path.join(directory, "cursor")
+            with self.assertRaises(CommandError):
+                self.sync("--cursor-file", cursor_file)
+            with open(cursor_file) as file:
+                self.assertEqual(file.read(), "/users/?cursor=2")
+
+            api_mock.register_uri(
+                "GET",
+                url("/users/?cursor=2"),
+                json={"results": [self.user("carol")], "next": None},
+            )
+            output = self.sync("--cursor-file", cursor_file)
+
+            self.assertFalse(os.path.exists(cursor_file))
+        self.assertIn("Created 1 and updated 0 users", output)
+        self.assertEqual(User.objects.count(), 3)
+
+
+class GlobalRequestMiddlewareTests(TestCase):
+    def request(self):
+        request = RequestFactory().get("/")
+        request.session = {}
+        return request
+
+    def test_request_is_available_while_the_view_runs(self):
+        request = self.request()
+
+        def view(request):
+            self.assertIs(api.get_request(), request)
+            self.assertIs(api.get_request_session(), request.session)
+            return HttpResponse()
+
+        api.GlobalRequestMiddleware(view)(request)
+
+        self.assertIsNone(api.get_request())
+
+    def test_state_is_cleared_when_the_view_raises(self):
+        def view(request):
+            raise ValueError("broken view")
+
+        with self.assertRaises(ValueError):
+            api.GlobalRequestMiddleware(view)(self.request())
+
+        self.assertIsNone(api.get_request_context())
+
+    def test_login_is_moved_into_the_session(self):
+        request = self.request()
+
+        def view(request):
+            api.RemoteBackend()._keep_login({"access_token": "t"}, {"roles": []})
+            return HttpResponse()
+
+        api.GlobalRequestMiddleware(view)(request)
+
+        self.assertEqual(request.session["user_token"], {"access_token": "t"})
+        self.assertEqual(request.session["user_profile"], {"roles": []})
+
+    async def test_concurrent_async_requests_keep_their_own_state(self):
+        async def view(request):
+            await asyncio.sleep(0.01)
+            self.assertIs(api.get_request(), request)
+            return HttpResponse()
+
+        middleware = api.GlobalRequestMiddleware(view)
+        await asyncio.gather(*[middleware(self.request()) for _ in range(10)])
+
+        self.assertIsNone(api.get_request())
+
+
+class RoleTests(TestCase):
+    def run_in_request(self, check, roles=("Editor", "viewer")):
+        request = RequestFactory().get("/")
+        request.session = {"user_profile": {"roles": list(roles)}}
+        results = []
+
+        def view(request):
+            results.append(check(request))
+            return HttpResponse()
+
+        api.GlobalRequestMiddleware(view)(request)
+        return results[0]
+
+    def test_roles_are_indexed_once_per_request(self):
+        def check(request):
+            return roles.roles_of(request), roles.roles_of(request)
+
+        first, second = self.run_in_request(check)
+
+        self.assertEqual(first, frozenset({"editor", "viewer"}))
+        self.assertIs(first, second)
+
+    def test_index_follows_a_new_profile(self):
+        def check(request):
+            roles.roles_of(request)
+            request.session["user_profile"] = {"roles": ["admin"]}
+            return roles.roles_of(request)
+
+        self.assertEqual(self.run_in_request(check), frozenset({"admin"}))
+
+    def test_has_perm_matches_roles_exactly(self):
+        user = User(username="tester")
+        backend = api.RemoteBackend()
+
+        def check(request):
+            return (
+                backend.has_perm(user, "Editor"),
+                backend.has_perm(user, "editor"),
+                backend.has_perm(user, "admin"),
+            )
+
+        self.assertEqual(self.run_in_request(check), (True, False, False))
+
+    def test_in_any_of_the_roles(self):
+        is_editor = require.in_any_of_the_roles(["EDITOR", "author"])
+        is_admin = require.in_any_of_the_roles(["admin"])
+        anyone = require.in_any_of_the_roles([])
+
+        def check(request):
+            return is_editor(None), is_admin(None), anyone(None)
+
+        self.assertEqual(self.run_in_request(check), (True, False, False))
+        self.assertEqual(self.run_in_request(check, roles=()), (False, False, True))
+
+
+class FanOutTests(SiteTokenMixin, TestCase):
+    def test_fetch_many_runs_calls_concurrently_in_order(self):
+        calls = []
+
+        def slow_upstream(method, url, **kwargs):
+            calls.append(url)
+            time.sleep(0.2)
+            response = Response()
+            response.status_code = 200
+            response._content = json.dumps({"url": url}).encode()
+            return response
+        started = time.monotonic()
+        with patch.object(transport, "request", side_effect=slow_upstream):
+            results = api.fetch_many([f"/items/{n}/" for n in range(5)])
+
+        self.assertLess(time.monotonic() - started, 0.6)
+        self.assertEqual(
+            [r.data["url"] for r in results],
+            [url(f"/items/{n}/") for n in range(5)],
+        )
+        self.assertEqual(len(calls), 5)
+
+    @mock()
+    def test_gather_mixes_verbs_and_keeps_request_context(self, api_mock):
+        api_mock.register_uri("GET", url("/items/"), json=[])
+        api_mock.register_uri("POST", url("/items/"), json={"id": 1})
+        api_mock.register_uri("DELETE", url("/items/1/"), status_code=204)
+        session = {
+            "site_token": {
+                "access_token": "from-session",
+                "expires_in": 36000,
+                "timestamp": datetime.now().strftime(api.ISO_DATE_FORMAT),
+            }
+        }
+        request = RequestFactory().get("/")
+        request.session = session
+        seen_requests = []
+
+        def check_context(path):
+            seen_requests.append(api.get_request())
+            return api.fetch(path)
+
+        reset_token = api._request_context.set({"request": request})
+        try:
+            results = api.gather(
+                (check_context, "/items/"),
+                (api.post, "/items/", {"name": "item"}),
+                (api.delete, "/items/1/"),
+            )
+        finally:
+            api._request_context.reset(reset_token)
+
+        self.assertEqual([r.ok for r in results], [True, True, True])
+        self.assertEqual(results[1].data, {"id": 1})
+        self.assertEqual(seen_requests, [request])
+        self.assertTrue(
+            all(
+                r.headers["Authorization"] == "Bearer from-session"
+                for r in api_mock.request_history
+            )
+        )
+
+
+class PaginationTests(SiteTokenMixin, TestCase):
+    @mock()
+    def test_items_follow_next_links(self, api_mock):
+        api_mock.register_uri(
+            "GET",
+            url("/items/"),
+            json={"results": [1, 2], "next": url("/items/?page=2")},
+        )
+        api_mock.register_uri(
+            "GET", url("/items/?page=2"), json={"results": [3], "next": "?page=3"}
+        )
+        api_mock.register_uri(
+            "GET", url("/items/?page=3"), json={"results": [4], "next": None}
+        )
+
+        self.assertEqual(list(api.iter_pages("/items/")), [1, 2, 3, 4])
+
+    @mock()
+    def test_root_relative_links_are_resolved_against_the_api(self, api_mock):
+        api_path = urlsplit(url("/items/?page=2"))
+        api_mock.register_uri(
+            "GET",
+            url("/items/"),
+            json={"results": [1], "next": f"{api_path.path}?{api_path.query}"},
+        )
+        api_mock.register_uri("GET", url("/items/?page=2"), json={"results": [2]})
+
+        self.assertEqual(list(api.iter_pages("/items/")), [1, 2])
+
+    @mock()
+    def test_cursors_and_offsets_are_sent_as_query_parameters(self, api_mock):
+        api_mock.register_uri(
+            "GET", url("/items/?limit=2"), json={"results": [1], "next": "abc"}
+        )
+        api_mock.register_uri(
+            "GET", url("/items/?limit=2&cursor=abc"), json={"results": [2]}
+        )
+        api_mock.register_uri("GET", url("/rows/?limit=2"), json=[1, 2])
+        api_mock.register_uri("GET", url("/rows/?limit=2&offset=2"), json=[3])
+
+        self.assertEqual(list(api.iter_pages("/items/?limit=2")), [1, 2])
+        self.assertEqual(
+            list(api.iter_pages("/rows/?limit=2", offset_param="offset", page_size=2)),
+            [1, 2, 3],
+        )
+
+    @mock()
+    def test_next_page_is_read_ahead(self, api_mock):
+        requested = threading.Event()
+
+        def second_page(request, context):
+            requested.set()
+            return {"results": [2]}
+
+        api_mock.register_uri(
+            "GET", url("/items/"), json={"results": [1], "next": "/items/?page=2"}
+        )
+        api_mock.register_uri("GET", url("/items/?page=2"), json=second_page)
+
+        items = api.iter_pages("/items/")
+        self.assertEqual(next(items), 1)
+        self.assertTrue(requested.wait(2))
+        self.assertEqual(list(items), [2])
+
+    @mock()
+    def test_failed_page_raises_with_its_path(self, api_mock):
+        api_mock.register_uri(
+            "GET", url("/items/"), json={"results": [1], "next": "/items/?page=2"}
+        )
+        api_mock.register_uri("GET", url("/items/?page=2"), status_code=404)
+
+        items = api.iter_pages("/items/", read_ahead=False)
+        self.assertEqual(next(items), 1)
+        with self.assertRaises(pagination.PageError) as raised:
+            next(items)
+        self.assertEqual(raised.exception.path, "/items/?page=2")
+        self.assertEqual(raised.exception.results.error_code, 404)
+
+
+class ResponseCacheTests(TestCase):
+    def setUp(self):
+        api.token_store.clear()
+        api.responses.clear()
+        self.session = {"site_token": self.token("site")}
+        self.request = RequestFactory().get("/")
+        self.request.session = self.session
+        self.reset_token = api._request_context.set({"request": self.request})
+
+    def tearDown(self):
+        api._request_context.reset(self.reset_token)
+
+    def token(self, access_token):
+        return {
+            "access_token": access_token,
+            "expires_in": 36000,
+            "timestamp": datetime.now().strftime(api.ISO_DATE_FORMAT),
+        }
+
+    @mock()
+    def test_fresh_response_is_served_from_cache(self, api_mock):
+        data_mock = api_mock.register_uri("GET", url("/countries/"), json=["GH"])
+
+        first = api.fetch("/countries/", cache_ttl=60)
+        first.data.append("mutated by caller")
+        second = api.fetch("/countries/", cache_ttl=60)
+
+        self.assertEqual(second.data, ["GH"])
+        self.assertEqual(data_mock.call_count, 1)
+
+    @mock()
+    def test_users_do_not_share_cached_responses(self, api_mock):
+        data_mock = api_mock.register_uri("GET", url("/me/"), json={})
+
+        api.fetch("/me/", cache_ttl=60)
+        self.session["site_token"] = self.token("someone-else")
+        api.fetch("/me/", cache_ttl=60)
+
+        self.assertEqual(data_mock.call_count, 2)
+
+    @mock()
+    def test_stale_response_is_revalidated_with_etag(self, api_mock):
+        data_mock = api_mock.register_uri(
+            "GET",
+            url("/countries/"),
+            [
+                {"json": ["GH"], "headers": {"ETag": '"v1"'}},
+                {"status_code": 304, "headers": {"ETag": '"v1"'}},
+            ],
+        )
+
+        api.fetch("/countries/", cache_ttl=0)
+        result = api.fetch("/countries/", cache_ttl=0)
+
+        self.assertTrue(result.ok)
+        self.assertEqual(result.data, ["GH"])
+        self.assertEqual(data_mock.last_request.headers["If-None-Match"], '"v1"')
+
+    @mock()
+    def test_no_store_responses_are_not_cached(self, api_mock):
+        data_mock = api_mock.register_uri(
+            "GET", url("/otp/"), json={}, headers={"Cache-Control": "no-store"}
+        )
+
+        api.fetch("/otp/", cache_ttl=60)
+        api.fetch("/otp/", cache_ttl=60)
+
+        self.assertEqual(data_mock.call_count, 2)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = response_cache.LocalResponseCache(max_entries=2)
+        cache.set("a", "entry-a")
+        cache.set("b", "entry-b")
+        cache.get("a")
+        cache.set("c", "entry-c")
+
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), "entry-a")
+
+
+class CoalescingTests(SiteTokenMixin, TestCase):
+    def slow_upstream(self, method, url, **kwargs):
+        time.sleep(0.2)
+        response = Response()
+        response.status_code = 200
+        response._content = b'{"items": []}'
+        return response
+
+    def fetch_concurrently(self, count, **kwargs):
+        results = []
+        threads = [
+            Thread(target=lambda: results.append(api.fetch("/items/", **kwargs)))
+            for _ in range(count)
+        ]
+        with patch.object(
+            transport, "request", side_effect=self.slow_upstream
+        ) as request_mock:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        return results, request_mock
+
+    def test_identical_gets_share_one_request(self):
+        before = api.inflight_gets.stats()
+        results, request_mock = self.fetch_concurrently(5, coalesce=True)
+        after = api.inflight_gets.stats()
+
+        self.assertEqual(request_mock.call_count, 1)
+        self.assertEqual(after["coalesced"] - before["coalesced"], 4)
+        self.assertTrue(all(r.data == {"items": []} for r in results))
+        results[0].data["items"].append("mutated by caller")
+        self.assertEqual(results[1].data, {"items": []})
+
+    def test_gets_are_not_coalesced_by_default(self):
+        results, request_mock = self.fetch_concurrently(3)
+
+        self.assertEqual(request_mock.call_count, 3)
+
+
+class GraphQLTests(SiteTokenMixin, TestCase):
+    query = "query Countries { countries { code } }"
+
+    def setUp(self):
+        super().setUp()
+        api.responses.clear()
+
+    def answer(self, body):
+        return {"data": {"echo": body.get("variables")}}
+
+    def register_server(self, api_mock, known_hashes=None):
+        def respond(request, context):
+            body = request.json()
+            batch = body if isinstance(body, list) else [body]
+            answers = []
+            for operation in batch:
+                persisted = operation.get("extensions", {}).get("persistedQuery")
+                if persisted and "query" not in operation:
+                    if persisted["sha256Hash"] not in known_hashes:
+                        answers.append(
+                            {"errors": [{"message": "PersistedQueryNotFound"}]}
+                        )
+                        continue
+                elif persisted:
+                    known_hashes.add(persisted["sha256Hash"])
+                answers.append(self.answer(operation))
+            return answers if isinstance(body, list) else answers[0]
+
+        return api_mock.register_uri("POST", url("/graphql/"), json=respond)
+
+    def test_read_only_operations_are_recognised(self):
+        self.assertTrue(graphql.is_read_only("{ countries { code } }"))
+        self.assertTrue(graphql.is_read_only(self.query))
+        self.assertFalse(graphql.is_read_only("mutation { vote(id: 1) { id } }"))
+        self.assertFalse(
+            graphql.is_read_only("# list\nsubscription { votes { id } }")
+        )
+
+    @mock()
+    def test_operations_are_batched_in_one_post(self, api_mock):
+        graphql_mock = self.register_server(api_mock)
+
+        results = api.graphiQl_many(
+            "/graphql/", [(self.query, {"n": 1}), (self.query, {"n": 2})]
+        )
+
+        self.assertEqual(
+            [r.data["data"]["echo"] for r in results], [{"n": 1}, {"n": 2}]
+        )
+        self.assertEqual(graphql_mock.call_count, 1)
+        self.assertEqual(
+            graphql_mock.last_request.json()[0],
+            {"query": self.query, "variables": {"n": 1}},
+        )
+
+    @mock()
+    def test_single_operation_is_not_batched(self, api_mock):
+        graphql_mock = self.register_server(api_mock)
+
+        results = api.graphiQl("/graphql/", self.query)
+
+        self.assertTrue(results.ok)
+        self.assertEqual(graphql_mock.last_request.json(), {"query": self.query})
+
+    @mock()
+    @patch.object(graphql, "GRAPHQL_PERSISTED_QUERIES", True)
+    def test_persisted_query_text_is_sent_once(self, api_mock):
+        graphql_mock = self.register_server(api_mock, known_hashes=set())
+        mutation = "mutation { vote { id } }"
+
+        first = api.graphiQl_many("/graphql/", [self.query, mutation])
+        sent = [request.json() for request in graphql_mock.request_history]
+        second = api.graphiQl("/graphql/", self.query)
+
+        self.assertTrue(all(r.ok and "data" in r.data for r in first + [second]))
+        self.assertNotIn("query", sent[0][0])
+        self.assertEqual(
+            [operation["query"] for operation in sent[1]], [self.query, mutation]
+        )
+        self.assertEqual(graphql_mock.call_count, 3)
+        self.assertNotIn("query", graphql_mock.last_request.json())
+
+    @mock()
+    def test_read_only_results_are_cached(self, api_mock):
+        graphql_mock = self.register_server(api_mock)
+        mutation = "mutation { vote { id } }"
+
+        for _ in range(2):
+            results = api.graphiQl_many(
+                "/graphql/",
+                [(self.query, {"a": 1, "b": 2}), mutation],
+                cache_ttl=60,
+            )
+        cached = api.graphiQl(
+            "/graphql/", self.query, variables={"b": 2, "a": 1}, cache_ttl=60
+        )
+
+        self.assertEqual(cached.data, {"data": {"echo": {"a": 1, "b": 2}}})
+        self.assertEqual(results[0].data, cached.data)
+        self.assertEqual(
+            [request.json() for request in graphql_mock.request_history[1:]],
+            [{"query": mutation}],
+        )
+
+
+class CodecTests(TestCase):
+    body = b'[{"id": 1, "name": "caf\\u00e9"}]'
+
+    def setUp(self):
+        api.token_store.clear()
+
+    def mock_upstream(self, api_mock):
+        api_mock.register_uri(
+            "POST",
+            url(api.ACCESS_TOKEN_ENDPOINT),
+            json={"access_token": "site", "expires_in": 36000},
+        )
+        return api_mock.register_uri(
+            requests_mock.ANY,
+            url("/things/?"),
+            content=self.body,
+            headers={"Content-Type": "application/json; charset=utf-8"},
+        )
+
+    def test_codecs_round_trip(self):
+        value = {"when": datetime(2024, 1, 2, 3, 4, 5), "items": [1, "two", None]}
+        codecs = [codec.StdlibCodec()]
+        if codec.orjson is not None:
+            codecs.append(codec.OrjsonCodec())
+
+        for json_codec in codecs:
+            decoded = json_codec.loads(json_codec.dumps(value))
+            self.assertEqual(decoded["items"], [1, "two", None])
+            self.assertTrue(decoded["when"].startswith("2024-01-02T03:04:05"))
+            with self.assertRaises(ValueError):
+                json_codec.loads(b"{not json")
+
+    @skipIf(hasattr(settings, "API_JSON_CODEC"), "API_JSON_CODEC is set")
+    def test_stdlib_codec_is_the_default(self):
+        self.assertIsInstance(codec.get_codec(), codec.StdlibCodec)
+
+    @skipUnless(codec.orjson, "orjson is not installed")
+    def test_orjson_codec_encodes_like_the_stdlib_codec(self):
+        values = [
+            QueryDict("a=1&b=2&b=3"),
+            {"when": datetime(2024, 1, 2, 3, 4, 5, 678901, tzinfo=timezone.utc)},
+            {1: "a", "big": 2**70},
+        ]
+        for value in values:
+            self.assertEqual(
+                json.loads(codec.OrjsonCodec().dumps(value)),
+                json.loads(codec.StdlibCodec().dumps(value)),
+            )
+
+    @mock()
+    def test_raw_results_are_decoded_on_first_access(self, api_mock):
+        self.mock_upstream(api_mock)
+
+        results = api.fetch("/things/?", raw=True)
+
+        self.assertFalse(results.is_decoded)
+        self.assertEqual(results.raw, self.body)
+        self.assertEqual(results.data, [{"id": 1, "name": "café"}])
+        self.assertTrue(results.is_decoded)
+
+    @mock()
+    def test_apify_relays_upstream_bytes(self, api_mock):
+        self.mock_upstream(api_mock)
+
+        response = views.apify(RequestFactory().get("/things/"), "things")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, self.body)
+        self.assertEqual(response["Content-Type"], "application/json; charset=utf-8")
+
+    @mock()
+    def test_apify_forwards_json_bodies_as_sent(self, api_mock):
+        upstream = self.mock_upstream(api_mock)
+        body = b'{"name":  "spaced out"}'
+
+        request = RequestFactory().post(
+            "/things/", body, content_type="application/json"
+        )
+        response = views.apify(request, "things")
+
+        self.assertEqual(response.content, self.body)
+        self.assertEqual(upstream.last_request.body, body)
+        self.assertEqual(
+            upstream.last_request.headers["Content-Type"], "application/json"
+        )
+
+
+class StreamingProxyTests(SiteTokenMixin, TestCase):
+    @mock()
+    def test_upstream_body_and_headers_are_relayed(self, api_mock):
+        csv = b"id,name\n" + b"".join(b"%d,item\n" % n for n in range(10000))
+        api_mock.register_uri(
+            "GET",
+            url("/exports/?format=csv"),
+            content=csv,
+            headers={
+                "Content-Type": "text/csv",
+                "Content-Disposition": 'attachment; filename="items.csv"',
+                "X-Internal": "secret",
+            },
+        )
+        request = RequestFactory().get("/exports/", {"format": "csv"})
+
+        response = views.apify(request, "exports", stream=True)
+
+        self.assertTrue(response.streaming)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/csv")
+        self.assertIn("items.csv", response["Content-Disposition"])
+        self.assertFalse(response.has_header("X-Internal"))
+        self.assertEqual(b"".join(response.streaming_content), csv)
+
+    @mock()
+    def test_upstream_errors_keep_their_status(self, api_mock):
+        api_mock.register_uri(
+            "POST",
+            url("/items/?"),
+            status_code=422,
+            json={"errors": ["name is required"]},
+        )
+        request = RequestFactory().post(
+            "/items/", data=b"{}", content_type="application/json"
+        )
+
+        response = views.apify(request, "items", stream=True)
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(api_mock.last_request.body, b"{}")
+        self.assertEqual(
+            api_mock.last_request.headers["Content-Type"], "application/json"
+        )
+        self.assertEqual(
+            json.loads(b"".join(response.streaming_content)),
+            {"errors": ["name is required"]},
+        )
+
+
+class UploadTests(SiteTokenMixin, TestCase):
+    def parse_multipart(self, body, content_type):
+        request = RequestFactory().generic(
+            "POST", "/", data=b"".join(body), content_type=content_type
+        )
+        return request.POST, request.FILES
+
+    def test_multipart_body_is_produced_in_chunks(self):
+        upload = SimpleUploadedFile("report.csv", b"x" * 10000, "text/csv")
+        body = multipart.MultipartBody(
+            fields={"title": "Report", "tags": ["a", "b"], "meta": {"pages": 2}},
+            files={"file": upload},
+            chunk_size=1024,
+        )
+
+        self.assertGreater(len(list(body)), 10)
+        fields, files = self.parse_multipart(body, body.content_type)
+        self.assertEqual(fields["title"], "Report")
+        self.assertEqual(fields.getlist("tags"), ["a", "b"])
+        self.assertEqual(fields["meta"], '{"pages": 2}')
+        self.assertEqual(files["file"].name, "report.csv")
+        self.assertEqual(files["file"].read(), b"x" * 10000)
+
+    @mock()
+    def test_post_with_files_streams_fields_and_files(self, api_mock):
+        api_mock.register_uri("POST", url("/documents/"), json={"id": 1})
+
+        result = api.post(
+            "/documents/",
+            data={"title": "Report"},
+            files={"file": SimpleUploadedFile("report.txt", b"hello")},
+        )
+
+        self.assertTrue(result.ok)
+        sent = api_mock.last_request
+        self.assertEqual(sent.headers["Transfer-Encoding"], "chunked")
+        fields, files = self.parse_multipart(sent.body, sent.headers["Content-Type"])
+        self.assertEqual(fields["title"], "Report")
+        self.assertEqual(files["file"].read(), b"hello")
+
+    @mock()
+    def test_apify_relays_uploads_without_parsing_them(self, api_mock):
+        api_mock.register_uri("POST", url("/documents/?"), json={"id": 1})
+        client_body = encode_multipart(
+            BOUNDARY,
+            {"title": "Report", "file": SimpleUploadedFile("a.txt", b"hello")},
+        )
+        request = RequestFactory().generic(
+            "POST", "/documents/", data=client_body, content_type=MULTIPART_CONTENT
+        )
+
+        response = views.apify(request, "documents")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(hasattr(request, "_files"))
+        sent = api_mock.last_request
+        self.assertEqual(sent.headers["Content-Type"], request.META["CONTENT_TYPE"])
+        self.assertEqual(b"".join(sent.body), client_body)
+
+
+class ResilienceTests(SiteTokenMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        resilience.reset()
+
+    def tearDown(self):
+        resilience.reset()
+
+    def test_breaker_opens_on_failure_rate_and_recovers_after_probe(self):
+        breaker = resilience.CircuitBreaker(
+            "test", failure_rate=0.5, min_calls=4, reset_timeout=0.05
+        )
+        for failed in (False, True, True, True):
+            breaker.before_call()
+            breaker.record(failed=failed)
+
+        self.assertEqual(breaker.state, breaker.OPEN)
+        with self.assertRaises(resilience.CircuitOpenError):
+            breaker.before_call()
+
+        time.sleep(0.06)
+        breaker.before_call()
+        with self.assertRaises(resilience.CircuitOpenError):
+            breaker.before_call()
+        breaker.record(failed=False)
+        self.assertEqual(breaker.state, breaker.CLOSED)
+
+    @mock()
+    def test_open_circuit_fails_fast_with_network_error_code(self, api_mock):
+        data_mock = api_mock.register_uri("GET", url("/reports/1/"), json={})
+        breaker = resilience.CircuitBreaker("/reports/", min_calls=2)
+        resilience._breakers["/reports/"] = breaker
+        data_mock_500 = api_mock.register_uri(
+            "GET", url("/reports/2/"), status_code=503, text="unavailable"
+        )
+
+        api.fetch("/reports/2/")
+        api.fetch("/reports/2/")
+        result = api.fetch("/reports/1/")
+
+        self.assertEqual(data_mock_500.call_count, 2)
+        self.assertEqual(data_mock.call_count, 0)
+        self.assertEqual(result.error_code, api.NETWORK_ERROR_CODE)
+        self.assertEqual(result.data["error_code"], "CIRCUIT_OPEN")
+
+    def test_slow_calls_count_as_failures(self):
+        breaker = resilience.CircuitBreaker(
+            "slow", min_calls=1, slow_call_seconds=0.01
+        )
+        resilience._breakers["slow"] = breaker
+        response = Response()
+        response.status_code = 200
+
+        def slow_send():
+            time.sleep(0.02)
+            return response
+
+        resilience.call("http://upstream.test/", "slow", slow_send)
+
+        self.assertEqual(breaker.state, breaker.OPEN)
+
+    @patch.object(resilience, "BULKHEAD_MAX_CONCURRENT", 1)
+    @mock()
+    def test_full_bulkhead_rejects_calls_beyond_its_queue(self, api_mock):
+        data_mock = api_mock.register_uri("GET", url("/reports/"), json={})
+        host = urlsplit(api.BASE_URL).netloc
+        bulkhead = resilience.Bulkhead(host, max_concurrent=1, max_waiting=0)
+        resilience._bulkheads[host] = bulkhead
+        bulkhead.acquire()
+        try:
+            result = api.fetch("/reports/")
+        finally:
+            bulkhead.release()
+
+        self.assertEqual(data_mock.call_count, 0)
+        self.assertEqual(result.error_code, api.NETWORK_ERROR_CODE)
+        self.assertEqual(result.data["error_code"], "BULKHEAD_FULL")
+
+    @patch.object(resilience, "BULKHEAD_MAX_CONCURRENT", 1)
+    def test_probe_rejected_by_the_bulkhead_does_not_close_the_circuit(self):
+        breaker = resilience.CircuitBreaker("probe", min_calls=1, reset_timeout=0.01)
+        resilience._breakers["probe"] = breaker
+        bulkhead = resilience.Bulkhead("probe.test", max_concurrent=1, max_waiting=0)
+        resilience._bulkheads["probe.test"] = bulkhead
+        breaker.record(failed=True)
+        time.sleep(0.02)
+        bulkhead.acquire()
+        try:
+            with self.assertRaises(resilience.BulkheadFullError):
+                resilience.call("http://probe.test/", "probe", Response)
+        finally:
+            bulkhead.release()
+
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+        breaker.before_call()
+
+    @mock()
+    def test_login_fails_fast_when_the_profile_circuit_is_open(self, api_mock):
+        api_mock.register_uri(
+            "POST",
+            url(api.ACCESS_TOKEN_ENDPOINT),
+            json={"access_token": "user", "refresh_token": "r", "expires_in": 600},
+        )
+        profile_mock = api_mock.register_uri(
+            "GET", url(api.USER_PROFILE_ENDPOINT), json={"username": "tester"}
+        )
+        breaker = resilience.CircuitBreaker(api.USER_PROFILE_ENDPOINT, min_calls=1)
+        resilience._breakers[api.USER_PROFILE_ENDPOINT] = breaker
+        breaker.record(failed=True)
+
+        user = api.RemoteBackend().authenticate(
+            None, username="tester", password="secret"
+        )
+
+        self.assertIsNone(user)
+        self.assertEqual(profile_mock.call_count, 0)
+
+    @mock()
+    def test_concurrent_callers_beyond_the_limit_wait_for_a_slot(self, api_mock):
+        def slow_reports(request, context):
+            time.sleep(0.02)
+            return {}
+
+        api_mock.register_uri("GET", url("/reports/"), json=slow_reports)
+        host = urlsplit(api.BASE_URL).netloc
+        results = []
+
+        def fetch_all():
+            threads = [
+                Thread(target=lambda: results.append(api.fetch("/reports/")))
+                for _ in range(16)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        # No limit unless one is configured
+        fetch_all()
+        self.assertNotIn(host, resilience._bulkheads)
+
+        resilience._bulkheads[host] = resilience.Bulkhead(
+            host, max_concurrent=4, max_waiting=16, wait_timeout=2
+        )
+        with patch.object(resilience, "BULKHEAD_MAX_CONCURRENT", 4):
+            fetch_all()
+
+        self.assertEqual(len(results), 32)
+        self.assertTrue(all(result.ok for result in results))
+
+    async def test_async_callers_beyond_the_limit_wait_for_a_slot(self):
+        bulkhead = resilience.Bulkhead(
+            "async", max_concurrent=2, max_waiting=4, wait_timeout=1
+        )
+        in_flight = []
+
+        async def call():
+            await bulkhead.aacquire()
+            in_flight.append(len(in_flight))
+            await asyncio.sleep(0.01)
+            bulkhead.arelease()
+
+        await asyncio.gather(*[call() for _ in range(6)])
+        self.assertEqual(len(in_flight), 6)
+
+        with self.assertRaises(resilience.BulkheadFullError):
+            await asyncio.gather(*[call() for _ in range(7)])
+
+    @mock()
+    @patch.object(api, "MAX_ENDPOINTS", 3)
+    @patch.object(api, "_endpoints", set())
+    def test_proxied_paths_share_breakers_past_the_endpoint_limit(self, api_mock):
+        api_mock.register_uri("GET", requests_mock.ANY, json={})
+
+        for n in range(10):
+            views.apify(RequestFactory().get(f"/x{n}/"), f"x{n}")
+
+        self.assertEqual(
+            set(resilience._breakers), {"/x0/", "/x1/", "/x2/", api.OTHER_ENDPOINT}
+        )
+
+    def test_queued_call_gets_a_slot_when_one_is_released(self):
+        bulkhead = resilience.Bulkhead(
+            "queued", max_concurrent=1, max_waiting=1, wait_timeout=1
+        )
+        bulkhead.acquire()
+        Thread(target=lambda: (time.sleep(0.05), bulkhead.release())).start()
+
+        bulkhead.acquire()
+        bulkhead.release()
+
+
+@patch.object(retry.time, "sleep")
+class RetryTests(SiteTokenMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        resilience.reset()
+
+    @mock()
+    def test_idempotent_call_is_retried_with_backoff(self, sleep, api_mock):
+        data_mock = api_mock.register_uri(
+            "GET",
+            url("/reports/"),
+            [{"status_code": 503, "text": "busy"}, {"json": {"id": 1}}],
+        )
+
+        result = api.fetch("/reports/")
+
+        self.assertTrue(result.ok)
+        self.assertEqual(data_mock.call_count, 2)
+        self.assertEqual(sleep.call_count, 1)
+        self.assertLessEqual(sleep.call_args[0][0], retry.RETRY_BACKOFF)
+
+    @mock()
+    def test_post_is_only_retried_with_an_idempotency_key(self, sleep, api_mock):
+        data_mock = api_mock.register_uri(
+            "POST",
+            url("/orders/"),
+            [
+                {"status_code": 502, "text": "bad gateway"},
+                {"status_code": 502, "text": "bad gateway"},
+                {"json": {"id": 1}},
+            ],
+        )
+
+        result = api.post("/orders/", {"item": 1})
+        self.assertEqual(result.error_code, 502)
+        self.assertEqual(data_mock.call_count, 1)
+
+        result = api.post("/orders/", {"item": 1}, idempotency_key="order-1")
+        self.assertTrue(result.ok)
+        self.assertEqual(data_mock.call_count, 3)
+        self.assertEqual(
+            data_mock.last_request.headers[retry.IDEMPOTENCY_KEY_HEADER], "order-1"
+        )
+
+    @mock()
+    def test_retry_after_is_respected_up_to_its_limit(self, sleep, api_mock):
+        data_mock = api_mock.register_uri(
+            "GET",
+            url("/reports/"),
+            [
+                {"status_code": 503, "headers": {"Retry-After": "1"}},
+                {"status_code": 503, "headers": {"Retry-After": "3600"}},
+                {"json": {}},
+            ],
+        )
+
+        result = api.fetch("/reports/")
+
+        self.assertEqual(result.error_code, 503)
+        self.assertEqual(data_mock.call_count, 2)
+        sleep.assert_called_once_with(1)
+
+    @mock()
+    def test_calls_do_not_run_past_the_request_deadline(self, sleep, api_mock):
+        data_mock = api_mock.register_uri("GET", url("/reports/"), json={})
+        results = []
+
+        def view(request):
+            results.append(api.fetch("/reports/"))
+            return HttpResponse()
+
+        request = RequestFactory().get("/")
+        request.session = {}
+        with patch.object(retry, "REQUEST_DEADLINE", 0):
+            api.GlobalRequestMiddleware(view)(request)
+
+        self.assertEqual(data_mock.call_count, 0)
+        self.assertEqual(results[0].error_code, api.NETWORK_ERROR_CODE)
+        self.assertEqual(results[0].data["error_code"], "NETWORK_TIMEOUT_ERROR")
+
+    def test_attempt_timeout_is_capped_by_the_deadline(self, sleep):
+        self.assertEqual(transport._cap_timeout((3.05, 30), 2), (2, 2))
+        self.assertEqual(transport._cap_timeout((3.05, 30), None), (3.05, 30))
+        self.assertEqual(transport._cap_timeout(None, 5), 5)
+
+
+class HedgingTests(SiteTokenMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        hedging.reset()
+
+    def tearDown(self):
+        hedging.reset()
+
+    def warm_up(self, endpoint, max_rate=1):
+        hedger = hedging.Hedger(endpoint, percentile=90, min_samples=10)
+        hedger.max_rate = max_rate
+        for _ in range(10):
+            hedger.record(0.01)
+        hedging._hedgers[endpoint] = hedger
+        return hedger
+
+    def test_delay_is_the_latency_percentile_once_known(self):
+        hedger = hedging.Hedger("test", percentile=90, min_samples=10)
+        for n in range(9):
+            hedger.record(n / 100)
+        self.assertIsNone(hedger.delay())
+
+        hedger.record(0.09)
+        self.assertEqual(hedger.delay(), 0.09)
+
+    def test_slow_get_is_hedged_and_first_response_wins(self):
+        hedger = self.warm_up("/reports/")
+        calls = []
+
+        def upstream(method, url, **kwargs):
+            calls.append(url)
+            # Only the first request hits a slow upstream
+            if len(calls) == 1:
+                time.sleep(0.5)
+            response = Response()
+            response.status_code = 200
+            response._content = json.dumps({"call": len(calls)}).encode()
+            response.raw = io.BytesIO()
+            return response
+
+        started = time.monotonic()
+        with patch.object(transport, "request", side_effect=upstream):
+            result = api.fetch("/reports/", hedge=True)
+
+        self.assertLess(time.monotonic() - started, 0.4)
+        self.assertEqual(result.data, {"call": 2})
+        self.assertEqual(hedger.hedged, 1)
+
+    def test_hedges_are_capped_by_the_hedge_rate(self):
+        hedger = self.warm_up("/reports/", max_rate=0)
+
+        def upstream(method, url, **kwargs):
+            time.sleep(0.05)
+            response = Response()
+            response.status_code = 200
+            response._content = b"{}"
+            return response
+
+        with patch.object(transport, "request", side_effect=upstream) as request:
+            result = api.fetch("/reports/", hedge=True)
+
+        self.assertTrue(result.ok)
+        self.assertEqual(request.call_count, 1)
+        self.assertEqual(hedger.hedged, 0)
+
+    async def test_async_hedge_cancels_the_losing_request(self):
+        hedger = self.warm_up("/reports/")
+        cancelled = []
+
+        async def send(delay):
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                cancelled.append(delay)
+                raise
+            return delay
+
+        delays = iter([1, 0])
+        response = await hedging.acall("/reports/", lambda: send(next(delays)))
+        # Let the cancelled task run its cancellation
+        await asyncio.sleep(0)
+
+        self.assertEqual(response, 0)
+        self.assertEqual(cancelled, [1])
+        self.assertEqual(hedger.hedged, 1)
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        metrics.sink.clear()
+        api.token_store.clear()
+        api.responses.clear()
+
+    def test_histograms_render_cumulative_buckets(self):
+        registry = metrics.Registry(buckets=(0.1, 1))
+        registry.observe("latency_seconds", (("endpoint", "/a/"),), 0.05)
+        registry.observe("latency_seconds", (("endpoint", "/a/"),), 0.5)
+        registry.increment("calls_total", (("status", "200"),))
+
+        self.assertEqual(
+            registry.render(),
+            "# TYPE calls_total counter\n"
+            'calls_total{status="200"} 1\n'
+            "# TYPE latency_seconds histogram\n"
+            'latency_seconds_bucket{endpoint="/a/",le="0.1"} 1\n'
+            'latency_seconds_bucket{endpoint="/a/",le="1"} 2\n'
+            'latency_seconds_bucket{endpoint="/a/",le="+Inf"} 2\n'
+            'latency_seconds_sum{endpoint="/a/"} 0.55\n'
+            'latency_seconds_count{endpoint="/a/"} 2\n',
+        )
+
+    @mock()
+    def test_api_calls_record_tokens_upstream_and_cache(self, api_mock):
+        api_mock.register_uri(
+            "POST",
+            url(api.ACCESS_TOKEN_ENDPOINT),
+            json={"access_token": "site", "expires_in": 36000},
+        )
+        api_mock.register_uri("GET", url("/reports/"), json=[])
+
+        api.fetch("/reports/", cache_ttl=60)
+        api.fetch("/reports/", cache_ttl=60)
+
+        value = metrics.sink.value
+        self.assertEqual(
+            value(
+                "remoteauth_token_grants_total", grant="client_credentials", result="ok"
+            ),
+            1,
+        )
+        self.assertEqual(value("remoteauth_token_seconds", kind="site"), 2)
+        self.assertEqual(
+            value(
+                "remoteauth_upstream_responses_total",
+                method="GET",
+                endpoint="/reports/",
+                status=200,
+            ),
+            1,
+        )
+        self.assertEqual(
+            value(
+                "remoteauth_api_calls_total",
+                method="GET",
+                endpoint="/reports/",
+                result="ok",
+            ),
+            2,
+        )
+        self.assertEqual(value("remoteauth_response_cache_total", result="miss"), 1)
+        self.assertEqual(value("remoteauth_response_cache_total", result="hit"), 1)
+        self.assertEqual(
+            value("remoteauth_upstream_in_flight", method="GET", endpoint="/reports/"),
+            0,
+        )
+
+    def endpoint_labels(self):
+        return set(re.findall(r'endpoint="([^"]*)"', metrics.sink.render()))
+
+    @mock()
+    @patch.object(metrics, "METRICS_ENDPOINTS", ["/reports/"])
+    def test_unknown_proxied_paths_share_the_other_series(self, api_mock):
+        api_mock.register_uri(
+            "POST",
+            url(api.ACCESS_TOKEN_ENDPOINT),
+            json={"access_token": "site", "expires_in": 36000},
+        )
+        api_mock.register_uri("GET", requests_mock.ANY, json={})
+
+        views.apify(RequestFactory().get("/reports/"), "reports")
+        views.apify(RequestFactory().get("/x0/"), "x0")
+        series = metrics.sink.render().count("\n")
+        for n in range(1, 10):
+            views.apify(RequestFactory().get(f"/x{n}/"), f"x{n}")
+
+        self.assertEqual(metrics.sink.render().count("\n"), series)
+        self.assertEqual(self.endpoint_labels(), {"/reports/", metrics.OTHER_ENDPOINT})
+
+    @mock()
+    @patch.object(api, "MAX_ENDPOINTS", 3)
+    @patch.object(api, "_endpoints", set())
+    def test_endpoint_labels_are_bounded_by_default(self, api_mock):
+        api_mock.register_uri(
+            "POST",
+            url(api.ACCESS_TOKEN_ENDPOINT),
+            json={"access_token": "site", "expires_in": 36000},
+        )
+        api_mock.register_uri("GET", requests_mock.ANY, json={})
+
+        for n in range(10):
+            views.apify(RequestFactory().get(f"/x{n}/"), f"x{n}")
+
+        self.assertEqual(
+            self.endpoint_labels(),
+            {"/oauth/token/", "/x0/", "/x1/", "/x2/", metrics.OTHER_ENDPOINT},
+        )
+
+    @mock()
+    def test_metrics_view_serves_prometheus_text(self, api_mock):
+        api_mock.register_uri(
+            "POST",
+            url(api.ACCESS_TOKEN_ENDPOINT),
+            json={"access_token": "site", "expires_in": 36000},
+        )
+        api_mock.register_uri("GET", url("/reports/"), status_code=404, json={})
+        views.apify(RequestFactory().get("/reports/"), "reports")
+
+        response = views.metrics_view(RequestFactory().get("/metrics/"))
+
+        self.assertEqual(response["Content-Type"], "text/plain; version=0.0.4")
+        self.assertIn(
+            'remoteauth_proxy_responses_total{method="GET",status="400"} 1',
+            response.content.decode(),
+        )
+
+    @mock()
+    def test_nothing_is_recorded_without_a_sink(self, api_mock):
+        api_mock.register_uri(
+            "POST",
+            url(api.ACCESS_TOKEN_ENDPOINT),
+            json={"access_token": "site", "expires_in": 36000},
+        )
+        api_mock.register_uri("GET", url("/reports/"), json=[])
+
+        with patch.object(metrics, "sink", None):
+            result = api.fetch("/reports/")
+
+        self.assertTrue(result.ok)
+        self.assertEqual(metrics.sink.render(), "\n")
+
+
+class RecordingTracer:
+    def __init__(self):
+        self.spans = []
+
+    def start_span(self, name, attributes=None):
+        tracer = self
+
+        class Span(tracing.NoopSpan):
+            def end(self):
+                tracer.spans.append((name, attributes))
+
+        return Span()
+
+
+class TracingTests(TestCase):
+    def setUp(self):
+        api.token_store.clear()
+
+    def mock_upstream(self, api_mock):
+        api_mock.register_uri(
+            "POST",
+            url(api.ACCESS_TOKEN_ENDPOINT),
+            json={"access_token": "site", "expires_in": 36000},
+        )
+        return api_mock.register_uri("GET", url("/reports/"), json={"id": 1})
+
+    @mock()
+    def test_apify_reports_phases_and_propagates_request_id(self, api_mock):
+        data_mock = self.mock_upstream(api_mock)
+        request = RequestFactory().get("/reports/", HTTP_X_REQUEST_ID="abc-123")
+
+        response = views.apify(request, "reports")
+
+        phases = [
+            timing.split(";")[0] for timing in response["Server-Timing"].split(", ")
+        ]
+        # The proxy relays the body without decoding it
+        self.assertEqual(phases, ["token", "upstream", "encode", "total"])
+        self.assertEqual(response["X-Request-ID"], "abc-123")
+        self.assertEqual(data_mock.last_request.headers["X-Request-ID"], "abc-123")
+
+    @mock()
+    def test_unsafe_request_ids_are_replaced(self, api_mock):
+        data_mock = self.mock_upstream(api_mock)
+        request = RequestFactory().get("/reports/", HTTP_X_REQUEST_ID="a b\r\nc")
+
+        response = views.apify(request, "reports")
+
+        request_id = data_mock.last_request.headers["X-Request-ID"]
+        self.assertRegex(request_id, "^[0-9a-f]{32}$")
+        self.assertEqual(response["X-Request-ID"], request_id)
+
+    @mock()
+    def test_spans_are_reported_to_the_tracer(self, api_mock):
+        self.mock_upstream(api_mock)
+        tracer = RecordingTracer()
+
+        with patch.object(tracing, "tracer", tracer):
+            views.apify(RequestFactory().get("/reports/"), "reports")
+
+        self.assertEqual(
+            [name for name, _ in tracer.spans],
+            [
+                "remoteauth.token",
+                "remoteauth.upstream",
+                "remoteauth.encode",
+                "remoteauth.total",
+            ],
+        )
+        self.assertEqual(tracer.spans[1][1], {"method": "GET", "endpoint": "/reports/"})
+
+    @mock()
+    def test_middleware_owns_the_trace_of_proxied_requests(self, api_mock):
+        self.mock_upstream(api_mock)
+        request = RequestFactory().get("/reports/")
+        request.session = {}
+
+        response = api.GlobalRequestMiddleware(
+            lambda request: views.apify(request, "reports")
+        )(request)
+
+        self.assertEqual(response["Server-Timing"].count("total;"), 1)
+        self.assertIn("X-Request-ID", response)
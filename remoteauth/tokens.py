@@ -0,0 +1,410 @@
+import logging
+import math
+import threading
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+
+logger = logging.getLogger(__name__)
+
+# Can remain static until restart
+TOKEN_STORE = getattr(settings, "API_TOKEN_STORE", "remoteauth.tokens.LocalTokenStore")
+TOKEN_CACHE_ALIAS = getattr(settings, "API_TOKEN_CACHE_ALIAS", "default")
+TOKEN_CACHE_PREFIX = getattr(settings, "API_TOKEN_CACHE_PREFIX", "remoteauth:token:")
+TOKEN_LOCK_TIMEOUT = getattr(settings, "API_TOKEN_LOCK_TIMEOUT", 10)
+TOKEN_LOCK_POLL_INTERVAL = 0.05
+# Format of the grant time kept in tokens by earlier versions
+ISO_DATE_FORMAT = "'%Y-%m-%dT%H:%M:%S'"
+
+
+class Token:
+    """
+    An access token as granted by the OAuth server. Its expiry is kept as an
+    absolute epoch time, so checking it is a single comparison. Tokens are
+    kept in the session in the form returned by to_session().
+    """
+
+    __slots__ = (
+        "access_token",
+        "refresh_token",
+        "token_type",
+        "scope",
+        "expires_in",
+        "expires_at",
+        "subject",
+    )
+
+    # Dict keys of the grant response each attribute is read from
+    _keys = {
+        "access_token": "access_token",
+        "refresh_token": "refresh_token",
+        "token_type": "token_type",
+        "scope": "scope",
+        "expires_in": "expires_in",
+        "sub": "subject",
+    }
+
+    def __init__(
+        self,
+        access_token,
+        refresh_token=None,
+        token_type="Bearer",
+        scope=None,
+        expires_in=None,
+        expires_at=None,
+        subject=None,
+    ):
+        self.access_token = access_token
+        self.refresh_token = refresh_token
+        self.token_type = token_type
+        self.scope = scope
+        self.expires_in = expires_in
+        if expires_at is None:
+            expires_at = math.inf if expires_in is None else time.time() + expires_in
+        self.expires_at = expires_at
+        self.subject = subject
+
+    @classmethod
+    def from_grant(cls, data, granted_at=None):
+        """
+        Build a token from the JSON body of a token endpoint response, granted
+        at the epoch time granted_at or just now
+        """
+        expires_in = data.get("expires_in")
+        expires_at = data.get("expires_at")
+        if expires_at is None and None not in (expires_in, granted_at):
+            expires_at = granted_at + expires_in
+        return cls(
+            data["access_token"],
+            refresh_token=data.get("refresh_token"),
+            token_type=data.get("token_type", "Bearer"),
+            scope=data.get("scope"),
+            expires_in=expires_in,
+            expires_at=expires_at,
+            subject=data.get("sub"),
+        )
+
+    @classmethod
+    def load(cls, value):
+        """
+        Read a token kept in the session or a token store. Tokens kept by
+        earlier versions carry their grant time as a formatted timestamp,
+        which is parsed once here.
+        """
+        if value is None or isinstance(value, cls):
+            return value
+        granted_at = None
+        timestamp = value.get("timestamp")
+        if timestamp is not None and "expires_at" not in value:
+            granted_at = datetime.strptime(timestamp, ISO_DATE_FORMAT).timestamp()
+        return cls.from_grant(value, granted_at)
+
+    def to_session(self):
+        data = {"access_token": self.access_token, "token_type": self.token_type}
+        if self.refresh_token is not None:
+            data["refresh_token"] = self.refresh_token
+        if self.scope is not None:
+            data["scope"] = self.scope
+        if self.expires_in is not None:
+            data["expires_in"] = self.expires_in
+        if self.expires_at != math.inf:
+            data["expires_at"] = self.expires_at
+        if self.subject is not None:
+            data["sub"] = self.subject
+        return data
+
+    def is_expired(self, leeway=0):
+        return time.time() >= self.expires_at - leeway
+
+    def expired(self):
+        """
+        Return a copy of this token that is expired, but can still be refreshed
+        """
+        return Token(
+            self.access_token,
+            refresh_token=self.refresh_token,
+            token_type=self.token_type,
+            scope=self.scope,
+            expires_in=self.expires_in,
+            expires_at=0,
+            subject=self.subject,
+        )
+
+    # Read access under the grant response keys, for code written against
+    # the dicts tokens used to be
+
+    def get(self, key, default=None):
+        attribute = self._keys.get(key)
+        if attribute is None:
+            return default
+        value = getattr(self, attribute)
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __eq__(self, other):
+        if not isinstance(other, Token):
+            return NotImplemented
+        return self.to_session() == other.to_session()
+
+    def __hash__(self):
+        return hash(self.access_token)
+
+    def __repr__(self):
+        return f"<Token {self.token_type} expires_at={self.expires_at}>"
+
+
+class LocalTokenStore:
+    """
+    Keeps tokens in process memory. Concurrent misses on the same key are
+    collapsed so that only one caller runs the refresh while the others
+    wait for its result.
+    """
+
+    # Whether tokens kept here are seen by every worker. User tokens are only
+    # refreshed ahead into a shared store, as the session they belong to may
+    # come back to any worker.
+    shared = False
+
+    def __init__(self):
+        self._tokens = {}
+        self._locks = {}
+        self._refreshing = set()
+        self._guard = threading.Lock()
+
+    def _lock_for(self, key):
+        with self._guard:
+            lock = self._locks.get(key)
+            if lock is None:
+                lock = self._locks[key] = threading.Lock()
+            return lock
+
+    def get(self, key):
+        return self._tokens.get(key, None)
+
+    def set(self, key, token):
+        with self._guard:
+            self._tokens[key] = token
+            self._drop_expired()
+
+    def _drop_expired(self):
+        # Tokens refreshed ahead for sessions that never come back to this
+        # worker are only dropped here, once they have expired
+        for key, token in list(self._tokens.items()):
+            if Token.load(token).is_expired():
+                del self._tokens[key]
+                self._drop_lock(key)
+
+    def _drop_lock(self, key):
+        lock = self._locks.get(key)
+        if lock is not None and not lock.locked() and key not in self._refreshing:
+            del self._locks[key]
+
+    def take(self, key):
+        """
+        Remove and return the token kept under key, if any
+        """
+        with self._guard:
+            token = self._tokens.pop(key, None)
+            self._drop_lock(key)
+        return token
+
+    def invalidate(self, key, token=None):
+        """
+        Drop the token kept under key. When token is given, only drop it if it
+        is still the one kept, so that a caller holding a rejected token can
+        not throw away a replacement that another caller already fetched.
+        """
+        with self._guard:
+            if token is None or self._same_token(self._tokens.get(key), token):
+                self._tokens.pop(key, None)
+                self._drop_lock(key)
+
+    def _same_token(self, kept, token):
+        return kept is not None and kept.get("access_token") == token.get(
+            "access_token"
+        )
+
+    def clear(self):
+        with self._guard:
+            self._tokens.clear()
+            self._locks.clear()
+
+    def get_or_refresh(self, key, is_valid, refresh):
+        token = self.get(key)
+        if token is not None and is_valid(token):
+            return token
+
+        with self._lock_for(key):
+            # Another thread may have refreshed while we were waiting
+            token = self.get(key)
+            if token is not None and is_valid(token):
+                return token
+            token = refresh()
+            if token is not None:
+                self.set(key, token)
+            return token
+
+    def refresh_in_background(self, key, refresh, is_due=None):
+        """
+        Run refresh on a daemon thread and keep its result under key. At most
+        one background refresh runs per key at a time. is_due tells whether a
+        token found under key by then still needs refreshing.
+        """
+        with self._guard:
+            if key in self._refreshing:
+                return False
+            self._refreshing.add(key)
+
+        def run():
+            try:
+                self._refresh_ahead(key, refresh, is_due)
+            except Exception:
+                logger.exception("Background refresh of token %s failed", key)
+            finally:
+                with self._guard:
+                    self._refreshing.discard(key)
+
+        threading.Thread(
+            target=run, name=f"remoteauth-refresh-{key}", daemon=True
+        ).start()
+        return True
+
+    def _refresh_ahead(self, key, refresh, is_due=None):
+        with self._lock_for(key):
+            token = self.get(key)
+            if token is not None and is_due is not None and not is_due(token):
+                return
+            token = refresh()
+            if token is not None:
+                self.set(key, token)
+
+
+class CacheTokenStore(LocalTokenStore):
+    """
+    Shares tokens between worker processes through Django's cache framework.
+    A lock taken with cache.add() lets one worker refresh an expiring token
+    while the others poll the cache for its result. A copy of each token is
+    kept in process memory so that hot reads do not touch the cache.
+    """
+
+    shared = True
+
+    def __init__(self, alias=None, prefix=None, lock_timeout=None):
+        super().__init__()
+        self.cache = caches[alias or TOKEN_CACHE_ALIAS]
+        self.prefix = prefix if prefix is not None else TOKEN_CACHE_PREFIX
+        self.lock_timeout = lock_timeout or TOKEN_LOCK_TIMEOUT
+
+    def _cache_key(self, key):
+        return f"{self.prefix}{key}"
+
+    def _lock_key(self, key):
+        return f"{self.prefix}{key}:lock"
+
+    def get(self, key):
+        token = super().get(key)
+        if token is None:
+            token = self.cache.get(self._cache_key(key))
+            if token is not None:
+                super().set(key, token)
+        return token
+
+    def set(self, key, token):
+        super().set(key, token)
+        self.cache.set(self._cache_key(key), token, timeout=token.get("expires_in"))
+
+    def take(self, key):
+        token = super().take(key)
+        cache_key = self._cache_key(key)
+        if token is None:
+            token = self.cache.get(cache_key)
+        self.cache.delete(cache_key)
+        return token
+
+    def invalidate(self, key, token=None):
+        super().invalidate(key, token)
+        if token is None or self._same_token(
+            self.cache.get(self._cache_key(key)), token
+        ):
+            self.cache.delete(self._cache_key(key))
+
+    def clear(self):
+        for key in list(self._tokens):
+            self.cache.delete(self._cache_key(key))
+        super().clear()
+
+    def _get_shared(self, key, is_valid):
+        token = self.cache.get(self._cache_key(key))
+        if token is not None and is_valid(token):
+            super().set(key, token)
+            return token
+
+    def get_or_refresh(self, key, is_valid, refresh):
+        token = super().get(key)
+        if token is not None and is_valid(token):
+            return token
+
+        # Only one thread per process takes part in the cross-worker race
+        with self._lock_for(key):
+            token = super().get(key)
+            if token is not None and is_valid(token):
+                return token
+
+            lock_key = self._lock_key(key)
+            deadline = time.monotonic() + self.lock_timeout
+            while True:
+                token = self._get_shared(key, is_valid)
+                if token is not None:
+                    return token
+
+                if self.cache.add(lock_key, 1, timeout=self.lock_timeout):
+                    try:
+                        token = self._get_shared(key, is_valid)
+                        if token is None:
+                            token = refresh()
+                            if token is not None:
+                                self.set(key, token)
+                        return token
+                    finally:
+                        self.cache.delete(lock_key)
+
+                if time.monotonic() >= deadline:
+                    # The worker holding the lock is stuck, refresh ourselves
+                    token = refresh()
+                    if token is not None:
+                        self.set(key, token)
+                    return token
+                time.sleep(TOKEN_LOCK_POLL_INTERVAL)
+
+    def _refresh_ahead(self, key, refresh, is_due=None):
+        lock_key = self._lock_key(key)
+        # Skip when another worker is already refreshing this token
+        if not self.cache.add(lock_key, 1, timeout=self.lock_timeout):
+            return
+        try:
+            # Another worker may have refreshed it since our copy was read
+            token = self.cache.get(self._cache_key(key))
+            if token is not None and is_due is not None and not is_due(token):
+                super().set(key, token)
+                return
+            token = refresh()
+            if token is not None:
+                self.set(key, token)
+        finally:
+            self.cache.delete(lock_key)
+
+
+def get_token_store():
+    """
+    Build the token store configured by the API_TOKEN_STORE setting
+    """
+    return import_string(TOKEN_STORE)()
@@ -0,0 +1,169 @@
+import re
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+# Can remain static until restart
+# Class spans are reported to, see NoopTracer
+TRACER = getattr(settings, "API_TRACER", "remoteauth.tracing.NoopTracer")
+# Return the time spent in each phase of a request as a Server-Timing header
+SERVER_TIMING = getattr(settings, "API_SERVER_TIMING", True)
+# Header the request id is read from and sent to the API in
+REQUEST_ID_HEADER = getattr(settings, "API_REQUEST_ID_HEADER", "X-Request-ID")
+
+# Request ids taken from clients must be safe to send on in a header
+_valid_request_id = re.compile(r"^[\w.:-]{1,128}$")
+_current = ContextVar("remoteauth_trace", default=None)
+
+
+class NoopSpan:
+    def set_attribute(self, key, value):
+        pass
+
+    def record_exception(self, exception):
+        pass
+
+    def end(self):
+        pass
+
+
+class NoopTracer:
+    """
+    Drops all spans. A tracer for e.g. OpenTelemetry implements the same
+    start_span method, returning spans with set_attribute, record_exception
+    and end methods.
+    """
+
+    _span = NoopSpan()
+
+    def start_span(self, name, attributes=None):
+        return self._span
+
+
+class Trace:
+    """
+    The phases of one request and the time each took
+    """
+
+    __slots__ = ("request_id", "timings")
+
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.timings = []
+
+    def record(self, name, seconds):
+        self.timings.append((name, seconds))
+
+    def server_timing(self):
+        return ", ".join(
+            f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.timings
+        )
+
+    def apply(self, response):
+        """
+        Tell the client the request id and, with API_SERVER_TIMING, the
+        time each phase took
+        """
+        response[REQUEST_ID_HEADER] = self.request_id
+        if SERVER_TIMING and self.timings:
+            response["Server-Timing"] = self.server_timing()
+
+
+def get_tracer():
+    """
+    Build the tracer configured by the API_TRACER setting
+    """
+    return import_string(TRACER)()
+
+
+tracer = get_tracer()
+
+
+def request_id_of(request):
+    request_id = request.headers.get(REQUEST_ID_HEADER, "")
+    if _valid_request_id.match(request_id):
+        return request_id
+    return uuid.uuid4().hex
+
+
+def current_trace():
+    return _current.get()
+
+
+@contextmanager
+def request_trace(request):
+    """
+    Trace the handling of request. Yields its Trace, or None when the request
+    is already being traced further up, in which case that caller applies
+    the trace to the response.
+    """
+    if _current.get() is not None:
+        yield None
+        return
+
+    trace = Trace(request_id_of(request))
+    reset_token = _current.set(trace)
+    try:
+        with span(
+            "total",
+            **{"http.method": request.method, "request_id": trace.request_id},
+        ):
+            yield trace
+    finally:
+        _current.reset(reset_token)
+
+
+class span:
+    """
+    Time a phase of the current request: it is reported to the tracer and,
+    when a request is being traced, added to its Server-Timing
+    """
+
+    __slots__ = ("name", "attributes", "span", "started")
+
+    def __init__(self, name, **attributes):
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self):
+        self.span = tracer.start_span(f"remoteauth.{self.name}", self.attributes)
+        self.started = time.perf_counter()
+        return self.span
+
+    def __exit__(self, exc_type, exc, traceback):
+        seconds = time.perf_counter() - self.started
+        trace = _current.get()
+        if trace is not None:
+            trace.record(self.name, seconds)
+        if exc is not None:
+            self.span.record_exception(exc)
+        self.span.end()
+
+
+def traced(name, func):
+    """
+    Wrap func so that each of its calls is timed as the phase name
+    """
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with span(name):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def propagation_headers():
+    """
+    Headers that tie calls to the API to the request being handled
+    """
+    trace = _current.get()
+    if trace is None:
+        return {}
+    return {REQUEST_ID_HEADER: trace.request_id}
@@ -0,0 +1,229 @@
+import asyncio
+import threading
+import weakref
+from urllib.parse import urlsplit
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, ConnectTimeout, Timeout
+from django.conf import settings
+
+from remoteauth import metrics, resilience, retry, tracing
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+# Can remain static until restart
+POOL_CONNECTIONS = getattr(settings, "API_POOL_CONNECTIONS", 10)
+POOL_MAXSIZE = getattr(settings, "API_POOL_MAXSIZE", 20)
+POOL_BLOCK = getattr(settings, "API_POOL_BLOCK", False)
+CONNECT_TIMEOUT = getattr(settings, "API_CONNECT_TIMEOUT", 3.05)
+READ_TIMEOUT = getattr(settings, "API_READ_TIMEOUT", 30)
+
+_session = None
+_session_lock = threading.Lock()
+# httpx clients are bound to the event loop they were first used on
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def _build_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=POOL_CONNECTIONS,
+        pool_maxsize=POOL_MAXSIZE,
+        pool_block=POOL_BLOCK,
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    # The session is shared by every user of the process, so it must never
+    # carry cookies set by the upstream from one call into the next.
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    return session
+
+
+def get_session():
+    """
+    Return the process-wide pooled session, creating it on first use
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _build_session()
+    return _session
+
+
+def _cap_timeout(timeout, budget):
+    if budget is None:
+        return timeout
+    if isinstance(timeout, tuple):
+        return tuple(budget if t is None else min(t, budget) for t in timeout)
+    return budget if timeout is None else min(timeout, budget)
+
+
+def _propagate(kwargs):
+    # Let the API tie the call to the request being handled
+    headers = tracing.propagation_headers()
+    if headers:
+        kwargs["headers"] = {**headers, **(kwargs.get("headers", None) or {})}
+
+
+def _count_response(method, endpoint, status):
+    metrics.increment(
+        "remoteauth_upstream_responses_total",
+        method=method,
+        endpoint=endpoint,
+        status=status,
+    )
+
+
+def _observed(method, url, endpoint, send):
+    """
+    Run send() and record its latency and response status per endpoint
+    """
+    name = endpoint or urlsplit(url).netloc
+    with metrics.timer(
+        "remoteauth_upstream_request_seconds",
+        gauge="remoteauth_upstream_in_flight",
+        method=method,
+        endpoint=name,
+    ):
+        try:
+            response = send()
+        except Exception:
+            _count_response(method, name, "error")
+            raise
+        _count_response(method, name, response.status_code)
+        return response
+
+
+async def _aobserved(method, url, endpoint, send):
+    name = endpoint or urlsplit(url).netloc
+    with metrics.timer(
+        "remoteauth_upstream_request_seconds",
+        gauge="remoteauth_upstream_in_flight",
+        method=method,
+        endpoint=name,
+    ):
+        try:
+            response = await send()
+        except Exception:
+            _count_response(method, name, "error")
+            raise
+        _count_response(method, name, response.status_code)
+        return response
+
+
+def request(method, url, endpoint=None, retries=0, deadline=None, **kwargs):
+    """
+    Send a request through the pooled session. Connections are kept alive
+    and reused, and a (connect, read) timeout is applied unless given.
+    The call is guarded by the circuit breaker of endpoint and the bulkhead
+    of the upstream host, see remoteauth.resilience. Failed idempotent
+    requests are sent again up to retries times, and no attempt runs past
+    deadline (a time.monotonic() value), see remoteauth.retry.
+    """
+    timeout = kwargs.pop("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
+    _propagate(kwargs)
+
+    def send(budget):
+        return resilience.call(
+            url,
+            endpoint,
+            lambda: _observed(
+                method,
+                url,
+                endpoint,
+                lambda: get_session().request(
+                    method, url, timeout=_cap_timeout(timeout, budget), **kwargs
+                ),
+            ),
+        )
+
+    return retry.call(method, kwargs.get("headers", None), send, retries, deadline)
+
+
+def close():
+    """
+    Close the pooled session and drop all kept-alive connections
+    """
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def _build_async_client():
+    if httpx is None:
+        raise ImportError(
+            "The async API needs httpx. Install it with: pip install remoteauth[async]"
+        )
+
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=POOL_CONNECTIONS * POOL_MAXSIZE,
+            max_keepalive_connections=POOL_MAXSIZE,
+        ),
+        timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+        cookies=CookieJar(policy=DefaultCookiePolicy(allowed_domains=[])),
+    )
+
+
+def get_async_client():
+    """
+    Return the pooled httpx.AsyncClient of the running event loop
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = _build_async_client()
+    return client
+
+
+async def arequest(method, url, endpoint=None, retries=0, deadline=None, **kwargs):
+    """
+    Send a request through the pooled async client without blocking the
+    event loop. Network failures are raised as the same requests exceptions
+    that request() raises, and retries and deadline work the same way.
+    """
+    client = get_async_client()
+    _propagate(kwargs)
+
+    async def send(budget):
+        if budget is not None:
+            kwargs["timeout"] = httpx.Timeout(
+                min(READ_TIMEOUT, budget), connect=min(CONNECT_TIMEOUT, budget)
+            )
+        try:
+            return await client.request(method, url, **kwargs)
+        except httpx.ConnectTimeout as ex:
+            raise ConnectTimeout(str(ex)) from ex
+        except httpx.TimeoutException as ex:
+            raise Timeout(str(ex)) from ex
+        except httpx.TransportError as ex:
+            raise ConnectionError(str(ex)) from ex
+
+    async def guarded_send(budget):
+        return await resilience.acall(
+            url,
+            endpoint,
+            lambda: _aobserved(method, url, endpoint, lambda: send(budget)),
+        )
+
+    return await retry.acall(
+        method, kwargs.get("headers", None), guarded_send, retries, deadline
+    )
+
+
+async def aclose():
+    """
+    Close the async client of the running event loop
+    """
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
@@ -1,5 +1,9 @@
 from django.urls import path
-from .views import apify
+from .metrics import METRICS_VIEW
+from .views import apify, metrics_view
 urlpatterns = [
     path("<str:path>/", view=apify, name='apify_view')
 ]
+if METRICS_VIEW:
+    # Before the catch-all route, which would forward it to the API
+    urlpatterns.insert(0, path("metrics/", view=metrics_view, name="metrics_view"))
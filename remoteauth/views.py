@@ -1,8 +1,31 @@
-import json
-from django.http.response import HttpResponse, JsonResponse
+from django.conf import settings
+from django.http.response import (
+    Http404,
+    HttpResponse,
+    StreamingHttpResponse,
+)
 
-from remoteauth import api
+from remoteauth import api, codec, metrics, tracing
 from remoteauth.api import ApiResults
+from remoteauth.multipart import MultipartBody, RequestStream
+
+# Can remain static until restart
+PROXY_STREAM = getattr(settings, "API_PROXY_STREAM", False)
+PROXY_STREAM_CHUNK_SIZE = getattr(settings, "API_PROXY_STREAM_CHUNK_SIZE", 64 * 1024)
+# Upstream response headers relayed by the streaming proxy
+PROXY_STREAM_HEADERS = getattr(
+    settings,
+    "API_PROXY_STREAM_HEADERS",
+    (
+        "Content-Type",
+        "Content-Length",
+        "Content-Encoding",
+        "Content-Disposition",
+        "Cache-Control",
+        "ETag",
+        "Last-Modified",
+    ),
+)
 
 API_HANDLER_MAP = dict(
     get=api.fetch,
@@ -11,26 +34,203 @@ API_HANDLER_MAP = dict(
     delete=api.delete,
 )
 
+ASYNC_API_HANDLER_MAP = dict(
+    get=api.afetch,
+    post=api.apost,
+    put=api.aput,
+    delete=api.adelete,
+)
+
+
+def apify(request, path, *args, stream=None, **kwargs):
+    """
+    Forward the request to the API. In streaming mode (stream=True, or the
+    API_PROXY_STREAM setting) the upstream status, headers and body are
+    relayed as they arrive, without being decoded.
+    """
+    with tracing.request_trace(request) as trace, _proxy_timer(request):
+        response = _apify(request, path, stream)
+    if trace is not None:
+        trace.apply(response)
+    _count_proxy_response(request, response)
+    return response
+
+
+async def aapify(request, path, *args, **kwargs):
+    """
+    Async version of apify for ASGI deployments. The upstream call does not
+    hold a thread while it waits for the response.
+    """
+    with tracing.request_trace(request) as trace, _proxy_timer(request):
+        response = await _aapify(request, path)
+    if trace is not None:
+        trace.apply(response)
+    _count_proxy_response(request, response)
+    return response
+
+
+def metrics_view(request):
+    """
+    Serve the metrics recorded by this process in the Prometheus text format
+    """
+    if not hasattr(metrics.sink, "render"):
+        raise Http404("Metrics are not kept in process")
+    return HttpResponse(metrics.sink.render(), content_type="text/plain; version=0.0.4")
+
+
+def _proxy_timer(request):
+    return metrics.timer(
+        "remoteauth_proxy_seconds",
+        gauge="remoteauth_proxy_in_flight",
+        method=request.method,
+    )
+
+
+def _count_proxy_response(request, response):
+    metrics.increment(
+        "remoteauth_proxy_responses_total",
+        method=request.method,
+        status=response.status_code,
+    )
+
+
+def _apify(request, path, stream):
+    if PROXY_STREAM if stream is None else stream:
+        return _stream(request, path)
 
-def apify(request, path, *args, **kwargs):
     request_method: str = request.method or ""
     api_forwarding_func = API_HANDLER_MAP.get(request_method.lower())
     if not api_forwarding_func:
         return HttpResponse(status=405)
 
+    if _is_upload(request):
+        query_string = request.META.get("QUERY_STRING", "")
+        body, content_type, replayable = _upload_body(request)
+        api_result: ApiResults = api.upload(
+            request_method,
+            f"/{path}/?{query_string}",
+            body,
+            content_type,
+            max_retry=3 if replayable else 0,
+        )
+        return _to_response(api_result)
+
+    api_result: ApiResults = api_forwarding_func(**_forwarding_kwargs(request, path))
+    return _to_response(api_result)
+
+
+async def _aapify(request, path):
+    request_method: str = request.method or ""
+    api_forwarding_func = ASYNC_API_HANDLER_MAP.get(request_method.lower())
+    if not api_forwarding_func:
+        return HttpResponse(status=405)
+
+    api_result: ApiResults = await api_forwarding_func(
+        **_forwarding_kwargs(request, path)
+    )
+    return _to_response(api_result)
+
+
+def _stream(request, path):
+    request_method: str = request.method or ""
+    if request_method.lower() not in API_HANDLER_MAP:
+        return HttpResponse(status=405)
+
     query_string = request.META.get("QUERY_STRING", "")
+    headers = {}
+    max_retry = 3
+    if _is_upload(request):
+        body, headers["Content-Type"], replayable = _upload_body(request)
+        max_retry = 3 if replayable else 0
+    else:
+        body = request.body or None
+        if request.META.get("CONTENT_TYPE"):
+            headers["Content-Type"] = request.META["CONTENT_TYPE"]
+
+    upstream = api.stream(
+        request_method,
+        f"/{path}/?{query_string}",
+        max_retry=max_retry,
+        headers=headers,
+        data=body,
+    )
+    if isinstance(upstream, ApiResults):
+        return _to_response(upstream)
+
+    response = StreamingHttpResponse(
+        _relay(upstream), status=upstream.status_code, reason=upstream.reason
+    )
+    for header in PROXY_STREAM_HEADERS:
+        if header in upstream.headers:
+            response[header] = upstream.headers[header]
+    return response
+
+
+def _relay(upstream):
+    try:
+        # Bodies are passed on as sent, compressed or not
+        yield from upstream.raw.stream(PROXY_STREAM_CHUNK_SIZE, decode_content=False)
+    finally:
+        upstream.close()
+
+
+def _is_upload(request):
+    return request.method.lower() in ("post", "put") and request.META.get(
+        "CONTENT_TYPE", ""
+    ).startswith("multipart/form-data")
+
+
+def _upload_body(request):
+    """
+    Return the body to forward for a multipart upload, its content type and
+    whether it can be sent more than once
+    """
+    if not getattr(request, "_read_started", True):
+        # Nothing has parsed the upload yet: relay the client's bytes as they
+        # arrive, boundary and all
+        return RequestStream(request), request.META["CONTENT_TYPE"], False
+
+    # Something (e.g. CSRF checks) already parsed it: stream the parsed parts
+    body = MultipartBody(fields=request.POST, files=request.FILES)
+    return body, body.content_type, True
+
+
+def _forwarding_kwargs(request, path):
+    query_string = request.META.get("QUERY_STRING", "")
+    forwarded_path = f"/{path}/?{query_string}"
+    if request.method.lower() == "delete":
+        # The query string already carries everything delete can send
+        return dict(path=forwarded_path)
+    if request.method.lower() == "get":
+        # Responses are relayed without being decoded, see _to_response
+        return dict(path=forwarded_path, raw=True)
+
     files = request.FILES
     data = request.POST or request.GET
     if not data and request.body:
-        data = json.loads(request.body)
+        # A JSON body is forwarded as it came, without decoding it
+        data = request.body
 
-    api_result: ApiResults = api_forwarding_func(
-        path=f"/{path}/?{query_string}", data=data, files=files
-    )
+    return dict(path=forwarded_path, data=data, files=files, raw=True)
 
-    if api_result.ok:
-        return JsonResponse(data=api_result.data)
-    else:
-        return JsonResponse(
-            status=400, data=dict(error=api_result.error_code, **api_result.data)
-        )
+
+def _to_response(api_result: ApiResults):
+    with tracing.span("encode"):
+        if api_result.ok:
+            if not api_result.is_decoded:
+                # Nothing looked at the body, send it back as the API did
+                return HttpResponse(
+                    api_result.raw,
+                    content_type=api_result.content_type or codec.CONTENT_TYPE,
+                )
+            return _json_response(api_result.data)
+        else:
+            return _json_response(
+                dict(error=api_result.error_code, **api_result.data), status=400
+            )
+
+
+def _json_response(data, status=200):
+    return HttpResponse(
+        codec.dumps(data), status=status, content_type=codec.CONTENT_TYPE
+    )